@@ -0,0 +1,97 @@
+"""
+Streaming APKG writer.
+
+genanki builds a Note object per card, validates each field's HTML, and zips the
+collection and every media file with one setting, so the collection goes in
+uncompressed. This writer inserts notes straight from an iterable into the
+collection and deflates only the collection. Media is copied into the archive in
+fixed-size chunks: already-compressed formats (JPEG, PNG, WebP, MP3, ...) are
+stored as-is and anything else is deflated. Memory use doesn't depend on the
+number or size of the notes and media files.
+
+The collection schema, deck and model JSON come from genanki, so the packages
+import the same way as genanki's:
+
+    write_apkg("deck.apkg", model, deck_id, "Birds", notes, media_files)
+"""
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+import genanki
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+
+COMPRESSED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".mp3", ".ogg", ".oga", ".opus", ".m4a", ".mp4", ".webm"}
+COLLECTION_COMPRESSLEVEL = 6
+NOTE_BATCH = 1000  # notes per executemany
+
+
+def compress_type(path):
+    return zipfile.ZIP_STORED if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def note_rows(model, deck_id, notes, timestamp, id_gen):
+    """Yield (note row, [card rows]) for each (guid, fields) note, as genanki would write them."""
+    mod = int(timestamp)
+    for guid, fields in notes:
+        note_id = next(id_gen)
+        note = (note_id, guid, model.model_id, mod, -1, "  ", "\x1f".join(fields),
+                fields[model.sort_field_index], 0, 0, "")
+        cards = []
+        for card_ord, any_or_all, required in model._req:
+            if (any if any_or_all == "any" else all)(fields[i] for i in required):
+                cards.append((next(id_gen), note_id, deck_id, card_ord, mod, -1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ""))
+        yield note, cards
+
+
+def write_collection(path, model, deck_id, deck_name, notes, timestamp):
+    """Write the Anki collection (collection.anki2) for one deck of notes to path."""
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.cursor()
+        cursor.executescript(APKG_SCHEMA)
+        cursor.executescript(APKG_COL)
+        # An empty deck holding just the model: genanki writes the deck and model JSON
+        deck = genanki.Deck(deck_id, deck_name)
+        deck.add_model(model)
+        deck.write_to_db(cursor, timestamp, iter(()))
+        id_gen = itertools.count(int(timestamp * 1000))
+        rows = note_rows(model, deck_id, notes, timestamp, id_gen)
+        while True:
+            batch = list(itertools.islice(rows, NOTE_BATCH))
+            if not batch:
+                break
+            cursor.executemany("INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)", [note for note, _ in batch])
+            cursor.executemany("INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                               [card for _, cards in batch for card in cards])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def write_apkg(output_file, model, deck_id, deck_name, notes, media_files, timestamp=None):
+    """
+    Write an APKG with one deck. notes is an iterable of (guid, field list)
+    pairs (consumed once); media_files are paths, added under their position
+    with their basename recorded in the media map.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    fd, collection = tempfile.mkstemp(suffix=".anki2", dir=os.path.dirname(os.path.abspath(output_file)))
+    os.close(fd)
+    try:
+        write_collection(collection, model, deck_id, deck_name, notes, timestamp)
+        with zipfile.ZipFile(output_file, "w") as out:
+            out.write(collection, "collection.anki2", compress_type=zipfile.ZIP_DEFLATED,
+                      compresslevel=COLLECTION_COMPRESSLEVEL)
+            media_map = {str(idx): os.path.basename(path) for idx, path in enumerate(media_files)}
+            out.writestr("media", json.dumps(media_map), compress_type=zipfile.ZIP_DEFLATED)
+            for idx, path in enumerate(media_files):
+                # ZipFile.write copies in small chunks; nothing is held in memory
+                out.write(path, str(idx), compress_type=compress_type(path))
+    finally:
+        os.remove(collection)
@@ -0,0 +1,77 @@
+"""
+Packaging benchmark: genanki.Package vs the streaming apkg_writer, on synthetic
+notes with incompressible JPEG/MP3-sized media. Each build runs in a fresh
+process so peak memory (max RSS) isn't shared; one extra build per packager runs
+under tracemalloc for the peak of Python allocations, and isn't timed.
+"""
+import argparse
+import concurrent.futures
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_anki_deck import DECK_ID, DECK_NAME, PACKAGERS, write_package
+
+def seed(tmp, notes, image_kb, sounds, sound_kb):
+    media = os.path.join(tmp, "media")
+    os.makedirs(media)
+    sound_paths = []
+    for j in range(sounds):
+        path = os.path.join(media, f"sound_{j}.mp3")
+        with open(path, "wb") as f:
+            f.write(os.urandom(sound_kb * 1000))
+        sound_paths.append(path)
+    rows, media_files = [], list(sound_paths)
+    for i in range(notes):
+        path = os.path.join(media, f"img_{i}.jpg")
+        with open(path, "wb") as f:
+            f.write(os.urandom(image_kb * 1000))
+        media_files.append(path)
+        sound = os.path.basename(sound_paths[i % sounds]) if sounds else ""
+        rows.append((f"guid{i}", [f"img_{i}.jpg", f'<img src="img_{i}.jpg">', f"species {i // 5}", f"Latinus {i // 5}",
+                     f"family {i % 40}", f"[sound:{sound}]" if sound else ""]))
+    return rows, media_files
+
+def build(packager, notes, media_files, output_file, traced=False):
+    """Runs in a child process: (seconds, traced peak MB or None, max RSS MB)."""
+    if traced:
+        tracemalloc.start()
+    _, seconds, _ = write_package(DECK_ID, DECK_NAME, notes, media_files, output_file, "", packager)
+    peak = None
+    if traced:
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return seconds, peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def run(packager, notes, media_files, output_file, traced=False):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(build, packager, notes, media_files, output_file, traced).result()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notes", type=int, default=3000)
+    parser.add_argument("--image-kb", type=int, default=60)
+    parser.add_argument("--sounds", type=int, default=600)
+    parser.add_argument("--sound-kb", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=3, help="Builds per packager; the fastest is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        notes, media_files = seed(tmp, args.notes, args.image_kb, args.sounds, args.sound_kb)
+        media_mb = sum(os.path.getsize(path) for path in media_files) / 1e6
+        print(f"{len(notes)} notes, {len(media_files)} media files ({media_mb:.0f} MB)")
+        for packager in PACKAGERS:
+            output_file = os.path.join(tmp, f"{packager}.apkg")
+            runs = [run(packager, notes, media_files, output_file) for _ in range(args.repeat)]
+            seconds = min(r[0] for r in runs)
+            rss = max(r[2] for r in runs)
+            traced = run(packager, notes, media_files, output_file, traced=True)[1]
+            size = os.path.getsize(output_file) / 1e6
+            print(f"{packager:8s} {seconds:.3f}s, {size:.1f} MB written, peak traced {traced:.1f} MB, max RSS {rss:.0f} MB")
+
+if __name__ == "__main__":
+    main()
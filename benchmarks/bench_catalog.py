@@ -0,0 +1,93 @@
+"""
+Deck-input benchmark: the old per-image sound query + os.path.exists loop (master and
+family passes) vs loading the Catalog once and building notes from it
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from catalog import Catalog
+from generate_anki_deck import build_notes
+
+def seed(tmp, species, images_per_species, sounds_per_species, families):
+    path = os.path.join(tmp, "birds.sqlite3")
+    media = os.path.join(tmp, "media")
+    os.makedirs(media)
+    conn = db.connect(path)
+    conn.executemany("INSERT INTO species (id, hebrew_name, latin_name, family) VALUES (?, ?, ?, ?)",
+                     [(i, f"species {i}", f"Latinus {i}", f"family {i % families}") for i in range(species)])
+    images, sounds = [], []
+    for i in range(species):
+        for j in range(images_per_species):
+            images.append((i, f"https://example/{i}_{j}.jpg", os.path.join(media, f"img_{i}_{j}.jpg")))
+        for j in range(sounds_per_species):
+            sounds.append((i, f"https://example/{i}_{j}.mp3", os.path.join(media, f"sound_{i}_{j}.mp3")))
+    conn.executemany("INSERT INTO images (species_id, url, file_path) VALUES (?, ?, ?)", images)
+    conn.executemany("INSERT INTO sounds (species_id, url, file_path) VALUES (?, ?, ?)", sounds)
+    conn.commit()
+    conn.close()
+    for _, _, file_path in images + sounds:
+        open(file_path, "wb").close()
+    return path
+
+def bench_loop(path):
+    """The pre-catalog generate_anki_deck loop: every image queried and stat'ed once per deck it lands in."""
+    start = time.perf_counter()
+    queries = stats = 0
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT images.file_path, species.id, species.hebrew_name, species.latin_name, species.family
+        FROM images JOIN species ON images.species_id = species.id
+        WHERE images.file_path IS NOT NULL AND images.file_path != ''
+    """)
+    rows = cur.fetchall()
+    family_map = {}
+    for row in rows:
+        family_map.setdefault(row[4] or "UnknownFamily", []).append(row)
+    for items in [rows] + list(family_map.values()):
+        for img_path, species_id, _, _, _ in items:
+            stats += 1
+            if not os.path.exists(img_path):
+                continue
+            cur.execute("SELECT file_path FROM sounds WHERE species_id=? AND file_path IS NOT NULL AND file_path != ''", (species_id,))
+            queries += 1
+            for (sound_path,) in cur.fetchall():
+                stats += 1
+                os.path.exists(sound_path)
+    conn.close()
+    return time.perf_counter() - start, queries + 1, stats
+
+def bench_catalog(path):
+    start = time.perf_counter()
+    catalog = Catalog.load(path)
+    loaded = time.perf_counter() - start
+    build_notes(catalog.images())
+    for species in catalog.families.values():
+        build_notes(catalog.images(species))
+    return loaded, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--species", type=int, default=500)
+    parser.add_argument("--images", type=int, default=10, help="Images per species")
+    parser.add_argument("--sounds", type=int, default=5, help="Sounds per species")
+    parser.add_argument("--families", type=int, default=80)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = seed(tmp, args.species, args.images, args.sounds, args.families)
+        images = args.species * args.images
+        elapsed, queries, stats = bench_loop(path)
+        print(f"per-image loop: {images} images in {elapsed:.3f}s, {queries} queries, {stats} stat calls")
+        loaded, elapsed = bench_catalog(path)
+        print(f"catalog:        {images} images in {elapsed:.3f}s (load {loaded:.3f}s), 3 queries, 1 directory listing")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Write benchmark: per-row connect/commit from 10 threads (old path) vs the batched DBWriter
+"""
+import argparse
+import concurrent.futures
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import DBWriter
+
+def seed(path, rows):
+    conn = db.connect(path)
+    conn.executemany("INSERT INTO species (id, hebrew_name) VALUES (?, ?)", [(i, f"species {i}") for i in range(rows)])
+    conn.executemany("INSERT INTO images (species_id, url) VALUES (?, ?)", [(i, f"https://example/{i}.jpg") for i in range(rows)])
+    conn.commit()
+    conn.close()
+
+def bench_per_row(path, rows, workers=10):
+    locked = 0
+    def update(image_id):
+        nonlocal locked
+        while True:
+            try:
+                conn = sqlite3.connect(path)
+                conn.execute("UPDATE images SET file_path=? WHERE id=?", (f"media/img_{image_id}.jpg", image_id))
+                conn.commit()
+                conn.close()
+                return
+            except sqlite3.OperationalError:
+                locked += 1
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(update, range(1, rows + 1)))
+    return time.perf_counter() - start, locked
+
+def bench_writer(path, rows):
+    start = time.perf_counter()
+    with DBWriter(path) as writer:
+        for image_id in range(1, rows + 1):
+            writer.execute("UPDATE images SET file_path=? WHERE id=?", (f"media/img_{image_id}.jpg", image_id))
+    return time.perf_counter() - start, writer.stats()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        old_db, new_db = os.path.join(tmp, "old.sqlite3"), os.path.join(tmp, "new.sqlite3")
+        seed(old_db, args.rows)
+        seed(new_db, args.rows)
+        elapsed, locked = bench_per_row(old_db, args.rows)
+        print(f"per-row connect/commit (10 threads): {args.rows} rows in {elapsed:.2f}s -> {args.rows / elapsed:.0f} rows/s, {locked} lock errors")
+        elapsed, stats = bench_writer(new_db, args.rows)
+        print(f"DBWriter:                            {args.rows} rows in {elapsed:.2f}s -> {args.rows / elapsed:.0f} rows/s")
+        print(f"  {stats}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Throughput benchmark: thread-pool + requests.get (old path) vs the shared FetchEngine
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from http_engine import FetchEngine
+from benchmarks.stub_server import StubServer
+
+EXAMPLE_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "francolinus_response_example.json")
+
+def bench_thread_pool(urls, workers=10):
+    def fetch(url):
+        return requests.get(url, timeout=10).status_code
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(fetch, urls))
+    return time.perf_counter() - start, statuses.count(200)
+
+async def _bench_engine(urls):
+    async with FetchEngine() as engine:
+        results = await asyncio.gather(*(engine.get(url) for url in urls))
+        stats = engine.stats()
+    return sum(1 for r in results if r.status == 200), stats
+
+def bench_engine(urls):
+    start = time.perf_counter()
+    ok, stats = asyncio.run(_bench_engine(urls))
+    return time.perf_counter() - start, ok, stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.02, help="Server-side delay per request (seconds)")
+    args = parser.parse_args()
+
+    with open(EXAMPLE_JSON, "rb") as f:
+        payload = f.read()
+    server = StubServer(latency=args.latency, payload=payload).start()
+    urls = [f"{server.base_url}/api/species/byid/he/{i}" for i in range(args.requests)]
+
+    elapsed, ok = bench_thread_pool(urls)
+    print(f"thread pool (10 x requests.get): {ok}/{len(urls)} ok in {elapsed:.2f}s -> {len(urls) / elapsed:.0f} req/s")
+    elapsed, ok, stats = bench_engine(urls)
+    print(f"FetchEngine:                     {ok}/{len(urls)} ok in {elapsed:.2f}s -> {len(urls) / elapsed:.0f} req/s")
+    for host, host_stats in stats.items():
+        print(f"  {host}: {host_stats}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
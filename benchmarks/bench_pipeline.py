@@ -0,0 +1,247 @@
+"""
+End-to-end offline benchmark: runs each pipeline script against a local fake
+birds.org.il / image host / xeno-canto server and records per-stage wall time,
+request throughput, server-side p50/p95 latency, CPU time and peak RSS as JSON.
+
+    python benchmarks/bench_pipeline.py --species 200 --latency 0.05 --rate-429 0.02
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/pipeline-20250101-120000.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_server import SiteStubServer, percentile
+
+STAGES = ("discover", "fetch", "media", "audio", "deck")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+def peak_rss_kb():
+    """
+    Peak RSS of this process and of the worker processes it has waited for.
+    VmHWM is used for this process because ru_maxrss carries over the parent's
+    peak across fork+exec.
+    """
+    import resource
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            own, children = own // 1024, children // 1024
+    return max(own, children)
+
+def run_stage_in_process(stage, base_url, max_id, stage_args, usage_file):
+    """Child side: point the scripts at the stub server, run one stage and record its peak RSS."""
+    try:
+        _run_stage(stage, base_url, max_id, stage_args)
+    finally:
+        with open(usage_file, "w", encoding="utf-8") as f:
+            json.dump({"peak_rss_kb": peak_rss_kb()}, f)
+
+def _run_stage(stage, base_url, max_id, stage_args):
+    import discover_species_ids
+    import download_and_resize_media
+    import fetch_and_store_species
+    discover_species_ids.API_URL = fetch_and_store_species.API_URL = base_url + "/api/species/byid/he/{}"
+    download_and_resize_media.SOUND_URL = base_url + "/xc/{}/download"
+    sys.argv = [stage] + stage_args
+    if stage == "discover":
+        # The real site's last observed ID is a hint near the top; the stub's is its highest ID
+        sys.argv += ["--hint", str(max_id)]
+        discover_species_ids.main()
+    elif stage == "fetch":
+        fetch_and_store_species.main()
+    elif stage == "media":
+        download_and_resize_media.main()
+    elif stage == "audio":
+        import process_audio
+        process_audio.main()
+    elif stage == "deck":
+        import generate_anki_deck
+        generate_anki_deck.main()
+
+def stage_outputs(workdir, stage):
+    """What a stage produced, for items/s."""
+    db_path = os.path.join(workdir, "birds.sqlite3")
+    if stage == "discover":
+        with open(os.path.join(workdir, "valid_species_ids.txt"), encoding="utf-8") as f:
+            return {"valid_ids": sum(1 for line in f if line.strip())}
+    if stage == "deck":
+        decks = [os.path.join(workdir, "Birds_of_Israel.apkg")]
+        decks_dir = os.path.join(workdir, "decks")
+        if os.path.isdir(decks_dir):
+            decks += [os.path.join(decks_dir, name) for name in os.listdir(decks_dir) if name.endswith(".apkg")]
+        decks = [path for path in decks if os.path.exists(path)]
+        return {"decks": len(decks), "apkg_mb": round(sum(map(os.path.getsize, decks)) / 1e6, 2)}
+    conn = sqlite3.connect(db_path)
+    try:
+        if stage == "fetch":
+            return {"species": conn.execute("SELECT COUNT(*) FROM species").fetchone()[0],
+                    "media_rows": conn.execute("SELECT (SELECT COUNT(*) FROM images) + (SELECT COUNT(*) FROM sounds)").fetchone()[0]}
+        if stage == "media":
+            return {"media_done": conn.execute("SELECT COUNT(*) FROM media_tasks WHERE state = 'done'").fetchone()[0],
+                    "media_failed": conn.execute("SELECT COUNT(*) FROM media_tasks WHERE state = 'failed'").fetchone()[0]}
+        return {"sounds_kept": conn.execute("SELECT COUNT(*) FROM sounds WHERE selected = 1").fetchone()[0]}
+    finally:
+        conn.close()
+
+def summarize_requests(metrics, wall):
+    def summary(rows):
+        latencies = [seconds for _, _, _, seconds in rows]
+        by_status = {}
+        for _, status, _, _ in rows:
+            by_status[str(status)] = by_status.get(str(status), 0) + 1
+        size = sum(size for _, _, size, _ in rows)
+        return {
+            "requests": len(rows),
+            "by_status": by_status,
+            "mb": round(size / 1e6, 2),
+            "req_per_s": round(len(rows) / wall, 1) if wall else 0.0,
+            "mb_per_s": round(size / 1e6 / wall, 2) if wall else 0.0,
+            "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1) if rows else None,
+            "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1) if rows else None,
+        }
+    result = summary(metrics)
+    kinds = sorted({kind for kind, _, _, _ in metrics})
+    result["by_kind"] = {kind: summary([row for row in metrics if row[0] == kind]) for kind in kinds}
+    return result
+
+def run_stage(stage, server, workdir, max_id, stage_args):
+    """Parent side: run a stage in a child process and collect its resource usage and the server's request log."""
+    server.take_metrics()
+    log_path = os.path.join(workdir, f"{stage}.log")
+    usage_file = os.path.join(workdir, f"{stage}.usage.json")
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--base-url", server.base_url,
+           "--species", str(max_id), "--usage-file", usage_file, "--"] + stage_args
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 reports the child's CPU time, including worker processes it waited for
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    try:
+        with open(usage_file, encoding="utf-8") as f:
+            rss_mb = json.load(f)["peak_rss_kb"] / 1024
+    except (OSError, ValueError):
+        rss_mb = None
+    result = {
+        "stage": stage,
+        "exit_code": proc.returncode,
+        "wall_s": round(wall, 3),
+        "cpu_user_s": round(usage.ru_utime, 3),
+        "cpu_sys_s": round(usage.ru_stime, 3),
+        "peak_rss_mb": round(rss_mb, 1) if rss_mb is not None else None,
+        "http": summarize_requests(server.take_metrics(), wall),
+        "log": log_path,
+    }
+    if proc.returncode == 0:
+        result["outputs"] = stage_outputs(workdir, stage)
+        first = next(iter(result["outputs"].values()))
+        result["items_per_s"] = round(first / wall, 1) if wall else 0.0
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(stage["pass"], stage["stage"]): stage for stage in json.load(f)["stages"]}
+    print(f"\nCompared with {baseline_path}:")
+    for stage in current["stages"]:
+        old = baseline.get((stage["pass"], stage["stage"]))
+        if old is None:
+            continue
+        changes = []
+        for key in ("wall_s", "cpu_user_s", "peak_rss_mb"):
+            if old.get(key) and stage.get(key) is not None:
+                changes.append(f"{key} {old[key]} -> {stage[key]} ({stage[key] / old[key]:.2f}x)")
+        print(f"  {stage['pass']:<5} {stage['stage']:<8} " + ", ".join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline benchmark")
+    parser.add_argument("--species", type=int, default=100, help="Highest species ID served")
+    parser.add_argument("--invalid-density", type=float, default=0.3, help="Fraction of IDs that are invalid")
+    parser.add_argument("--images", type=int, default=3, help="Images per species")
+    parser.add_argument("--sounds", type=int, default=3, help="Sounds per species")
+    parser.add_argument("--families", type=int, default=10, help="Number of bird families")
+    parser.add_argument("--image-size", default="1600x1067", help="WIDTHxHEIGHT of served photos")
+    parser.add_argument("--image-format", choices=("JPEG", "PNG"), default="JPEG")
+    parser.add_argument("--sound-seconds", type=float, default=60, help="Length of served recordings")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mean per-request latency in seconds")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0, help="Per-response bandwidth cap in MB/s (0: unlimited)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run, in order")
+    parser.add_argument("--rerun", action="store_true", help="Run the stages a second time (incremental/no-op cost)")
+    parser.add_argument("--workdir", help="Keep the working directory here instead of a temp dir")
+    parser.add_argument("--output", help="JSON results file (default: benchmarks/results/pipeline-<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--usage-file", help=argparse.SUPPRESS)
+    parser.add_argument("stage_args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage_in_process(args.run_stage, args.base_url, args.species, args.stage_args, args.usage_file)
+        return
+
+    width, height = (int(n) for n in args.image_size.split("x"))
+    config = {key: value for key, value in vars(args).items() if key not in ("run_stage", "base_url", "stage_args", "output", "compare")}
+    server = SiteStubServer(max_id=args.species, invalid_density=args.invalid_density, images_per_species=args.images,
+                            sounds_per_species=args.sounds, families=args.families, image_size=(width, height), image_format=args.image_format,
+                            sound_seconds=args.sound_seconds, latency=args.latency,
+                            bandwidth=int(args.bandwidth_mbps * 1e6), rate_429=args.rate_429).start()
+    stages = [stage.strip() for stage in args.stages.split(",")]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-pipeline-")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    passes = ["first", "rerun"] if args.rerun else ["first"]
+    for run in passes:
+        for stage in stages:
+            result = run_stage(stage, server, workdir, args.species, [])
+            result["pass"] = run
+            results.append(result)
+            http = result["http"]
+            print(f"{run:<5} {stage:<8} wall {result['wall_s']:7.2f}s  cpu {result['cpu_user_s'] + result['cpu_sys_s']:7.2f}s  "
+                  f"rss {result['peak_rss_mb']} MB  {http['requests']:5} req  {http['mb_per_s']:6.2f} MB/s  "
+                  f"p50 {http['latency_p50_ms']} ms  p95 {http['latency_p95_ms']} ms  {result.get('outputs', 'FAILED, see ' + result['log'])}")
+            if result["exit_code"] != 0:
+                break
+    server.shutdown()
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "env": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": config,
+        "workdir": workdir,
+        "total_wall_s": round(sum(result["wall_s"] for result in results), 3),
+        "stages": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Total {report['total_wall_s']:.2f}s; results written to {output}")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Local stub HTTP servers for offline benchmarks
+"""
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is measurable
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.server.payload
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, payload=b"{}", port=0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.payload = payload
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# --- Fake birds.org.il API + image host + xeno-canto, for whole-pipeline benchmarks ---
+
+EXAMPLE_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "francolinus_response_example.json")
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"  # MPEG-1 layer III, 128 kbps, 44.1 kHz
+MP3_FRAME_BYTES = 417
+MP3_FRAMES_PER_SEC = 44100 / 1152
+WRITE_CHUNK = 64 * 1024
+PHOTO_POOL = 8  # distinct generated scenes served round-robin
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def synthetic_photo(seed, size):
+    """Pixels of a noisy, smoothly varying photo stand-in that compresses about like a real one."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    coarse = rng.integers(0, 256, (max(2, height // 40), max(2, width // 40), 3), dtype=np.uint8)
+    img = np.asarray(Image.fromarray(coarse).resize(size, Image.Resampling.BICUBIC)).astype(np.int16)
+    img += rng.integers(-10, 10, img.shape, dtype=np.int16)
+    return img.clip(0, 255).astype(np.uint8)
+
+def encode_photo(pixels, fmt):
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, fmt, quality=90)
+    return buf.getvalue()
+
+def synthetic_mp3(seconds, tag):
+    """Valid MP3 frames (random payload) behind an ID3 tag carrying `tag`, so every recording hashes differently."""
+    frames = int(seconds * MP3_FRAMES_PER_SEC)
+    payload = np.random.default_rng(0).integers(0, 256, MP3_FRAME_BYTES - 4, dtype=np.uint8).tobytes()
+    text = tag.encode()
+    frame = b"TIT2" + (len(text) + 1).to_bytes(4, "big") + b"\x00\x00\x00" + text
+    id3 = b"ID3\x03\x00\x00" + bytes([(len(frame) >> shift) & 0x7F for shift in (21, 14, 7, 0)]) + frame
+    return id3 + (MP3_FRAME_HEADER + payload) * frames
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        start = time.perf_counter()
+        server = self.server
+        status, body, content_type, kind = 404, b"", "text/plain", "other"
+        extra = {}
+        if server.latency:
+            time.sleep(server.latency * server.rng().uniform(0.5, 1.5))
+        if server.rate_429 and server.rng().random() < server.rate_429:
+            status, kind, extra = 429, "throttled", {"Retry-After": str(server.retry_after)}
+        else:
+            match = re.fullmatch(r"/api/species/byid/he/(\d+)", self.path)
+            if match:
+                kind = "api"
+                body = server.species_json(int(match.group(1)))
+                status, content_type = (200, "application/json") if body else (404, "text/plain")
+            elif match := re.fullmatch(r"/img/(\d+)_(\d+)\.(jpg|png)", self.path):
+                kind = "image"
+                status, content_type = 200, "image/jpeg" if match.group(3) == "jpg" else "image/png"
+                body = server.image(int(match.group(1)), int(match.group(2)))
+            elif match := re.fullmatch(r"/xc/(\d+)/download", self.path):
+                kind = "sound"
+                status, content_type = 200, "audio/mpeg"
+                body = server.sound(match.group(1))
+        sent = self.reply(status, body, content_type, extra)
+        server.record(kind, status, sent, time.perf_counter() - start)
+
+    def reply(self, status, body, content_type, extra):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        elif status == 200 and (match := re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))):
+            offset = int(match.group(1))
+            extra = dict(extra, **{"Content-Range": f"bytes {offset}-{len(body) - 1}/{len(body)}"})
+            status, body = 206, body[offset:]
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status in (200, 206, 304):
+            self.send_header("ETag", etag)
+        for name, value in extra.items():
+            self.send_header(name, value)
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        for offset in range(0, len(body), WRITE_CHUNK):
+            chunk = body[offset:offset + WRITE_CHUNK]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+        return len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class SiteStubServer(http.server.ThreadingHTTPServer):
+    """
+    Serves synthetic species JSON (modelled on francolinus_response_example.json)
+    for IDs 1..max_id, generated photos under /img/ and MP3s under /xc/<id>/download.
+    latency (s, +-50% jitter), bandwidth (bytes/s per response) and rate_429
+    (fraction of requests answered 429 with Retry-After) are injectable. Every
+    request is recorded; take_metrics() returns and clears them.
+    """
+    daemon_threads = True
+
+    def __init__(self, max_id=200, invalid_density=0.3, images_per_species=3, sounds_per_species=3, families=20,
+                 image_size=(1600, 1067), image_format="JPEG", sound_seconds=60, latency=0.0, bandwidth=0,
+                 rate_429=0.0, retry_after=1, seed=0, port=0):
+        super().__init__(("127.0.0.1", port), SiteHandler)
+        self.max_id = max_id
+        self.invalid_density = invalid_density
+        self.images_per_species = images_per_species
+        self.sounds_per_species = sounds_per_species
+        self.families = families
+        self.image_size = image_size
+        self.image_format = image_format
+        self.sound_seconds = sound_seconds
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.seed = seed
+        with open(EXAMPLE_JSON, encoding="utf-8") as f:
+            self.example = json.load(f)
+        self._photos = []
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._local = threading.local()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        # Generate the scenes up front so it doesn't show up as request latency
+        self._photos = [synthetic_photo(seed, self.image_size) for seed in range(PHOTO_POOL)]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def rng(self):
+        if not hasattr(self._local, "rng"):
+            self._local.rng = random.Random(f"{self.seed}-{threading.get_ident()}")
+        return self._local.rng
+
+    def is_valid(self, species_id):
+        return 1 <= species_id <= self.max_id and random.Random(f"{self.seed}-{species_id}").random() >= self.invalid_density
+
+    def species_json(self, species_id):
+        if not self.is_valid(species_id):
+            return b""
+        ext = "jpg" if self.image_format == "JPEG" else "png"
+        data = dict(self.example)
+        data.update({
+            "id": species_id,
+            "name": f"ציפור {species_id}",
+            "latinName": f"Avis synthetica {species_id}",
+            "speciesFamilyName": f"משפחה {species_id % self.families}",
+            "images": [{"type": 2, "path": f"{self.base_url}/img/{species_id}_{k}.{ext}"} for k in range(self.images_per_species)],
+            "largeImage": [{"type": 2, "path": f"{self.base_url}/img/{species_id}_0.{ext}"}],
+            "sounds": [{"type": 3, "path": str(species_id * 100 + k)} for k in range(self.sounds_per_species)],
+            "relatedSpecies": [{"id": i, "name": f"ציפור {i}"} for i in self.related(species_id)],
+            "moreFromFamily": [{"id": i, "name": f"ציפור {i}"} for i in self.family_members(species_id)],
+        })
+        return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    def related(self, species_id, count=3):
+        """The nearest valid IDs on either side, like look-alike species listed next to each other."""
+        near = sorted(range(max(1, species_id - 10), species_id + 11), key=lambda i: abs(i - species_id))
+        return [i for i in near if i != species_id and self.is_valid(i)][:count]
+
+    def family_members(self, species_id, count=6):
+        """Nearest valid IDs of the same family (species_id % families)."""
+        near = sorted(range(species_id % self.families or self.families, self.max_id + 1, self.families),
+                      key=lambda i: abs(i - species_id))
+        return [i for i in near if i != species_id and self.is_valid(i)][:count]
+
+    def image(self, species_id, index):
+        # A shared pool of generated scenes keeps the cost bounded; a per-species tint makes
+        # every URL's pixels (and so its stored thumbnail) unique
+        pixels = self._photos[(species_id * self.images_per_species + index) % PHOTO_POOL].copy()
+        pixels[..., species_id % 3] += np.uint8(species_id % 251 + 1)
+        return encode_photo(pixels, self.image_format)
+
+    def sound(self, sound_id):
+        return synthetic_mp3(self.sound_seconds, sound_id)
+
+    def record(self, kind, status, size, seconds):
+        with self._lock:
+            self._metrics.append((kind, status, size, seconds))
+
+    def take_metrics(self):
+        with self._lock:
+            metrics, self._metrics = self._metrics, []
+        return metrics
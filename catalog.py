@@ -0,0 +1,142 @@
+"""
+In-memory species catalog for deck generation.
+
+Loads species, images and sounds with one query per table and checks which
+media files exist with one directory listing per media folder, so building any
+number of decks costs no further queries or stat calls.
+"""
+import os
+
+import db
+import metrics
+
+UNKNOWN_FAMILY = "UnknownFamily"
+
+
+class Species:
+    __slots__ = ("id", "hebrew_name", "latin_name", "family", "description", "conservation", "images", "sound_paths")
+
+    def __init__(self, id, hebrew_name, latin_name, family, description, conservation):
+        self.id = id
+        self.hebrew_name = hebrew_name
+        self.latin_name = latin_name
+        self.family = family
+        self.description = description
+        self.conservation = conservation
+        self.images = []  # Image objects for distinct, present, non-duplicate photos
+        self.sound_paths = []  # present sound files (trimmed clips once the audio stage has run)
+
+
+class Image:
+    __slots__ = ("id", "species", "file_path", "content_hash", "quality", "url")
+
+    def __init__(self, id, species, file_path, content_hash, quality=None, url=None):
+        self.id = id
+        self.species = species
+        self.file_path = file_path
+        self.content_hash = content_hash
+        self.quality = quality  # 0..1 from image_quality, None if not scored yet
+        self.url = url  # source URL the photo was downloaded from
+
+
+def scan_existing(paths):
+    """
+    Return the subset of paths that exist, listing each parent directory once
+    instead of calling stat per file.
+    """
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+    existing = set()
+    for directory, dir_paths in by_dir.items():
+        try:
+            with os.scandir(directory or ".") as entries:
+                names = {entry.name for entry in entries if not entry.is_dir()}
+        except FileNotFoundError:
+            continue
+        existing.update(path for path in dir_paths if os.path.basename(path) in names)
+    return existing
+
+
+class Catalog:
+    """
+    Species indexed by id and by family, each carrying its photos and sounds:
+
+        catalog = Catalog.load()
+        for family, species in catalog.families.items():
+            ...
+    """
+
+    def __init__(self):
+        self.species = {}  # id -> Species, in id order
+        self.families = {}  # family (or UNKNOWN_FAMILY) -> [Species]
+        self.missing = []  # referenced media files that aren't on disk
+
+    @classmethod
+    def load(cls, path=db.DB_FILE, variants=()):
+        """
+        Load the catalog. With variants, each photo's file is the first of those
+        image variants (see image_variants) that exists for it, falling back to
+        the primary image.
+        """
+        with metrics.timer("catalog_load_seconds"):
+            return cls._load(path, tuple(variants))
+
+    @classmethod
+    def _load(cls, path, variants):
+        catalog = cls()
+        conn = db.connect(path)
+        try:
+            species_rows = conn.execute(
+                "SELECT id, hebrew_name, latin_name, family, description, conservation FROM species ORDER BY id").fetchall()
+            joins = "".join(f" LEFT JOIN image_variants v{k} ON v{k}.image_id = i.id AND v{k}.variant = ?"
+                            for k in range(len(variants)))
+            file_path = "COALESCE(" + "".join(f"v{k}.file_path, " for k in range(len(variants))) + "i.file_path)" if variants else "i.file_path"
+            image_rows = conn.execute(f"""
+                SELECT i.id, i.species_id, {file_path}, i.content_hash, i.quality, i.url FROM images i{joins}
+                WHERE i.file_path IS NOT NULL AND i.file_path != '' AND i.duplicate_of IS NULL
+                ORDER BY i.id
+            """, variants).fetchall()
+            sound_rows = conn.execute("""
+                SELECT species_id, COALESCE(clip_path, file_path) FROM sounds
+                WHERE file_path IS NOT NULL AND file_path != '' AND (selected IS NULL OR selected = 1)
+                ORDER BY id
+            """).fetchall()
+        finally:
+            conn.close()
+
+        existing = scan_existing({row[2] for row in image_rows} | {row[1] for row in sound_rows})
+        for row in species_rows:
+            species = Species(*row)
+            catalog.species[species.id] = species
+            catalog.families.setdefault(species.family or UNKNOWN_FAMILY, []).append(species)
+
+        # One card per distinct photo: rows whose file is stored by content hash share a path
+        seen_paths = set()
+        for image_id, species_id, file_path, content_hash, quality, url in image_rows:
+            species = catalog.species.get(species_id)
+            if species is None or file_path in seen_paths:
+                continue
+            seen_paths.add(file_path)
+            if file_path not in existing:
+                catalog.missing.append(file_path)
+                continue
+            species.images.append(Image(image_id, species, file_path, content_hash, quality, url))
+        for species_id, file_path in sound_rows:
+            species = catalog.species.get(species_id)
+            if species is not None and file_path in existing:
+                species.sound_paths.append(file_path)
+        return catalog
+
+    def keep_best_images(self, limit):
+        """Trim each species to its limit highest-quality photos (unscored ones rank last), kept in id order."""
+        for species in self.species.values():
+            if len(species.images) > limit:
+                ranked = sorted(species.images, key=lambda image: -image.quality if image.quality is not None else 1.0)
+                best = set(ranked[:limit])
+                species.images = [image for image in species.images if image in best]
+
+    def images(self, species=None):
+        """Photos of the given species (default: all), in species then image order."""
+        for sp in (self.species.values() if species is None else species):
+            yield from sp.images
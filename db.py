@@ -0,0 +1,440 @@
+"""
+SQLite schema, migrations and the single batched writer shared by all pipeline steps
+"""
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+DB_FILE = "birds.sqlite3"
+BUSY_TIMEOUT_MS = 5000
+BATCH_SIZE = 500  # statements per transaction
+FLUSH_INTERVAL = 0.2  # seconds a partial batch may wait before it is committed
+QUEUE_SIZE = 10000
+
+CREATE_SPECIES_TABLE = """
+CREATE TABLE IF NOT EXISTS species (
+    id INTEGER PRIMARY KEY,
+    hebrew_name TEXT,
+    latin_name TEXT,
+    family TEXT,
+    description TEXT,
+    conservation TEXT
+);
+"""
+CREATE_IMAGES_TABLE = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    species_id INTEGER,
+    url TEXT,
+    file_path TEXT,
+    FOREIGN KEY(species_id) REFERENCES species(id)
+);
+"""
+CREATE_SOUNDS_TABLE = """
+CREATE TABLE IF NOT EXISTS sounds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    species_id INTEGER,
+    url TEXT,
+    file_path TEXT,
+    FOREIGN KEY(species_id) REFERENCES species(id)
+);
+"""
+# HTTP validators and source content hash per media URL, for incremental refreshes
+CREATE_MEDIA_VALIDATORS_TABLE = """
+CREATE TABLE IF NOT EXISTS media_validators (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    checked_at REAL
+);
+"""
+
+# One row per image/sound download: what state it is in and what it produced
+CREATE_MEDIA_TASKS_TABLE = """
+CREATE TABLE IF NOT EXISTS media_tasks (
+    kind TEXT,
+    media_id INTEGER,
+    url TEXT,
+    file_path TEXT,
+    state TEXT,
+    bytes INTEGER,
+    sha256 TEXT,
+    attempts INTEGER DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL,
+    PRIMARY KEY(kind, media_id)
+);
+"""
+
+# MP3 stream facts per source file, and the trimmed clips cut from them per clip setting
+CREATE_AUDIO_SOURCES_TABLE = """
+CREATE TABLE IF NOT EXISTS audio_sources (
+    content_hash TEXT PRIMARY KEY,
+    duration REAL,
+    bitrate INTEGER,
+    error TEXT
+);
+"""
+CREATE_AUDIO_CLIPS_TABLE = """
+CREATE TABLE IF NOT EXISTS audio_clips (
+    source_hash TEXT,
+    settings TEXT,
+    clip_path TEXT,
+    clip_bytes INTEGER,
+    clip_seconds REAL,
+    PRIMARY KEY(source_hash, settings)
+);
+"""
+
+# Extra sizes/formats of each image, written from the same decode as images.file_path
+CREATE_IMAGE_VARIANTS_TABLE = """
+CREATE TABLE IF NOT EXISTS image_variants (
+    image_id INTEGER,
+    variant TEXT,
+    file_path TEXT,
+    width INTEGER,
+    height INTEGER,
+    bytes INTEGER,
+    PRIMARY KEY(image_id, variant)
+);
+"""
+
+# Size-targeted re-encodings of a source image, per optimizer setting (see optimize_images)
+CREATE_IMAGE_ENCODINGS_TABLE = """
+CREATE TABLE IF NOT EXISTS image_encodings (
+    source_hash TEXT,
+    settings TEXT,
+    file_path TEXT,
+    format TEXT,
+    quality INTEGER,
+    bytes INTEGER,
+    ssim REAL,
+    PRIMARY KEY(source_hash, settings)
+);
+"""
+
+# Full-text index over species names and descriptions for deck specs. External
+# content: the text stays in species and triggers keep the index in step.
+CREATE_SPECIES_FTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS species_fts USING fts5(
+    hebrew_name, latin_name, description,
+    content='species', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+"""
+SPECIES_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS species_fts_insert AFTER INSERT ON species BEGIN
+        INSERT INTO species_fts (rowid, hebrew_name, latin_name, description)
+        VALUES (new.id, new.hebrew_name, new.latin_name, new.description);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS species_fts_delete AFTER DELETE ON species BEGIN
+        INSERT INTO species_fts (species_fts, rowid, hebrew_name, latin_name, description)
+        VALUES ('delete', old.id, old.hebrew_name, old.latin_name, old.description);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS species_fts_update AFTER UPDATE ON species BEGIN
+        INSERT INTO species_fts (species_fts, rowid, hebrew_name, latin_name, description)
+        VALUES ('delete', old.id, old.hebrew_name, old.latin_name, old.description);
+        INSERT INTO species_fts (rowid, hebrew_name, latin_name, description)
+        VALUES (new.id, new.hebrew_name, new.latin_name, new.description);
+    END;
+    """,
+]
+
+def _dedupe_media(table):
+    # Keep one row per (species_id, url), preferring one that already has a downloaded file
+    return f"""
+    DELETE FROM {table} WHERE id NOT IN (
+        SELECT COALESCE(MIN(CASE WHEN file_path IS NOT NULL THEN id END), MIN(id))
+        FROM {table} GROUP BY species_id, url
+    );
+    """
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+# Append new migrations; never edit one that has shipped.
+MIGRATIONS = [
+    # 1: original tables
+    [CREATE_SPECIES_TABLE, CREATE_IMAGES_TABLE, CREATE_SOUNDS_TABLE, CREATE_MEDIA_VALIDATORS_TABLE],
+    # 2: drop duplicate media rows from earlier reruns, then make (species_id, url) unique.
+    # The unique index also serves every species_id lookup, so no separate index is needed.
+    [
+        _dedupe_media("images"),
+        _dedupe_media("sounds"),
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_images_species_url ON images(species_id, url);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_sounds_species_url ON sounds(species_id, url);",
+    ],
+    # 3: media task ledger
+    [
+        CREATE_MEDIA_TASKS_TABLE,
+        "CREATE INDEX IF NOT EXISTS idx_media_tasks_state ON media_tasks(state);",
+    ],
+    # 4: content-addressed store (sha256 of the stored file) and perceptual duplicate index
+    [
+        "ALTER TABLE images ADD COLUMN content_hash TEXT;",
+        "ALTER TABLE images ADD COLUMN dhash INTEGER;",
+        "ALTER TABLE images ADD COLUMN duplicate_of INTEGER;",
+        "ALTER TABLE sounds ADD COLUMN content_hash TEXT;",
+    ],
+    # 5: audio budget; sounds.selected is NULL until the audio stage has run, then 0/1
+    [
+        CREATE_AUDIO_SOURCES_TABLE,
+        CREATE_AUDIO_CLIPS_TABLE,
+        "ALTER TABLE sounds ADD COLUMN clip_path TEXT;",
+        "ALTER TABLE sounds ADD COLUMN selected INTEGER;",
+    ],
+    # 6: image size/format variants
+    [
+        CREATE_IMAGE_VARIANTS_TABLE,
+        "CREATE INDEX IF NOT EXISTS idx_image_variants_variant ON image_variants(variant);",
+    ],
+    # 7: cache of the image optimizer's searches
+    [CREATE_IMAGE_ENCODINGS_TABLE],
+    # 8: deck spec queries: species filters and full-text search
+    [
+        "CREATE INDEX IF NOT EXISTS idx_species_family ON species(family);",
+        "CREATE INDEX IF NOT EXISTS idx_species_conservation ON species(conservation);",
+        CREATE_SPECIES_FTS_TABLE,
+        *SPECIES_FTS_TRIGGERS,
+        "INSERT INTO species_fts (species_fts) VALUES ('rebuild');",
+    ],
+    # 9: photo quality scores (see image_quality); NULL until scored
+    [
+        "ALTER TABLE images ADD COLUMN sharpness REAL;",
+        "ALTER TABLE images ADD COLUMN exposure REAL;",
+        "ALTER TABLE images ADD COLUMN contrast REAL;",
+        "ALTER TABLE images ADD COLUMN resolution INTEGER;",
+        "ALTER TABLE images ADD COLUMN quality REAL;",
+    ],
+]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version={number}")
+    return conn
+
+def connect(path=DB_FILE):
+    """Open the database in WAL mode with the schema migrated to the latest version."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return migrate(conn)
+
+
+class DBWriter(threading.Thread):
+    """
+    The only thread that writes to the database. Producers enqueue statements
+    with execute() (fire and forget) or submit() (runs a function on the writer
+    connection and returns a Future). Consecutive statements with the same SQL
+    are grouped into one executemany, and every batch is a single transaction.
+    A batch that fails is rolled back as a whole and its error raised by the
+    futures and flush() waiting on it; the writer carries on with the next one.
+
+        with DBWriter() as writer:
+            writer.execute("UPDATE images SET file_path=? WHERE id=?", (path, image_id))
+    """
+
+    def __init__(self, path=DB_FILE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        super().__init__(name="db-writer", daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.rows = 0
+        self.transactions = 0
+        self.lock_retries = 0
+        self.errors = 0
+        self.lock_wait = 0.0
+        self.write_time = 0.0
+        self.max_queue_depth = 0
+        self._started_at = None
+        self._finished_at = None
+        self._ready = threading.Event()
+        self._error = None
+        self._unreported = None  # a rolled-back batch nobody was waiting on, raised by the next flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def execute(self, sql, params=()):
+        self._put(("sql", sql, params))
+
+    def submit(self, fn):
+        """Run fn(conn) on the writer thread inside its current transaction."""
+        future = concurrent.futures.Future()
+        self._put(("call", fn, future))
+        return future
+
+    def flush(self):
+        """
+        Block until everything queued so far is committed. Raises the error of
+        a batch that was rolled back since the last flush.
+        """
+        future = concurrent.futures.Future()
+        self._put(("flush", None, future))
+        future.result()
+
+    def close(self):
+        self._put(None)
+        self.join()
+
+    def _put(self, item):
+        self.queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def run(self):
+        try:
+            conn = connect(self.path)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._started_at = time.perf_counter()
+        self._ready.set()
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and batch[-1][0] != "flush" and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            self._write_batch(conn, [item for item in batch if item is not None])
+        conn.close()
+        self._finished_at = time.perf_counter()
+
+    def _write_batch(self, conn, batch):
+        """
+        Write one batch as a single transaction. If any statement, the BEGIN or
+        the commit fails, the whole batch is rolled back and the error goes to
+        every future and flush waiting on it (or, with none in the batch, to the
+        next flush); the writer keeps running either way.
+        """
+        if not batch:
+            return
+        start = time.perf_counter()
+        calls, waiters = [], []
+        try:
+            with conn:
+                self._begin(conn)
+                self._apply(conn, batch, calls, waiters)
+        except Exception as e:
+            self.errors += 1
+            metrics.inc("db_errors_total")
+            metrics.echo(f"DB batch of {len(batch)} writes rolled back: {e}")
+            if conn.in_transaction:
+                # A failed commit leaves the transaction open
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            for future, _, _ in calls:
+                future.set_exception(e)
+            if waiters:
+                for future in waiters:
+                    future.set_exception(e)
+            else:
+                self._unreported = e
+            return
+        self.transactions += 1
+        elapsed = time.perf_counter() - start
+        self.write_time += elapsed
+        metrics.observe("db_batch_seconds", elapsed)
+        # Results are only handed out once the transaction they were written in has committed
+        for future, result, error in calls:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        error, self._unreported = (self._unreported, None) if waiters else (None, self._unreported)
+        for future in waiters:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _apply(self, conn, batch, calls, waiters):
+        pending_sql, pending_params = None, []
+        for kind, target, arg in batch + [("end", None, None)]:
+            if kind == "sql" and target == pending_sql:
+                pending_params.append(arg)
+                continue
+            if pending_sql is not None:
+                try:
+                    conn.executemany(pending_sql, pending_params)
+                except sqlite3.Error as e:
+                    metrics.echo(f"DB write failed ({e}): {pending_sql.strip()}")
+                    raise
+                self.rows += len(pending_params)
+                metrics.inc("db_rows_total", len(pending_params))
+                pending_sql, pending_params = None, []
+            if kind == "sql":
+                pending_sql, pending_params = target, [arg]
+            elif kind == "call":
+                # The caller may have given up on it (e.g. a cancelled asyncio task)
+                if not arg.set_running_or_notify_cancel():
+                    continue
+                # A failing function only undoes its own writes; the rest of the batch commits
+                conn.execute("SAVEPOINT call")
+                try:
+                    calls.append((arg, target(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO call")
+                    calls.append((arg, None, e))
+                conn.execute("RELEASE call")
+            elif kind == "flush":
+                waiters.append(arg)
+
+    def _begin(self, conn):
+        # Take the write lock up front so a busy database shows up as lock wait, not a failed batch
+        while True:
+            start = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                self.lock_retries += 1
+            finally:
+                waited = time.perf_counter() - start
+                self.lock_wait += waited
+                metrics.inc("db_lock_wait_seconds_total", waited)
+
+    def stats(self):
+        end = self._finished_at or time.perf_counter()
+        elapsed = end - self._started_at if self._started_at else 0.0
+        return {
+            "rows": self.rows,
+            "transactions": self.transactions,
+            "rows_per_sec": round(self.rows / elapsed, 1) if elapsed else 0.0,
+            "write_time_s": round(self.write_time, 3),
+            "lock_wait_s": round(self.lock_wait, 3),
+            "lock_retries": self.lock_retries,
+            "errors": self.errors,
+            "max_queue_depth": self.max_queue_depth,
+        }
@@ -0,0 +1,157 @@
+"""
+Deck specs: named decks defined by filters over the species table.
+
+A spec file is JSON with a list of decks:
+
+    {"decks": [
+        {"name": "Endangered species", "conservation": ["CR", "EN", "VU"]},
+        {"name": "Raptors and owls", "family": ["נציים", "בזיים", "תנשמתיים", "ינשופיים"]},
+        {"name": "Herons", "search": "hebrew_name: אנפה*"},
+        {"name": "Favourites", "species": [12, 57, 301], "file": "favourites.apkg"}
+    ]}
+
+A deck holds the species that match all of its filters; a list filter matches
+any of its values. "search" is an FTS5 query over hebrew_name, latin_name and
+description. "file" names the output (default: from the deck name) and
+"min_images" (default 1) skips decks with fewer photos.
+"""
+import argparse
+import json
+import sqlite3
+import time
+
+import db
+
+FILTER_KEYS = ("family", "conservation", "search", "species")
+SPEC_KEYS = ("name", "file", "min_images") + FILTER_KEYS
+
+
+class DeckSpec:
+    __slots__ = ("name", "file", "min_images", "family", "conservation", "search", "species")
+
+    def __init__(self, name, file=None, min_images=1, family=None, conservation=None, search=None, species=None):
+        self.name = name
+        self.file = file
+        self.min_images = min_images
+        self.family = family
+        self.conservation = conservation
+        self.search = search
+        self.species = species
+
+
+def _string_list(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value and all(isinstance(v, str) for v in value):
+        return value
+    return None
+
+
+def parse_spec(entry):
+    """A DeckSpec from one entry of a spec file; raises ValueError describing what's wrong."""
+    if not isinstance(entry, dict):
+        raise ValueError("must be an object")
+    unknown = set(entry) - set(SPEC_KEYS)
+    if unknown:
+        raise ValueError(f"unknown keys {', '.join(sorted(unknown))}")
+    name = entry.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("needs a name")
+    spec = DeckSpec(name.strip(), entry.get("file"), entry.get("min_images", 1))
+    if spec.file is not None and not isinstance(spec.file, str):
+        raise ValueError("file must be a string")
+    if not isinstance(spec.min_images, int) or spec.min_images < 1:
+        raise ValueError("min_images must be a positive integer")
+    for key in ("family", "conservation"):
+        if key in entry:
+            values = _string_list(entry[key])
+            if values is None:
+                raise ValueError(f"{key} must be a string or a non-empty list of strings")
+            setattr(spec, key, values)
+    if "search" in entry:
+        if not isinstance(entry["search"], str) or not entry["search"].strip():
+            raise ValueError("search must be a non-empty FTS5 query")
+        spec.search = entry["search"]
+    if "species" in entry:
+        ids = entry["species"]
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) for i in ids):
+            raise ValueError("species must be a non-empty list of species ids")
+        spec.species = ids
+    if not any(getattr(spec, key) is not None for key in FILTER_KEYS):
+        raise ValueError(f"needs at least one of {', '.join(FILTER_KEYS)}")
+    return spec
+
+
+def load_specs(path):
+    """The DeckSpecs of a spec file, in file order. Raises ValueError for an invalid file."""
+    with open(path, encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: not valid JSON: {e}") from None
+    entries = data.get("decks") if isinstance(data, dict) else data
+    if not isinstance(entries, list):
+        raise ValueError(f'{path}: expected {{"decks": [...]}}')
+    specs, names = [], set()
+    for i, entry in enumerate(entries, start=1):
+        try:
+            spec = parse_spec(entry)
+        except ValueError as e:
+            raise ValueError(f"{path}: deck {i}: {e}") from None
+        if spec.name in names:
+            raise ValueError(f"{path}: deck {i}: duplicate name '{spec.name}'")
+        names.add(spec.name)
+        specs.append(spec)
+    return specs
+
+
+def species_query(spec):
+    """(sql, params) selecting the ids of the species a spec matches, in id order."""
+    clauses, params = [], []
+    for column in ("family", "conservation"):
+        values = getattr(spec, column)
+        if values is not None:
+            clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+    if spec.species is not None:
+        clauses.append(f"id IN ({','.join('?' * len(spec.species))})")
+        params.extend(spec.species)
+    if spec.search is not None:
+        clauses.append("id IN (SELECT rowid FROM species_fts WHERE species_fts MATCH ?)")
+        params.append(spec.search)
+    return f"SELECT id FROM species WHERE {' AND '.join(clauses)} ORDER BY id", params
+
+
+def query_species(conn, spec):
+    """Species ids matching spec. Raises ValueError for a search the FTS5 parser rejects."""
+    sql, params = species_query(spec)
+    try:
+        return [row[0] for row in conn.execute(sql, params)]
+    except sqlite3.OperationalError as e:
+        raise ValueError(f"deck '{spec.name}': bad search {spec.search!r}: {e}") from None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a deck spec file: species matched per deck and query time")
+    parser.add_argument("spec", help="Deck spec JSON file")
+    args = parser.parse_args()
+    try:
+        specs = load_specs(args.spec)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    conn = db.connect()
+    try:
+        for spec in specs:
+            start = time.perf_counter()
+            try:
+                ids = query_species(conn, spec)
+            except ValueError as e:
+                print(f"  {e}")
+                continue
+            print(f"  {spec.name}: {len(ids)} species ({(time.perf_counter() - start) * 1000:.2f} ms)")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,292 @@
 """
 Bird species ID discovery script for birds.org.il API
+
+Instead of probing every ID in a fixed range, discovery:
+  1. starts from the IDs known valid from the response cache, re-checking those
+     confirmed more than VALID_TTL_DAYS ago, and crawls the
+     relatedSpecies/moreFromFamily links of every valid species;
+  2. probes the unknown IDs up to the last known bound (the --hint on a cold
+     cache), skipping IDs confirmed invalid within the last INVALID_TTL_DAYS
+     unless a valid species links to them;
+  3. finds the live upper bound by galloping up from the highest valid ID and
+     binary-searching the edge, then always re-probes a window above it, so a
+     run of dead IDs isn't mistaken for the end and new species show up.
+
+On a cold cache this sends as many requests as a linear scan up to the hint,
+plus the window above the bound; the savings come on later runs.
 """
-import requests
+import argparse
+import asyncio
+import collections
 import time
 
+import metrics
+from http_engine import API_HEADERS, FetchEngine, FetchError
+from response_cache import ResponseCache
+
 API_URL = "https://api.birds.org.il/api/species/byid/he/{}"
 START_ID = 1
-END_ID = 854  # Last observed ID
-TIMEOUT = 0.5  # seconds between requests (faster)
+END_ID = 854  # Last observed ID; only a starting point for the upper-bound search
+REQUEST_TIMEOUT = 10
+MAX_GAP = 16  # longest run of dead IDs expected inside the live range
+INVALID_TTL_DAYS = 30  # confirmed-invalid IDs aren't re-probed for this long
+VALID_TTL_DAYS = 7  # valid IDs are re-probed after this long, so species removed upstream drop out
+LINK_KEYS = ("relatedSpecies", "moreFromFamily")
 
 VALID_IDS_FILE = "valid_species_ids.txt"
 
-def is_valid_species(species_id):
-    try:
-        headers = {
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "he-IL,he;q=0.9,en-US;q=0.8,en;q=0.7,ar;q=0.6",
-            "Referer": "https://www.birds.org.il/",
-            "Origin": "https://www.birds.org.il",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36"
-        }
-        resp = requests.get(API_URL.format(species_id), headers=headers, timeout=10)
-        if resp.status_code == 200:
+def species_data(data):
+    """The parsed response if it describes a species (must have a Hebrew and Latin name), else None."""
+    if isinstance(data, dict) and data.get("name") and data.get("latinName"):
+        return data
+    return None
+
+def linked_ids(data):
+    """Species IDs referenced by a response's relatedSpecies/moreFromFamily lists."""
+    ids = set()
+    for key in LINK_KEYS:
+        for entry in data.get(key) or []:
             try:
-                data = resp.json()
-            except Exception:
-                return False
-            # Basic check: must have a Hebrew name and Latin name
-            if data.get("name") and data.get("latinName"):
-                return data.get("name")
-        return False
-    except Exception:
+                ids.add(int(entry["id"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+    return ids
+
+async def fetch_species(engine, species_id, cache=None):
+    """Request one ID; returns the species JSON, or None if the ID is invalid. Raises FetchError."""
+    resp = await engine.get(API_URL.format(species_id))
+    if cache is not None:
+        # Keep the raw body so fetch_and_store_species doesn't download it again
+        cache.put(species_id, resp.status, resp.body, resp.headers)
+    if resp.status == 200:
+        try:
+            return species_data(resp.json())
+        except ValueError:
+            return None
+    return None
+
+async def is_valid_species(engine, species_id, cache=None):
+    """The species' Hebrew name if the ID is valid, else False."""
+    try:
+        data = await fetch_species(engine, species_id, cache)
+    except FetchError:
         return False
+    return data.get("name") if data else False
+
+class SpeciesDiscovery:
+    """
+    Finds the valid species IDs with as few requests as possible:
+
+        async with FetchEngine(headers=API_HEADERS) as engine:
+            discovery = SpeciesDiscovery(engine, cache)
+            valid_ids = await discovery.run()
+
+    on_valid, if given, is awaited with each valid ID as soon as it is known
+    (including IDs answered from the cache), so later stages can start early.
+    Callers that draw their own progress bar pass show_progress=False.
+    """
+
+    def __init__(self, engine, cache, start=START_ID, hint=END_ID, max_gap=MAX_GAP, invalid_ttl=INVALID_TTL_DAYS * 86400,
+                 valid_ttl=VALID_TTL_DAYS * 86400, scan_gaps=True, on_valid=None, show_progress=True):
+        self.engine = engine
+        self.cache = cache
+        self.start = start
+        self.hint = hint
+        self.max_gap = max_gap
+        self.invalid_ttl = invalid_ttl
+        self.valid_ttl = valid_ttl
+        self.scan_gaps = scan_gaps
+        self.on_valid = on_valid
+        self.show_progress = show_progress
+        self.valid = {}  # id -> species JSON
+        self.invalid = set()  # confirmed invalid, from this run or a fresh cache entry
+        self.stale = {}  # id -> species JSON of valid cache entries older than valid_ttl, to re-probe
+        self.probed = set()  # requested this run (including failed requests)
+        self.upper = None
+        self.requests = collections.Counter()  # phase -> requests sent
+        self.report = collections.Counter()
+        self.progress = None
 
-def discover_species_ids(start=START_ID, end=END_ID):
-    import concurrent.futures
-    valid_ids = []
-    def check_id(species_id):
-        name = is_valid_species(species_id)
-        if name:
-            print(f"  Valid: {species_id} - {name}")
-            return species_id
-        else:
-            print(f"  Invalid: {species_id}")
+    def load_cache(self):
+        """Seed valid IDs and recently confirmed invalid IDs from stored responses."""
+        now = time.time()
+        for species_id, (status, fetched_at) in self.cache.checked().items():
+            data = species_data(self.cache.get(species_id)) if status == 200 else None
+            if data and fetched_at and now - fetched_at >= self.valid_ttl:
+                self.stale[species_id] = data
+            elif data:
+                self.valid[species_id] = data
+                self.report["cached_valid"] += 1
+            elif fetched_at and now - fetched_at < self.invalid_ttl:
+                self.invalid.add(species_id)
+                self.report["cached_invalid"] += 1
+
+    def advance(self, valid=False):
+        if self.progress is not None:
+            self.progress.advance(valid=int(valid))
+
+    async def found(self, species_id, data):
+        self.valid[species_id] = data
+        self.invalid.discard(species_id)
+        self.advance(valid=True)
+        if self.on_valid is not None:
+            await self.on_valid(species_id)
+
+    async def probe(self, species_id, phase):
+        """Request one ID; returns its JSON if valid."""
+        self.probed.add(species_id)
+        self.requests[phase] += 1
+        metrics.inc("discovery_requests_total", phase=phase)
+        try:
+            data = await fetch_species(self.engine, species_id, self.cache)
+        except FetchError as e:
+            # Not cached, so the next run asks again
+            metrics.echo(f"  Exception for {species_id}: {e}")
+            self.report["errors"] += 1
+            if species_id in self.stale:
+                # Couldn't re-check: keep what the cache knows rather than dropping the species
+                data = self.stale[species_id]
+                await self.found(species_id, data)
+                return data
+            self.advance()
+            return None
+        if data is None:
+            self.invalid.add(species_id)
+            if species_id in self.stale:
+                self.report["removed"] += 1
+            self.advance()
             return None
-    print(f"Checking species IDs {start} to {end}...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(check_id, range(start, end + 1)))
-    valid_ids = [sid for sid in results if sid]
+        await self.found(species_id, data)
+        return data
+
+    def distrust(self, linked):
+        """A valid species linking to an ID the cache calls invalid makes that entry suspicious: ask again."""
+        suspicious = {i for i in linked if i in self.invalid and i not in self.probed}
+        self.report["suspicious"] += len(suspicious)
+        self.invalid -= suspicious
+
+    async def visit(self, ids, phase):
+        """Probe ids not decided yet, then crawl the links of every valid species found, breadth first."""
+        frontier = {i for i in ids if i not in self.valid and i not in self.invalid and i not in self.probed}
+        while frontier:
+            results = await asyncio.gather(*(self.probe(i, phase) for i in sorted(frontier)))
+            links = set()
+            for data in results:
+                if data:
+                    links |= linked_ids(data)
+            self.distrust(links)
+            frontier = {i for i in links if i not in self.valid and i not in self.probed}
+            phase = "crawl"
+
+    async def is_valid(self, species_id, phase):
+        if species_id not in self.valid and species_id not in self.invalid and species_id not in self.probed:
+            await self.visit([species_id], phase)
+        return species_id in self.valid
+
+    async def find_upper_bound(self):
+        """Highest valid ID, assuming no run of more than max_gap dead IDs below it."""
+        lo = max(self.valid, default=self.start - 1)
+        while True:
+            # Gallop up until an ID is invalid, then binary-search the edge between the two
+            step = 1
+            while await self.is_valid(lo + step, "bound"):
+                lo += step
+                step *= 2
+            hi = lo + step
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if await self.is_valid(mid, "bound"):
+                    lo = mid
+                else:
+                    hi = mid
+            # The edge may just be a gap: everything in the window above it must be invalid too.
+            # Cached misses there aren't trusted, since new species are added above the bound.
+            window = set(range(lo + 1, lo + 1 + self.max_gap))
+            self.invalid -= window - self.probed
+            await self.visit(window, "bound")
+            top = max(self.valid, default=lo)
+            if top <= lo:
+                return lo
+            lo = top
+
+    async def run(self):
+        """Discover valid IDs; returns them sorted."""
+        if self.show_progress:
+            self.progress = metrics.Progress(None, "discover")
+        self.load_cache()
+        for species_id in sorted(self.valid):
+            self.advance(valid=True)
+            if self.on_valid is not None:
+                await self.on_valid(species_id)
+        links = set()
+        for data in list(self.valid.values()):
+            links |= linked_ids(data)
+        self.distrust(links)
+        await self.visit(self.stale, "recheck")
+        await self.visit(links | {self.start, self.hint}, "crawl")
+        if self.scan_gaps:
+            # Up to the last known bound a scan is cheapest: the bound search then starts from there
+            await self.visit(range(self.start, max(self.hint, max(self.valid, default=0)) + 1), "gaps")
+        while True:
+            self.upper = await self.find_upper_bound()
+            if self.scan_gaps:
+                await self.visit(range(self.start, self.upper + 1), "gaps")
+            if max(self.valid, default=0) <= self.upper:
+                break
+        if self.progress is not None:
+            self.progress.close()
+        return sorted(i for i in self.valid if i >= self.start)
+
+    def summary(self):
+        sent = sum(self.requests.values())
+        phases = ", ".join(f"{phase} {count}" for phase, count in sorted(self.requests.items())) or "none"
+        r = self.report
+        line = (f"Discovery: {len(self.valid)} valid IDs up to {self.upper}; {sent} requests ({phases}); "
+                f"{r['cached_valid']} valid and {r['cached_invalid']} invalid IDs from the cache, "
+                f"{r['suspicious']} re-checked, {len(self.stale)} stale re-probed ({r['removed']} gone), {r['errors']} errors")
+        full_scan = self.upper - self.start + 1
+        if full_scan > 0:
+            saved = full_scan - sent
+            line += f". A full scan of {self.start}..{self.upper} would send {full_scan}: saved {saved} ({saved / full_scan:.0%})"
+        return line
+
+async def discover(cache, **options):
+    async with FetchEngine(headers=API_HEADERS, timeout=REQUEST_TIMEOUT) as engine:
+        discovery = SpeciesDiscovery(engine, cache, **options)
+        valid_ids = await discovery.run()
+    return discovery, valid_ids
+
+def write_valid_ids(valid_ids):
     with open(VALID_IDS_FILE, "w", encoding="utf-8") as f:
         for sid in valid_ids:
             f.write(f"{sid}\n")
+
+def discover_species_ids(**options):
+    print("Discovering species IDs...")
+    with ResponseCache() as cache:
+        discovery, valid_ids = asyncio.run(discover(cache, **options))
+    write_valid_ids(valid_ids)
+    print(discovery.summary())
     print(f"Done. {len(valid_ids)} valid species IDs saved to {VALID_IDS_FILE}")
 
+def main():
+    parser = argparse.ArgumentParser(description="Find which species IDs the birds.org.il API knows")
+    parser.add_argument("--start", type=int, default=START_ID, help="Lowest ID to consider")
+    parser.add_argument("--hint", type=int, default=END_ID, help="An ID believed to be near the top of the range")
+    parser.add_argument("--max-gap", type=int, default=MAX_GAP,
+                        help="Dead IDs checked above the apparent upper bound before accepting it")
+    parser.add_argument("--invalid-ttl-days", type=float, default=INVALID_TTL_DAYS,
+                        help="Don't re-probe IDs confirmed invalid within this many days (0 re-probes all)")
+    parser.add_argument("--valid-ttl-days", type=float, default=VALID_TTL_DAYS,
+                        help="Re-probe IDs confirmed valid more than this many days ago (0 re-probes all)")
+    parser.add_argument("--crawl-only", action="store_true",
+                        help="Only follow links and search the upper bound; don't probe unlinked IDs below it")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "discover"):
+        discover_species_ids(start=args.start, hint=args.hint, max_gap=args.max_gap,
+                             invalid_ttl=args.invalid_ttl_days * 86400, valid_ttl=args.valid_ttl_days * 86400,
+                             scan_gaps=not args.crawl_only)
+
 if __name__ == "__main__":
-    discover_species_ids()
+    main()
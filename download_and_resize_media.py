@@ -1,117 +1,315 @@
 """
 Download and resize bird images and sounds for Anki cards (mobile-friendly)
 """
+import argparse
+import asyncio
+import collections
 import os
-import sqlite3
-import requests
-from PIL import Image
-from io import BytesIO
 import time
 
-DB_FILE = "birds.sqlite3"
-MEDIA_ROOT = "media"
-IMG_MAX_SIZE = (400, 400)  # Mobile-friendly size
-TIMEOUT = 2
+import db
+import image_quality
+import media_store
+import metrics
+from db import DBWriter
+from http_engine import MAX_INFLIGHT_BYTES, FetchEngine, FetchError, conditional_headers, response_validator
+from image_pipeline import FORMAT_EXTENSIONS, IMG_QUALITY, VARIANTS, ImagePipeline, parse_variants, variants_spec
+
+REQUEST_TIMEOUT = 15
+SOUND_URL = "https://xeno-canto.org/{}/download"
 
 def ensure_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def download_and_resize_image(url, save_path):
+def load_validators(conn):
+    return {row[0]: tuple(row[1:]) for row in
+            conn.execute("SELECT url, etag, last_modified, content_hash FROM media_validators")}
+
+def source_unchanged(resp, validator):
+    """True if a 200 response carries the same bytes the stored validator was made from."""
+    return bool(validator) and validator[2] == response_validator(resp)[2]
+
+async def download_and_resize_image(engine, pipeline, url, save_path, validator=None):
+    """
+    Returns (outcome, validator, error, variants) where outcome is "saved",
+    "unchanged" or "failed" and variants maps each extra variant written to
+    (path, width, height). With a stored validator the request is conditional,
+    and a 304 (or identical bytes) skips the resize entirely.
+    """
+    # The source is streamed to disk next to its output and removed once resized
+    source_path = save_path + ".src"
     try:
-        resp = requests.get(url, timeout=15)
-        if resp.status_code == 200:
-            img = Image.open(BytesIO(resp.content))
-            img.thumbnail(IMG_MAX_SIZE)
-            img.save(save_path, format=img.format or 'JPEG', quality=85)
-            return True
+        resp = await engine.download(url, source_path, headers=conditional_headers(validator))
+        if resp.status == 304:
+            return "unchanged", validator, None, {}
+        if resp.status == 200:
+            if source_unchanged(resp, validator):
+                os.remove(source_path)
+                return "unchanged", response_validator(resp), None, {}
+            # Decode/resize happens in the pipeline's process pool
+            variants = await pipeline.resize(source_path, save_path)
+            os.remove(source_path)
+            return "saved", response_validator(resp), None, variants
+        error = f"HTTP {resp.status}"
     except Exception as e:
-        print(f"Failed to download/resize {url}: {e}")
-    return False
+        error = str(e)
+    metrics.echo(f"Failed to download/resize {url}: {error}")
+    return "failed", validator, error, {}
 
-def download_sound(sound_id, save_path):
+async def download_sound(engine, sound_id, save_path, validator=None):
     """
     Download the actual .mp3 file from xeno-canto.org using the sound ID.
+    Returns (outcome, validator, error) like download_and_resize_image.
     """
     # The download URL is https://xeno-canto.org/{sound_id}/download
-    sound_url = f"https://xeno-canto.org/{sound_id}/download"
+    sound_url = SOUND_URL.format(sound_id)
     try:
-        resp = requests.get(sound_url, timeout=15)
-        if resp.status_code == 200:
-            with open(save_path, "wb") as f:
-                f.write(resp.content)
-            return True
-        else:
-            print(f"Failed to download sound {sound_url}: HTTP {resp.status_code}")
-    except Exception as e:
-        print(f"Failed to download sound {sound_url}: {e}")
-    return False
+        resp = await engine.download(sound_url, save_path, headers=conditional_headers(validator))
+        if resp.status == 304:
+            return "unchanged", validator, None
+        if resp.status == 200:
+            if source_unchanged(resp, validator):
+                os.remove(save_path)
+                return "unchanged", response_validator(resp), None
+            return "saved", response_validator(resp), None
+        error = f"HTTP {resp.status}"
+    except FetchError as e:
+        error = str(e)
+    metrics.echo(f"Failed to download sound {sound_url}: {error}")
+    return "failed", validator, error
 
-def main():
-    # Clean up old .mp3 and .txt files from media directory
-    print("Cleaning up old .mp3 and .txt files from media directory...")
-    for root, dirs, files in os.walk(MEDIA_ROOT):
-        for file in files:
-            if file.endswith('.mp3') or file.endswith('.txt'):
-                try:
-                    os.remove(os.path.join(root, file))
-                except Exception as e:
-                    print(f"Failed to remove {file}: {e}")
-    import concurrent.futures
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, family, latin_name FROM species")
-    species_list = cur.fetchall()
-    download_tasks = []
-    for species_id, family, latin_name in species_list:
-        family_dir = family.strip() if family else "UnknownFamily"
-        species_dir = latin_name.strip() if latin_name else f"species_{species_id}"
-        base_dir = os.path.join(MEDIA_ROOT, family_dir, species_dir)
-        ensure_dir(base_dir)
-        # Images
-        cur.execute("SELECT id, url FROM images WHERE species_id=?", (species_id,))
-        for img_id, url in cur.fetchall():
+def sync_ledger(conn, force=False, species_id=None):
+    """
+    Add a pending media_tasks row for every image/sound not in the ledger yet and
+    drop rows whose media is gone. Runs on the writer connection. Media that an
+    older run already downloaded (file_path set and on disk) is entered as done,
+    so upgrading doesn't re-download everything. Pending rows point at their
+    working file under the store's tmp directory until they finish.
+    With species_id, only that species' media is added and nothing is removed.
+    Returns (added, removed).
+    """
+    now = time.time()
+    species_filter = "" if species_id is None else "AND species_id = :species_id"
+    rows = conn.execute(f"""
+        SELECT 'image', images.id, images.url, images.file_path
+        FROM images LEFT JOIN media_tasks t ON t.kind = 'image' AND t.media_id = images.id
+        WHERE t.media_id IS NULL {species_filter}
+        UNION ALL
+        SELECT 'sound', sounds.id, sounds.url, sounds.file_path
+        FROM sounds LEFT JOIN media_tasks t ON t.kind = 'sound' AND t.media_id = sounds.id
+        WHERE t.media_id IS NULL {species_filter}
+    """, {"species_id": species_id}).fetchall()
+    new_tasks = []
+    for kind, media_id, url, file_path in rows:
+        if kind == "image":
             ext = os.path.splitext(url)[-1] or ".jpg"
-            img_name = f"img_{img_id}{ext}"
-            img_path = os.path.join(base_dir, img_name)
-            if os.path.exists(img_path):
-                print(f"Skipping existing image: {img_path}")
-                continue
-            download_tasks.append(("image", img_id, url, img_path))
-        # Sounds
-        cur.execute("SELECT id, url FROM sounds WHERE species_id=?", (species_id,))
-        for snd_id, url in cur.fetchall():
+            path = os.path.join(media_store.TMP_ROOT, f"img_{media_id}{ext}")
+        else:
             # url is actually the sound ID as a string
-            snd_name = f"sound_{snd_id}.mp3"
-            snd_path = os.path.join(base_dir, snd_name)
-            if os.path.exists(snd_path):
-                print(f"Skipping existing sound: {snd_path}")
-                continue
-            download_tasks.append(("sound", snd_id, url, snd_path))
-
-    def process_task(task):
-        typ, file_id, url, path = task
-        if typ == "image":
-            if download_and_resize_image(url, path):
-                # Open a new connection for thread safety
-                conn2 = sqlite3.connect(DB_FILE)
-                conn2.execute("UPDATE images SET file_path=? WHERE id=?", (path, file_id))
-                conn2.commit()
-                conn2.close()
-                print(f"Saved image: {path}")
-        elif typ == "sound":
-            # url is actually the sound ID
-            if download_sound(url, path):
-                conn2 = sqlite3.connect(DB_FILE)
-                conn2.execute("UPDATE sounds SET file_path=? WHERE id=?", (path, file_id))
-                conn2.commit()
-                conn2.close()
-                print(f"Saved sound: {path}")
-
-    print(f"Starting media downloads with multithreading...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        list(executor.map(process_task, download_tasks))
+            path = os.path.join(media_store.TMP_ROOT, f"sound_{media_id}.mp3")
+            url = SOUND_URL.format(url)
+        state = "done" if file_path and os.path.exists(file_path) else "pending"
+        new_tasks.append((kind, media_id, url, file_path or path, state, now))
+    conn.executemany("INSERT INTO media_tasks (kind, media_id, url, file_path, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     new_tasks)
+    if species_id is not None:
+        return len(new_tasks), 0
+    removed = conn.execute("DELETE FROM media_tasks WHERE kind = 'image' AND media_id NOT IN (SELECT id FROM images)").rowcount
+    removed += conn.execute("DELETE FROM media_tasks WHERE kind = 'sound' AND media_id NOT IN (SELECT id FROM sounds)").rowcount
+    if force:
+        conn.execute("UPDATE media_tasks SET state = 'pending', updated_at = ?", (now,))
+    return len(new_tasks), removed
+
+def work_path(kind, media_id, url, pipeline):
+    """Where a task downloads (and, for images, resizes) before the result moves into the store."""
+    if kind == "image":
+        ext = os.path.splitext(url)[-1] or ".jpg"
+        return pipeline.output_path(os.path.join(media_store.TMP_ROOT, f"img_{media_id}{ext}"))
+    return os.path.join(media_store.TMP_ROOT, f"sound_{media_id}.mp3")
+
+def ledger_tasks(conn, states, species_id=None):
+    """(kind, media_id, url, file_path, state) for ledger rows in the given states, optionally for one species."""
+    placeholders = ",".join("?" * len(states))
+    if species_id is None:
+        return conn.execute(f"SELECT kind, media_id, url, file_path, state FROM media_tasks WHERE state IN ({placeholders})",
+                            states).fetchall()
+    return conn.execute(f"""
+        SELECT t.kind, t.media_id, t.url, t.file_path, t.state
+        FROM media_tasks t JOIN images ON t.kind = 'image' AND images.id = t.media_id
+        WHERE images.species_id = ? AND t.state IN ({placeholders})
+        UNION ALL
+        SELECT t.kind, t.media_id, t.url, t.file_path, t.state
+        FROM media_tasks t JOIN sounds ON t.kind = 'sound' AND sounds.id = t.media_id
+        WHERE sounds.species_id = ? AND t.state IN ({placeholders})
+    """, (species_id, *states, species_id, *states)).fetchall()
+
+def task_states(incremental=False):
+    return ("pending", "downloading", "failed", "done") if incremental else ("pending", "downloading", "failed")
+
+class MediaDownloader:
+    """
+    Works through media_tasks rows: downloads (and resizes) each one, moves the
+    result into the store and records the outcome through the writer.
+
+        downloader = MediaDownloader(engine, pipeline, writer, conn)
+        await asyncio.gather(*(downloader.process_task(task) for task in tasks))
+        downloader.save_validators()
+    """
+
+    def __init__(self, engine, pipeline, writer, conn):
+        self.engine = engine
+        self.pipeline = pipeline
+        self.writer = writer
+        self.validators = load_validators(conn)
+        self.new_validators = {}
+        self.report = collections.Counter()
+        # The same source URL can back several rows (e.g. shared between species); fetch it once per run.
+        # Rows share a fetch only if they send the same validator, so a 304 is never handed to a row
+        # that has no stored file of its own.
+        self.by_url = {}
+
+    async def fetch_once(self, kind, media_id, url, validator):
+        path = work_path(kind, media_id, url, self.pipeline)
+        variants = {}
+        if kind == "image":
+            outcome, validator, error, variants = await download_and_resize_image(self.engine, self.pipeline, url, path, validator)
+        else:
+            # The ledger keeps the full xeno-canto URL; download_sound wants the sound ID
+            sound_id = url.rstrip("/").split("/")[-2]
+            outcome, validator, error = await download_sound(self.engine, sound_id, path, validator)
+        stored = None
+        if outcome == "saved":
+            stored = await asyncio.to_thread(media_store.add, path, None, validator[2] if kind == "sound" else None)
+            for name, (variant_path, width, height) in variants.items():
+                size = os.path.getsize(variant_path)
+                variants[name] = (await asyncio.to_thread(media_store.add, variant_path), width, height, size)
+        return outcome, validator, error, stored, variants
+
+    async def process_task(self, task):
+        """Returns the outcome: "saved", "unchanged" or "failed". An error in one task marks only that row failed."""
+        try:
+            return await self.update_task(task)
+        except Exception as e:
+            kind, media_id, url = task[:3]
+            metrics.echo(f"Failed to process {kind} {media_id} ({url}): {e}")
+            self.writer.execute("UPDATE media_tasks SET state = 'failed', last_error = ?, updated_at = ? WHERE kind = ? AND media_id = ?",
+                                (str(e), time.time(), kind, media_id))
+            self.report["failed"] += 1
+            metrics.inc("media_items_total", kind=kind, outcome="failed")
+            return "failed"
+
+    async def update_task(self, task):
+        kind, media_id, url, old_path, state = task
+        writer = self.writer
+        # Only finished media has a file for a stored validator to describe
+        existed = state == "done"
+        validator = self.validators.get(url) if existed else None
+        writer.execute("UPDATE media_tasks SET state = 'downloading', attempts = attempts + 1, updated_at = ? WHERE kind = ? AND media_id = ?",
+                       (time.time(), kind, media_id))
+        key = (url, validator)
+        if key not in self.by_url:
+            self.by_url[key] = asyncio.ensure_future(self.fetch_once(kind, media_id, url, validator))
+        outcome, validator, error, stored, variants = await self.by_url[key]
+        if validator:
+            self.new_validators[url] = validator
+        if outcome == "failed":
+            writer.execute("UPDATE media_tasks SET state = 'failed', last_error = ?, updated_at = ? WHERE kind = ? AND media_id = ?",
+                           (error, time.time(), kind, media_id))
+            self.report["failed"] += 1
+            metrics.inc("media_items_total", kind=kind, outcome=outcome)
+            return outcome
+        path = stored or old_path
+        writer.execute("UPDATE media_tasks SET state = 'done', file_path = ?, bytes = ?, sha256 = ?, last_error = NULL, updated_at = ?"
+                       " WHERE kind = ? AND media_id = ?",
+                       (path, os.path.getsize(path), validator[2] if validator else None, time.time(), kind, media_id))
+        if outcome == "saved":
+            content_hash = os.path.splitext(os.path.basename(stored))[0]
+            if kind == "image":
+                # New pixels need a new perceptual hash and quality score
+                writer.execute("UPDATE images SET file_path=?, content_hash=?, dhash=NULL, quality=NULL WHERE id=?",
+                               (stored, content_hash, media_id))
+                writer.submit(lambda c: media_store.set_variants(c, media_id, variants))
+            else:
+                writer.execute("UPDATE sounds SET file_path=?, content_hash=? WHERE id=?", (stored, content_hash, media_id))
+            if existed and old_path != stored:
+                writer.submit(lambda c: media_store.release(c, old_path))
+            self.report["changed" if existed else "added"] += 1
+        else:
+            self.report["unchanged"] += 1
+        metrics.inc("media_items_total", kind=kind, outcome=outcome)
+        return outcome
+
+    def save_validators(self):
+        """Record validators, and drop those whose media no longer exists in the DB."""
+        now = time.time()
+        for url, validator in self.new_validators.items():
+            self.writer.execute("INSERT OR REPLACE INTO media_validators (url, etag, last_modified, content_hash, checked_at) VALUES (?, ?, ?, ?, ?)",
+                                (url, *validator, now))
+        self.writer.execute("DELETE FROM media_validators WHERE url NOT IN (SELECT url FROM media_tasks)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Download and resize bird images and sounds")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-download and re-process all media, not just unfinished or failed items")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Also revalidate finished media with conditional requests")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), help="Output image format (default: keep the source format)")
+    parser.add_argument("--quality", type=int, default=IMG_QUALITY, help="JPEG/WebP quality")
+    parser.add_argument("--workers", type=int, help="Image resize processes (default: CPU count)")
+    parser.add_argument("--variants", type=parse_variants, default=variants_spec(VARIANTS),
+                        help="Extra image sizes written from the same decode, as name=px:FORMAT[:quality],... "
+                             "(default: %(default)s; empty for none)")
+    parser.add_argument("--max-inflight-mb", type=int, default=MAX_INFLIGHT_BYTES // (1024 * 1024),
+                        help="Ceiling on download buffers held in memory across all concurrent downloads")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "media"):
+        run(args)
+
+def run(args):
+    pipeline = ImagePipeline(workers=args.workers, fmt=args.format, quality=args.quality, variants=args.variants)
+
+    conn = db.connect()
+    ensure_dir(media_store.TMP_ROOT)
+    engine = FetchEngine(timeout=REQUEST_TIMEOUT, max_inflight_bytes=args.max_inflight_mb * 1024 * 1024)
+
+    with DBWriter() as writer:
+        downloader = MediaDownloader(engine, pipeline, writer, conn)
+        report = downloader.report
+
+        async def run_tasks(tasks):
+            progress = metrics.Progress(len(tasks), "media")
+
+            async def run_task(task):
+                outcome = await downloader.process_task(task)
+                progress.advance(**{outcome: 1})
+
+            async with engine, pipeline:
+                await asyncio.gather(*(run_task(task) for task in tasks))
+                report["peak_inflight_kb"] = engine.budget.peak // 1024
+            progress.close()
+
+        added, removed = writer.submit(lambda c: sync_ledger(c, force=args.force)).result()
+        writer.flush()
+        print(f"Media ledger: {added} new items, {removed} removed")
+        report["removed"] = removed
+        tasks = ledger_tasks(conn, task_states(args.incremental))
+        print(f"Starting media downloads ({len(tasks)} items)...")
+        asyncio.run(run_tasks(tasks))
+        downloader.save_validators()
+
+        adopted = writer.submit(media_store.adopt_existing).result()
+        if adopted:
+            print(f"Moved {adopted} previously downloaded files into {media_store.STORE_ROOT}")
+        hashed, duplicates = writer.submit(media_store.index_duplicates).result()
+        print(f"Duplicate index: hashed {hashed} new images, {duplicates} near-duplicate photos flagged")
+        scored = writer.submit(image_quality.score_images).result()
+        print(f"Quality scores: scored {scored} new images")
     conn.close()
+    print("Media report: " + ", ".join(f"{key}={report[key]}" for key in ("added", "changed", "removed", "unchanged", "failed", "peak_inflight_kb")))
+    print(f"Image pipeline: {pipeline.report()}")
+    print(f"DB writer: {writer.stats()}")
     print("Done downloading and resizing media.")
 
 if __name__ == "__main__":
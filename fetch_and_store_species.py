@@ -2,129 +2,240 @@
 Fetch and parse bird species data from birds.org.il API and store in SQLite
 """
 
-import requests
-import sqlite3
-import json
+import argparse
+import asyncio
+import collections
 import os
-import time
-import concurrent.futures
+
+import db
+import media_store
+import metrics
+from db import DB_FILE, DBWriter
+from http_engine import API_HEADERS, FetchEngine, FetchError, conditional_headers
+from response_cache import ResponseCache
 
 API_URL = "https://api.birds.org.il/api/species/byid/he/{}"
 VALID_IDS_FILE = "valid_species_ids.txt"
-DB_FILE = "birds.sqlite3"
-TIMEOUT = 2
 REQUEST_TIMEOUT = 30
 
-CREATE_SPECIES_TABLE = """
-CREATE TABLE IF NOT EXISTS species (
-    id INTEGER PRIMARY KEY,
-    hebrew_name TEXT,
-    latin_name TEXT,
-    family TEXT,
-    description TEXT,
-    conservation TEXT
-);
-"""
-CREATE_IMAGES_TABLE = """
-CREATE TABLE IF NOT EXISTS images (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    species_id INTEGER,
-    url TEXT,
-    file_path TEXT,
-    FOREIGN KEY(species_id) REFERENCES species(id)
-);
-"""
-CREATE_SOUNDS_TABLE = """
-CREATE TABLE IF NOT EXISTS sounds (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    species_id INTEGER,
-    url TEXT,
-    file_path TEXT,
-    FOREIGN KEY(species_id) REFERENCES species(id)
-);
-"""
-
-def fetch_species_data(species_id):
+async def fetch_species_data(engine, species_id, cache=None):
+    if cache is not None:
+        data = cache.get(species_id)
+        if data is not None:
+            return data
     try:
-        headers = {
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "he-IL,he;q=0.9,en-US;q=0.8,en;q=0.7,ar;q=0.6",
-            "Referer": "https://www.birds.org.il/",
-            "Origin": "https://www.birds.org.il",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36"
-        }
-        resp = requests.get(API_URL.format(species_id), headers=headers, timeout=REQUEST_TIMEOUT)
-        if resp.status_code == 200:
-            try:
-                return resp.json()
-            except Exception as e:
-                print(f"  Error parsing JSON for {species_id}: {e}")
-        else:
-            print(f"  HTTP error {resp.status_code} for {species_id}")
-    except Exception as e:
-        print(f"  Exception for {species_id}: {e}")
+        resp = await engine.get(API_URL.format(species_id))
+    except FetchError as e:
+        metrics.echo(f"  Exception for {species_id}: {e}")
+        return None
+    if cache is not None:
+        cache.put(species_id, resp.status, resp.body, resp.headers)
+    if resp.status == 200:
+        try:
+            return resp.json()
+        except ValueError as e:
+            metrics.echo(f"  Error parsing JSON for {species_id}: {e}")
+    else:
+        metrics.echo(f"  HTTP error {resp.status} for {species_id}")
     return None
 
-def parse_and_store(data):
+UPSERT_SPECIES = """
+INSERT INTO species (id, hebrew_name, latin_name, family, description, conservation) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET hebrew_name=excluded.hebrew_name, latin_name=excluded.latin_name,
+    family=excluded.family, description=excluded.description, conservation=excluded.conservation
+"""
+# Reruns are no-ops for media that is already stored (UNIQUE(species_id, url))
+INSERT_IMAGE = "INSERT INTO images (species_id, url, file_path) VALUES (?, ?, NULL) ON CONFLICT(species_id, url) DO NOTHING"
+INSERT_SOUND = "INSERT INTO sounds (species_id, url, file_path) VALUES (?, ?, NULL) ON CONFLICT(species_id, url) DO NOTHING"
+
+def species_row(data):
+    return (data.get("id"), data.get("name"), data.get("latinName"), data.get("speciesFamilyName"),
+            data.get("description"), data.get("conservationLevelIL"))
+
+def media_urls(data):
+    images = [img.get("path") for img in data.get("images", []) + data.get("largeImage", [])]
+    sounds = [snd.get("path") for snd in data.get("sounds", [])]
+    return images, sounds
+
+def parse_and_store(data, writer):
+    species_id = data.get("id")
+    images, sounds = media_urls(data)
+    writer.execute(UPSERT_SPECIES, species_row(data))
+    for url in images:
+        writer.execute(INSERT_IMAGE, (species_id, url))
+    for url in sounds:
+        writer.execute(INSERT_SOUND, (species_id, url))
+
+def update_species(conn, data):
+    """
+    Bring an already-stored species in line with a changed API response.
+    Media rows are synced by URL so unchanged media keep their local files.
+    Runs on the writer connection; returns (media_added, media_removed).
+    """
     species_id = data.get("id")
-    hebrew_name = data.get("name")
-    latin_name = data.get("latinName")
-    family = data.get("speciesFamilyName")
-    description = data.get("description")
-    conservation = data.get("conservationLevelIL")
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("INSERT OR IGNORE INTO species (id, hebrew_name, latin_name, family, description, conservation) VALUES (?, ?, ?, ?, ?, ?)",
-                 (species_id, hebrew_name, latin_name, family, description, conservation))
-    # Images
-    for img in data.get("images", []):
-        url = img.get("path")
-        conn.execute("INSERT INTO images (species_id, url, file_path) VALUES (?, ?, ?)" , (species_id, url, None))
-    for img in data.get("largeImage", []):
-        url = img.get("path")
-        conn.execute("INSERT INTO images (species_id, url, file_path) VALUES (?, ?, ?)" , (species_id, url, None))
-    # Sounds
-    for snd in data.get("sounds", []):
-        url = snd.get("path")
-        conn.execute("INSERT INTO sounds (species_id, url, file_path) VALUES (?, ?, ?)" , (species_id, url, None))
-    conn.commit()
+    conn.execute(UPSERT_SPECIES, species_row(data))
+    added = removed = 0
+    images, sounds = media_urls(data)
+    for table, insert_sql, urls in (("images", INSERT_IMAGE, images), ("sounds", INSERT_SOUND, sounds)):
+        existing = conn.execute(f"SELECT id, url, file_path FROM {table} WHERE species_id=?", (species_id,)).fetchall()
+        existing_urls = {url for _, url, _ in existing}
+        for row_id, url, file_path in existing:
+            if url not in urls:
+                conn.execute(f"DELETE FROM {table} WHERE id=?", (row_id,))
+                media_store.release(conn, file_path)
+                if table == "images":
+                    media_store.set_variants(conn, row_id, {})
+                removed += 1
+        new_urls = [url for url in dict.fromkeys(urls) if url not in existing_urls]
+        conn.executemany(insert_sql, [(species_id, url) for url in new_urls])
+        added += len(new_urls)
+    return added, removed
+
+def delete_species(conn, species_ids):
+    """Remove species and their media rows/files. Runs on the writer connection."""
+    for species_id in species_ids:
+        for (image_id,) in conn.execute("SELECT id FROM images WHERE species_id=?", (species_id,)).fetchall():
+            media_store.set_variants(conn, image_id, {})
+        for table in ("images", "sounds"):
+            file_paths = conn.execute(f"SELECT file_path FROM {table} WHERE species_id=? AND file_path IS NOT NULL", (species_id,)).fetchall()
+            conn.execute(f"DELETE FROM {table} WHERE species_id=?", (species_id,))
+            for (file_path,) in file_paths:
+                media_store.release(conn, file_path)
+        conn.execute("DELETE FROM species WHERE id=?", (species_id,))
+
+def stored_species_ids():
+    conn = db.connect()
+    ids = {row[0] for row in conn.execute("SELECT id FROM species")}
     conn.close()
-    if not os.path.exists(VALID_IDS_FILE):
-        print(f"Missing {VALID_IDS_FILE}. Run discover_species_ids.py first.")
-        return
+    return ids
+
+async def refresh_one(engine, species_id, cache, writer, stored_ids, report):
+    """Revalidate one species with a conditional request and apply whatever changed. Returns True if it changed."""
+    try:
+        resp = await engine.get(API_URL.format(species_id), headers=conditional_headers(cache.validator(species_id)))
+    except FetchError as e:
+        metrics.echo(f"  Exception for {species_id}: {e}")
+        report["failed"] += 1
+        return False
+    if resp.status == 304:
+        cache.touch(species_id)
+        report["unchanged"] += 1
+        return False
+    if resp.status in (404, 410) and species_id in stored_ids:
+        # Removed upstream: drop it like a species that left the ID list
+        cache.put(species_id, resp.status, resp.body, resp.headers)
+        stored_ids.discard(species_id)
+        await asyncio.wrap_future(writer.submit(lambda conn: delete_species(conn, [species_id])))
+        report["removed"] += 1
+        return True
+    if resp.status != 200:
+        metrics.echo(f"  HTTP error {resp.status} for {species_id}")
+        report["failed"] += 1
+        return False
+    content_changed = cache.put(species_id, resp.status, resp.body, resp.headers)
+    exists = species_id in stored_ids
+    if exists and not content_changed:
+        report["unchanged"] += 1
+        return False
+    try:
+        data = resp.json()
+    except ValueError as e:
+        metrics.echo(f"  Error parsing JSON for {species_id}: {e}")
+        report["failed"] += 1
+        return False
+    if exists:
+        media_added, media_removed = await asyncio.wrap_future(writer.submit(lambda conn: update_species(conn, data)))
+        report["changed"] += 1
+        report["media_added"] += media_added
+        report["media_removed"] += media_removed
+        return True
     else:
-        print(f"{VALID_IDS_FILE} already exists. Skipping species ID discovery.")
+        parse_and_store(data, writer)
+        report["added"] += 1
+        return True
 
-    with open(VALID_IDS_FILE, encoding="utf-8") as f:
-        ids = [int(line.strip()) for line in f if line.strip().isdigit()]
+async def refresh_all(ids, cache, writer):
+    report = collections.Counter()
+    stored_ids = stored_species_ids()
+    progress = metrics.Progress(len(ids), "refresh")
 
-    # Create tables once before threading and enable WAL mode
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    conn.execute(CREATE_SPECIES_TABLE)
-    conn.execute(CREATE_IMAGES_TABLE)
-    conn.execute(CREATE_SOUNDS_TABLE)
-    conn.close()
-def fetch_and_store_one(species_id):
-        # Open a single connection per thread
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM species WHERE id=?", (species_id,))
-        if cur.fetchone():
-            print(f"Skipping already-fetched species: {species_id}")
-            conn.close()
-            return
-        data = fetch_species_data(species_id)
-        if data:
-            hebrew_name = data.get("name", "")
-            print(f"Fetched {species_id} - {hebrew_name}")
-            parse_and_store(data)
-        else:
-            print(f"  Failed to fetch {species_id}")
-        conn.close()
+    async def refresh(species_id):
+        changed = await refresh_one(engine, species_id, cache, writer, stored_ids, report)
+        progress.advance(changed=int(changed))
+
+    async with FetchEngine(headers=API_HEADERS, timeout=REQUEST_TIMEOUT) as engine:
+        await asyncio.gather(*(refresh(sid) for sid in ids))
+    progress.close()
+    gone = stored_ids - set(ids)
+    writer.submit(lambda conn: delete_species(conn, gone))
+    report["removed"] += len(gone)
+    return report
+
+async def fetch_and_store_one(engine, species_id, writer, stored_ids, cache=None):
+    """Returns True if the species was newly stored."""
+    if species_id in stored_ids:
+        metrics.inc("species_total", outcome="skipped")
+        return False
+    data = await fetch_species_data(engine, species_id, cache)
+    if data:
+        parse_and_store(data, writer)
+        metrics.inc("species_total", outcome="stored")
+        return True
+    metrics.echo(f"  Failed to fetch {species_id}")
+    metrics.inc("species_total", outcome="failed")
+    return False
 
+async def fetch_all(ids, writer, cache=None):
+    stored_ids = stored_species_ids()
+    progress = metrics.Progress(len(ids), "fetch")
+
+    async def fetch_one(species_id):
+        stored = await fetch_and_store_one(engine, species_id, writer, stored_ids, cache)
+        progress.advance(stored=int(stored))
+
+    async with FetchEngine(headers=API_HEADERS, timeout=REQUEST_TIMEOUT) as engine:
+        await asyncio.gather(*(fetch_one(sid) for sid in ids))
+    progress.close()
+
+def reparse_from_cache(cache, writer):
+    """
+    Rebuild the species/images/sounds tables from the raw response archive,
+    without any network access. Media rows are synced by URL, so local files of
+    already-downloaded media are kept and nothing gets downloaded again.
+    """
+    stored_ids = stored_species_ids()
+    parsed_ids = set()
+    for data in cache.iter_species():
+        if not (data.get("name") and data.get("latinName")):
+            continue
+        if data.get("id") in stored_ids:
+            writer.submit(lambda conn, data=data: update_species(conn, data))
+        else:
+            parse_and_store(data, writer)
+        parsed_ids.add(data.get("id"))
+    gone = stored_ids - parsed_ids
+    writer.submit(lambda conn: delete_species(conn, gone))
+    return len(parsed_ids)
 
 def main():
+    parser = argparse.ArgumentParser(description="Fetch species data from birds.org.il into SQLite")
+    parser.add_argument("--reparse", action="store_true",
+                        help="Rebuild species/images/sounds from the cached API responses, without network access")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Revalidate every species with conditional requests and apply only what changed")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "fetch"):
+        run(args)
+
+def run(args):
+    if args.reparse:
+        with ResponseCache() as cache, DBWriter() as writer:
+            count = reparse_from_cache(cache, writer)
+        print(f"Done. Re-parsed {count} cached species into {DB_FILE}")
+        print(f"DB writer: {writer.stats()}")
+        return
+
     if not os.path.exists(VALID_IDS_FILE):
         print(f"Missing {VALID_IDS_FILE}. Run discover_species_ids.py first.")
         return
@@ -134,19 +245,20 @@ def main():
     with open(VALID_IDS_FILE, encoding="utf-8") as f:
         ids = [int(line.strip()) for line in f if line.strip().isdigit()]
 
-    # Create tables once before threading and enable WAL mode
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    conn.execute(CREATE_SPECIES_TABLE)
-    conn.execute(CREATE_IMAGES_TABLE)
-    conn.execute(CREATE_SOUNDS_TABLE)
-    conn.close()
+    if args.incremental:
+        print(f"Refreshing species data with conditional requests...")
+        with ResponseCache() as cache, DBWriter() as writer:
+            report = asyncio.run(refresh_all(ids, cache, writer))
+        print("Refresh report: " + ", ".join(f"{key}={report[key]}" for key in
+              ("added", "changed", "removed", "unchanged", "failed", "media_added", "media_removed")))
+        print(f"DB writer: {writer.stats()}")
+        return
 
     print(f"Fetching species data concurrently...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        list(executor.map(fetch_and_store_one, ids))
+    with ResponseCache() as cache, DBWriter() as writer:
+        asyncio.run(fetch_all(ids, writer, cache))
     print(f"Done. Data saved to {DB_FILE}")
+    print(f"DB writer: {writer.stats()}")
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,23 @@
 """
 Generate an Anki deck (APKG) from the bird species database and images.
 """
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
-import sqlite3
+import time
+
 import genanki
 
+import apkg_writer
+import db
+import deck_specs
+import media_store
+import metrics
+import releases
+from catalog import Catalog
+
 DB_FILE = "birds.sqlite3"
 DECK_ID = 2059400110  # Random, but must be consistent for updates
 DECK_NAME = "Birds of Israel"
@@ -12,6 +25,16 @@ DECK_NAME = "Birds of Israel"
 MODEL_ID = 1607392319  # Random, must be unique
 MEDIA_ROOT = "media"
 OUTPUT_FILE = "Birds_of_Israel.apkg"
+DELTA_FILE = "Birds_of_Israel_delta_since_{}.apkg"
+DECKS_DIR = "decks"
+MIN_FAMILY_ITEMS = 3
+FINGERPRINT_SUFFIX = ".fingerprint"
+# Device profile -> (image variant its decks use, None for the primary images; suffix of its file names)
+DECK_PROFILES = {"phone": (None, ""), "desktop": ("desktop", "_desktop")}
+DEFAULT_PROFILE = "phone"
+# "stream" writes packages with apkg_writer; "genanki" uses genanki.Package (slower, larger files)
+PACKAGERS = ("stream", "genanki")
+DEFAULT_PACKAGER = "stream"
 
 # Define the card model (template) for Anki, now with Sounds field.
 # IMPORTANT: Field order matters for Anki duplicate detection. We make the
@@ -60,127 +83,300 @@ my_model = genanki.Model(
     '''
 )
 
-def main():
+def sanitize_name(name):
+    # Simple filename-safe sanitizer
+    return ''.join(c for c in name if c.isalnum() or c in (' ', '-', '_')).rstrip().replace(' ', '_')
+
+def family_deck_id(family):
+    # Deterministic deck id from family name
+    return DECK_ID + int(hashlib.sha1(family.encode('utf-8')).hexdigest()[:8], 16)
+
+def note_guid(image):
     """
-    Generate an Anki deck from the SQLite database and images.
-    Each card will have an image on the front, and bird names/family on the back.
-    All images are included as media in the APKG file.
+    Stable note GUID derived from the photo's source: its species and the URL it
+    was downloaded from. Renamed species, new sounds, a different image variant
+    or resize settings all keep the GUID, so they update the note.
     """
+    return genanki.guid_for("bird-photo", image.species.id, image.url or image.id)
 
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    deck = genanki.Deck(DECK_ID, DECK_NAME)
+def build_notes(images):
+    """
+    (guid, fields) notes and media paths for a sequence of catalog Images.
+    """
+    notes = []
     media_files = []
-
-    # Query all images and their species info
-    cur.execute("""
-        SELECT images.file_path, species.id, species.hebrew_name, species.latin_name, species.family
-        FROM images
-        JOIN species ON images.species_id = species.id
-        WHERE images.file_path IS NOT NULL AND images.file_path != ''
-    """)
-    rows = cur.fetchall()
-    print(f"Found {len(rows)} images for Anki deck generation.")
-
-    for img_path, species_id, hebrew_name, latin_name, family in rows:
-        if not os.path.exists(img_path):
-            print(f"Warning: Image file missing: {img_path}")
-            continue
+    for image in images:
+        species = image.species
         # Anki expects just the filename in the <img> tag, not the full path
-        img_filename = os.path.basename(img_path)
-        media_files.append(img_path)
+        img_filename = os.path.basename(image.file_path)
+        media_files.append(image.file_path)
 
-        # Get all sound files for this species
-        cur.execute("SELECT file_path FROM sounds WHERE species_id=? AND file_path IS NOT NULL AND file_path != ''", (species_id,))
-        sound_paths = [row[0] for row in cur.fetchall() if os.path.exists(row[0])]
-        sound_filenames = [os.path.basename(p) for p in sound_paths]
         # Build the Anki sound field: [sound:filename1.mp3][sound:filename2.mp3] ...
-        sounds_field = ''.join([f'[sound:{fname}]' for fname in sound_filenames])
+        sounds_field = ''.join([f'[sound:{os.path.basename(p)}]' for p in species.sound_paths])
         # Add all sound files to media
-        media_files.extend(sound_paths)
+        media_files.extend(species.sound_paths)
 
         # Use image filename as a short unique ID (Field 1) to avoid Anki
         # merging notes on identical Field 1 checksums. The image HTML is kept
         # in Field 2 so the card shows correctly.
         uid = img_filename
-        note = genanki.Note(
-            model=my_model,
-            fields=[
-                uid,
-                f'<img src="{img_filename}">',  # Image field
-                hebrew_name or '',
-                latin_name or '',
-                family or '',
-                sounds_field,
-            ]
-        )
-        deck.add_note(note)
-
+        notes.append((note_guid(image), [
+            uid,
+            f'<img src="{img_filename}">',  # Image field
+            species.hebrew_name or '',
+            species.latin_name or '',
+            species.family or '',
+            sounds_field,
+        ]))
     # Remove duplicates from media_files
-    media_files = list(dict.fromkeys(media_files))
+    return notes, list(dict.fromkeys(media_files))
 
-    # Package the deck with media
-    print(f"Packaging deck with {len(media_files)} media files (images + sounds)...")
-    genanki.Package(deck, media_files).write_to_file(OUTPUT_FILE)
-    print(f"Anki deck generated: {OUTPUT_FILE}")
+def media_fingerprint(path):
+    # Store files are named by their content hash; anything else falls back to size and mtime
+    if media_store.in_store(path):
+        return os.path.basename(path)
+    st = os.stat(path)
+    return f"{path}:{st.st_size}:{st.st_mtime_ns}"
 
-    # --- Create per-family decks ---
-    print("Creating per-family decks...")
-    # ensure decks directory exists
-    decks_dir = "decks"
-    os.makedirs(decks_dir, exist_ok=True)
-    # Build mapping: family -> list of rows (image_path, species_id, hebrew, latin, family)
-    family_map = {}
-    for img_path, species_id, hebrew_name, latin_name, family in rows:
-        fam_key = family or 'UnknownFamily'
-        family_map.setdefault(fam_key, []).append((img_path, species_id, hebrew_name, latin_name, family))
+def deck_fingerprint(deck_id, deck_name, notes, media_files):
+    """Hash of everything that ends up in a package: model, deck, note fields and media content."""
+    h = hashlib.sha256()
+    h.update(json.dumps([MODEL_ID, my_model.templates, my_model.css, deck_id, deck_name, notes],
+                        ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    for path in media_files:
+        h.update(media_fingerprint(path).encode("utf-8"))
+    return h.hexdigest()
+
+def package_is_current(output_file, fingerprint):
+    try:
+        with open(output_file + FINGERPRINT_SUFFIX, encoding="utf-8") as f:
+            return f.read().strip() == fingerprint and os.path.exists(output_file)
+    except FileNotFoundError:
+        return False
+
+def write_package(deck_id, deck_name, notes, media_files, output_file, fingerprint, packager=DEFAULT_PACKAGER):
+    """
+    Build one APKG; runs in a worker process. The fingerprint sidecar is written
+    last, so a crash mid-build never leaves a package that looks current.
+    Returns (output_file, seconds, bytes_written).
+    """
+    start = time.perf_counter()
+    tmp_file = output_file + ".tmp"
+    if packager == "stream":
+        apkg_writer.write_apkg(tmp_file, my_model, deck_id, deck_name, notes, media_files)
+    else:
+        deck = genanki.Deck(deck_id, deck_name)
+        for guid, fields in notes:
+            deck.add_note(genanki.Note(model=my_model, fields=fields, guid=guid))
+        genanki.Package(deck, media_files).write_to_file(tmp_file)
+    os.replace(tmp_file, output_file)
+    with open(output_file + FINGERPRINT_SUFFIX, "w", encoding="utf-8") as f:
+        f.write(fingerprint)
+    return output_file, time.perf_counter() - start, os.path.getsize(output_file)
+
+def profile_path(path, profile=DEFAULT_PROFILE):
+    """Output path of a deck for a device profile: Birds_of_Israel.apkg -> Birds_of_Israel_desktop.apkg."""
+    root, ext = os.path.splitext(path)
+    return root + DECK_PROFILES[profile][1] + ext
+
+def optimized_variant(profile=DEFAULT_PROFILE):
+    """Image variant optimize_images.py writes for a profile's size-targeted photos."""
+    return f"{profile}-optimized"
+
+def load_catalog(profile=DEFAULT_PROFILE, optimized=True, max_images_per_species=None):
+    """
+    The catalog with a profile's photos: its optimized encodings where they
+    exist, else its variant. With max_images_per_species, only each species'
+    best-scoring photos are kept.
+    """
+    variants = [optimized_variant(profile)] if optimized else []
+    if DECK_PROFILES[profile][0] is not None:
+        variants.append(DECK_PROFILES[profile][0])
+    catalog = Catalog.load(DB_FILE, variants)
+    if max_images_per_species:
+        catalog.keep_best_images(max_images_per_species)
+    return catalog
 
-    def sanitize_name(name):
-        # Simple filename-safe sanitizer
-        return ''.join(c for c in name if c.isalnum() or c in (' ', '-', '_')).rstrip().replace(' ', '_')
+def master_job(catalog, profile=DEFAULT_PROFILE):
+    """(deck_id, deck_name, notes, media_files, output_file) for the deck with every photo."""
+    notes, media_files = build_notes(catalog.images())
+    return DECK_ID, DECK_NAME, notes, media_files, profile_path(OUTPUT_FILE, profile)
 
-    import hashlib
+def release_manifest(name, profile=DEFAULT_PROFILE):
+    return releases.manifest_path(name, DECK_PROFILES[profile][1])
 
-    for fam, items in family_map.items():
+def delta_job(master, since, profile=DEFAULT_PROFILE):
+    """
+    Package job with only the master deck's notes and media that changed since
+    release `since`, or None if nothing did. Raises ValueError if the release is unknown.
+    """
+    deck_id, deck_name, notes, media_files, _ = master
+    manifest = releases.load_manifest(release_manifest(since, profile))
+    delta_notes, delta_media, report = releases.delta(manifest, notes, media_files, media_fingerprint)
+    print(f"Since release {since}: {report['added']} notes added, {report['changed']} changed, "
+          f"{report['removed']} removed (not carried by a delta), {report['media']} media files to ship")
+    if not delta_notes:
+        return None
+    return deck_id, deck_name, delta_notes, delta_media, profile_path(DELTA_FILE.format(since), profile)
+
+def record_release(master, name, profile=DEFAULT_PROFILE):
+    """Write the manifest of release `name` from the master deck's job."""
+    deck_id, deck_name, notes, media_files, _ = master
+    path = release_manifest(name, profile)
+    releases.write_manifest(path, releases.build_manifest(name, deck_id, deck_name, notes, media_files, media_fingerprint))
+    print(f"Release {name}: manifest of {len(notes)} notes and {len(media_files)} media files written to {path}")
+
+def family_jobs(catalog, families=None, profile=DEFAULT_PROFILE):
+    """Package jobs for the given families (default: all), skipping small ones."""
+    # ensure decks directory exists
+    os.makedirs(DECKS_DIR, exist_ok=True)
+    jobs = []
+    for fam in (catalog.families if families is None else families):
+        fam_images = list(catalog.images(catalog.families.get(fam, [])))
         # skip small families
-        if len(items) < 3:
-            print(f"Skipping family '{fam}' with only {len(items)} items (<3)")
+        if len(fam_images) < MIN_FAMILY_ITEMS:
+            if fam_images:
+                print(f"Skipping family '{fam}' with only {len(fam_images)} items (<{MIN_FAMILY_ITEMS})")
             continue
-        fam_safe = sanitize_name(fam)
-        # Deterministic deck id from family name
-        fam_hash = int(hashlib.sha1(fam.encode('utf-8')).hexdigest()[:8], 16)
-        fam_deck_id = DECK_ID + fam_hash
-        fam_deck_name = f"Birds of Israel - {fam}"
-        fam_deck = genanki.Deck(fam_deck_id, fam_deck_name)
-        fam_media = []
-        for img_path, species_id, hebrew_name, latin_name, family in items:
-            if not os.path.exists(img_path):
+        fam_notes, fam_media = build_notes(fam_images)
+        fam_filename = profile_path(os.path.join(DECKS_DIR, f"Birds_of_Israel_{sanitize_name(fam)}.apkg"), profile)
+        jobs.append((family_deck_id(fam), f"Birds of Israel - {fam}", fam_notes, fam_media, fam_filename))
+    return jobs
+
+def spec_deck_id(name):
+    return DECK_ID + int(hashlib.sha1(f"spec:{name}".encode('utf-8')).hexdigest()[:8], 16)
+
+def spec_jobs(catalog, specs, profile=DEFAULT_PROFILE):
+    """
+    Package jobs for deck specs, all from one catalog, plus {output_file: query
+    seconds}. Each spec's species come from one indexed query on DB_FILE.
+    """
+    os.makedirs(DECKS_DIR, exist_ok=True)
+    jobs, query_times = [], {}
+    conn = db.connect(DB_FILE)
+    try:
+        for spec in specs:
+            start = time.perf_counter()
+            species_ids = deck_specs.query_species(conn, spec)
+            elapsed = time.perf_counter() - start
+            metrics.observe("deck_query_seconds", elapsed)
+            images = list(catalog.images(catalog.species[i] for i in species_ids if i in catalog.species))
+            if len(images) < spec.min_images:
+                print(f"Skipping deck '{spec.name}' with {len(images)} photos of {len(species_ids)} species (<{spec.min_images})")
                 continue
-            img_filename = os.path.basename(img_path)
-            fam_media.append(img_path)
-            cur.execute("SELECT file_path FROM sounds WHERE species_id=? AND file_path IS NOT NULL AND file_path != ''", (species_id,))
-            sound_paths = [row[0] for row in cur.fetchall() if os.path.exists(row[0])]
-            sound_filenames = [os.path.basename(p) for p in sound_paths]
-            sounds_field = ''.join([f'[sound:{fname}]' for fname in sound_filenames])
-            fam_media.extend(sound_paths)
-            uid = img_filename
-            note = genanki.Note(
-                model=my_model,
-                fields=[
-                    uid,
-                    f'<img src="{img_filename}">',
-                    hebrew_name or '',
-                    latin_name or '',
-                    family or '',
-                    sounds_field,
-                ]
-            )
-            fam_deck.add_note(note)
-        fam_media = list(dict.fromkeys(fam_media))
-        fam_filename = os.path.join(decks_dir, f"Birds_of_Israel_{fam_safe}.apkg")
-        print(f"Packaging family deck '{fam_deck_name}' with {len(fam_media)} media files -> {fam_filename}")
-        genanki.Package(fam_deck, fam_media).write_to_file(fam_filename)
-    print("Per-family decks created.")
+            notes, media_files = build_notes(images)
+            output_file = profile_path(os.path.join(DECKS_DIR, spec.file or f"Birds_of_Israel_{sanitize_name(spec.name)}.apkg"), profile)
+            jobs.append((spec_deck_id(spec.name), f"{DECK_NAME} - {spec.name}", notes, media_files, output_file))
+            query_times[output_file] = elapsed
+    finally:
+        conn.close()
+    return jobs, query_times
+
+def record_package(future):
+    """Done-callback for a package build: count its time and size (worker processes can't record metrics themselves)."""
+    if future.cancelled() or future.exception() is not None:
+        metrics.inc("packages_total", result="failed")
+        return
+    _, seconds, size = future.result()
+    metrics.inc("packages_total", result="built")
+    metrics.observe("package_seconds", seconds)
+    metrics.inc("package_bytes_total", size)
+
+def submit_package(executor, job, force=False, packager=DEFAULT_PACKAGER):
+    """Queue a package build on executor; returns its Future, or None if the existing package is current."""
+    deck_id, deck_name, notes, media_files, output_file = job
+    fingerprint = deck_fingerprint(deck_id, deck_name, notes, media_files)
+    if not force and package_is_current(output_file, fingerprint):
+        metrics.inc("packages_total", result="reused")
+        return None
+    metrics.echo(f"Packaging deck '{deck_name}' with {len(notes)} notes and {len(media_files)} media files -> {output_file}")
+    future = executor.submit(write_package, deck_id, deck_name, notes, media_files, output_file, fingerprint, packager)
+    future.add_done_callback(record_package)
+    return future
+
+def print_report(built, reused, elapsed, query_times=None):
+    # Spec decks also show how long their species query took
+    query_times = query_times or {}
+
+    def query(output_file):
+        return [f"query {query_times[output_file] * 1000:.2f} ms"] if output_file in query_times else []
+
+    for output_file, seconds, size in sorted(built):
+        print(f"  built  {output_file}: " + ", ".join(query(output_file) + [f"package {seconds:.2f}s", f"{size / 1e6:.1f} MB"]))
+    for output_file in reused:
+        print(f"  reused {output_file}" + "".join(f": {part}" for part in query(output_file)))
+    print(f"Packaging done in {elapsed:.2f}s: {len(built)} rebuilt, {len(reused)} reused, "
+          f"{sum(size for _, _, size in built) / 1e6:.1f} MB written")
+
+def main():
+    """
+    Generate an Anki deck from the SQLite database and images.
+    Each card will have an image on the front, and bird names/family on the back.
+    All images are included as media in the APKG file.
+    A master deck plus one deck per family are built in parallel worker
+    processes; a deck whose notes and media haven't changed since the last
+    build is reused instead of rebuilt.
+    """
+    parser = argparse.ArgumentParser(description="Generate Anki decks from the bird database")
+    parser.add_argument("--workers", type=int, help="Packaging processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Rebuild every package even if its inputs are unchanged")
+    parser.add_argument("--deck-profile", choices=sorted(DECK_PROFILES), default=DEFAULT_PROFILE,
+                        help="Device profile: picks the image variant the decks use and suffixes their file names")
+    parser.add_argument("--no-optimized", action="store_true",
+                        help="Ignore the size-targeted encodings from optimize_images.py")
+    parser.add_argument("--max-images-per-species", type=int, metavar="N",
+                        help="Only the N best-scoring photos of each species (see image_quality.py)")
+    parser.add_argument("--spec", help="Build the decks of this deck spec file (see deck_specs.py) instead of master and family decks")
+    parser.add_argument("--release", metavar="NAME",
+                        help="Record the master deck of this build as release NAME, for later --delta-since builds")
+    parser.add_argument("--delta-since", metavar="NAME",
+                        help=f"Also write {DELTA_FILE.format('NAME')} with only the notes and media changed since release NAME")
+    parser.add_argument("--packager", choices=PACKAGERS, default=DEFAULT_PACKAGER,
+                        help="stream: media stored as-is, only the collection deflated; genanki: genanki.Package")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.spec and (args.release or args.delta_since):
+        parser.error("--release and --delta-since apply to the master deck; they can't be combined with --spec")
+    with metrics.instrumented(args, "deck"):
+        run(args)
+
+def run(args):
+    catalog = load_catalog(args.deck_profile, not args.no_optimized, args.max_images_per_species)
+    for path in catalog.missing:
+        print(f"Warning: Image file missing: {path}")
+    print(f"Found {sum(1 for _ in catalog.images())} images for Anki deck generation.")
+    query_times = None
+    if args.spec:
+        try:
+            jobs, query_times = spec_jobs(catalog, deck_specs.load_specs(args.spec), args.deck_profile)
+        except ValueError as e:
+            raise SystemExit(str(e))
+    else:
+        jobs = [master_job(catalog, args.deck_profile)] + family_jobs(catalog, profile=args.deck_profile)
+        try:
+            if args.release and not args.force and os.path.exists(release_manifest(args.release, args.deck_profile)):
+                raise ValueError(f"Release {args.release} is already recorded (--force overwrites it)")
+            if args.delta_since:
+                job = delta_job(jobs[0], args.delta_since, args.deck_profile)
+                if job is not None:
+                    jobs.append(job)
+        except ValueError as e:
+            raise SystemExit(str(e))
+
+    start = time.perf_counter()
+    reused = []
+    futures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for job in jobs:
+            future = submit_package(executor, job, args.force, args.packager)
+            if future is None:
+                reused.append(job[4])
+            else:
+                futures.append(future)
+        built = [future.result() for future in concurrent.futures.as_completed(futures)]
+    print_report(built, reused, time.perf_counter() - start, query_times)
+    if args.release:
+        record_release(jobs[0], args.release, args.deck_profile)
 
 if __name__ == "__main__":
     main()
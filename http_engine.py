@@ -0,0 +1,383 @@
+"""
+Shared asyncio HTTP engine used by discovery, species fetch and media download
+"""
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import metrics
+
+# Headers the birds.org.il API expects (it rejects requests without a browser-like Referer/Origin)
+API_HEADERS = {
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "he-IL,he;q=0.9,en-US;q=0.8,en;q=0.7,ar;q=0.6",
+    "Referer": "https://www.birds.org.il/",
+    "Origin": "https://www.birds.org.il",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36"
+}
+
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+BACKOFF_MAX = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Adaptive per-host concurrency
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+LATENCY_TOLERANCE = 2.0  # grow while smoothed latency stays under this multiple of the best seen
+LATENCY_SLACK = 0.05  # seconds, so tiny baselines don't make every jitter look like congestion
+
+# Streaming downloads
+CHUNK_SIZE = 64 * 1024
+MAX_INFLIGHT_BYTES = 16 * 1024 * 1024  # ceiling on chunk buffers held across all concurrent downloads
+
+
+class FetchError(Exception):
+    """Raised when a request still fails after all retries."""
+
+
+class FetchResult:
+    """
+    Response of get() (body holds the bytes) or download() (body is None; the
+    content is on disk and size/sha256 describe it).
+    """
+    __slots__ = ("url", "status", "headers", "body", "elapsed", "size", "sha256")
+
+    def __init__(self, url, status, headers, body, elapsed, size=None, sha256=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed
+        self.size = size
+        self.sha256 = sha256
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class HostLimiter:
+    """
+    Concurrency limit for a single host.
+
+    The limit grows by roughly one slot per window of successful requests while
+    latency stays close to the best latency seen, shrinks gently when latency
+    climbs, and halves on 429/5xx responses.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.best_latency = None
+        self.latency = None
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, elapsed):
+        self.requests += 1
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        if self.best_latency is None or elapsed < self.best_latency:
+            self.best_latency = elapsed
+        if self.latency <= self.best_latency * LATENCY_TOLERANCE + LATENCY_SLACK:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        else:
+            self.limit = max(self.minimum, self.limit * 0.95)
+
+    def on_throttle(self):
+        self.throttled += 1
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+class ByteBudget:
+    """Caps the bytes buffered by all in-flight downloads together."""
+
+    def __init__(self, limit=MAX_INFLIGHT_BYTES):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        n = min(n, self.limit)
+        async with self._cond:
+            while self.used + n > self.limit:
+                await self._cond.wait()
+            self.used += n
+            self.peak = max(self.peak, self.used)
+        return n
+
+    async def release(self, n):
+        async with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+def parse_retry_after(value):
+    """Return the Retry-After header as seconds, or None if absent/unparseable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def response_validator(result):
+    """(ETag, Last-Modified, sha256 of body) for a 200 response, stored for later conditional requests."""
+    return (
+        result.headers.get("ETag"),
+        result.headers.get("Last-Modified"),
+        result.sha256 or hashlib.sha256(result.body).hexdigest(),
+    )
+
+
+def expected_size(resp, offset):
+    """Full size of the resource from Content-Length/Content-Range, or None if the server didn't say."""
+    if resp.headers.get("Content-Encoding", "identity") != "identity":
+        return None  # Content-Length counts the encoded bytes, not what we write
+    if resp.status == 206:
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    if resp.content_length is not None:
+        return offset + resp.content_length
+    return None
+
+
+def hash_file(path, sha256=None):
+    sha256 = sha256 or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256
+
+
+def conditional_headers(validator):
+    """If-None-Match/If-Modified-Since headers from a stored validator tuple (or None)."""
+    if not validator:
+        return None
+    etag, last_modified = validator[0], validator[1]
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers or None
+
+
+class FetchEngine:
+    """
+    One keep-alive session with per-host connection pools and per-host adaptive
+    concurrency. Use as an async context manager:
+
+        async with FetchEngine(headers=API_HEADERS) as engine:
+            result = await engine.get(url)
+    """
+
+    def __init__(self, headers=None, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES,
+                 initial_concurrency=INITIAL_CONCURRENCY, min_concurrency=MIN_CONCURRENCY,
+                 max_concurrency=MAX_CONCURRENCY, max_inflight_bytes=MAX_INFLIGHT_BYTES):
+        self.budget = ByteBudget(max_inflight_bytes)
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.session = None
+        self.limiters = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(self.initial_concurrency, self.min_concurrency, self.max_concurrency)
+            self.limiters[host] = limiter
+        return limiter
+
+    def record(self, url, status, elapsed, size=0):
+        """Count one response (status "error" for a connection failure) in the process-wide metrics."""
+        host = urlsplit(url).netloc
+        metrics.inc("http_requests_total", host=host, status=status)
+        metrics.observe("http_request_seconds", elapsed, host=host)
+        if size:
+            metrics.inc("http_bytes_total", size, host=host)
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(BACKOFF_MAX, retry_after)
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def get(self, url, headers=None):
+        """
+        GET a URL and return a FetchResult with the full body.
+        429/5xx and connection errors are retried with backoff; any other status
+        is returned to the caller as-is. Raises FetchError once retries run out.
+        """
+        limiter = self.limiter(url)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            await limiter.acquire()
+            try:
+                start = time.monotonic()
+                async with self.session.get(url, headers=headers) as resp:
+                    body = await resp.read()
+                    elapsed = time.monotonic() - start
+                    self.record(url, resp.status, elapsed, len(body))
+                    if resp.status not in RETRY_STATUSES:
+                        limiter.on_success(elapsed)
+                        return FetchResult(url, resp.status, resp.headers, body, elapsed)
+                    limiter.on_throttle()
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    last_error = f"HTTP {resp.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                limiter.errors += 1
+                self.record(url, "error", time.monotonic() - start)
+                last_error = repr(e)
+            finally:
+                await limiter.release()
+            if attempt < self.max_retries:
+                limiter.retries += 1
+                metrics.inc("http_retries_total", host=urlsplit(url).netloc)
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+        raise FetchError(f"{url}: {last_error}")
+
+    async def download(self, url, dest_path, headers=None, expected_sha256=None):
+        """
+        Stream a URL to dest_path without holding the body in memory.
+
+        Chunks go to dest_path + ".part", which is fsynced and atomically renamed
+        into place only once its size matches Content-Length (and expected_sha256,
+        if given). A .part left behind by an interrupted run or a dropped
+        connection is resumed with a Range request. Returns a FetchResult with
+        body=None; for anything but 200/206 nothing on disk is touched.
+        """
+        limiter = self.limiter(url)
+        part_path = dest_path + ".part"
+        # Downloads may legitimately take longer than `timeout`; only a stalled socket is an error
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            request_headers = dict(headers or {})
+            if offset:
+                request_headers["Range"] = f"bytes={offset}-"
+            await limiter.acquire()
+            try:
+                start = time.monotonic()
+                async with self.session.get(url, headers=request_headers, timeout=timeout) as resp:
+                    if resp.status in RETRY_STATUSES:
+                        self.record(url, resp.status, time.monotonic() - start)
+                        limiter.on_throttle()
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        last_error = f"HTTP {resp.status}"
+                    elif resp.status == 416 and offset:
+                        # The .part is already complete or stale; start over
+                        os.remove(part_path)
+                        self.record(url, 416, time.monotonic() - start)
+                        last_error = "HTTP 416"
+                    elif resp.status not in (200, 206):
+                        self.record(url, resp.status, time.monotonic() - start)
+                        limiter.on_success(time.monotonic() - start)
+                        return FetchResult(url, resp.status, resp.headers, None, time.monotonic() - start)
+                    else:
+                        if resp.status == 200:
+                            offset = 0  # server ignored the Range header
+                        sha256 = await asyncio.to_thread(hash_file, part_path) if offset else hashlib.sha256()
+                        size = await self._stream(resp, part_path, offset, sha256)
+                        total = expected_size(resp, offset)
+                        if total is not None and size != total:
+                            raise aiohttp.ClientPayloadError(f"got {size} of {total} bytes")
+                        self.record(url, resp.status, time.monotonic() - start, size - offset)
+                        digest = sha256.hexdigest()
+                        if expected_sha256 and digest != expected_sha256:
+                            os.remove(part_path)
+                            raise FetchError(f"{url}: sha256 mismatch")
+                        os.replace(part_path, dest_path)
+                        limiter.on_success(time.monotonic() - start)
+                        return FetchResult(url, 200, resp.headers, None, time.monotonic() - start, size, digest)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                limiter.errors += 1
+                self.record(url, "error", time.monotonic() - start)
+                last_error = repr(e)
+            finally:
+                await limiter.release()
+            if attempt < self.max_retries:
+                limiter.retries += 1
+                metrics.inc("http_retries_total", host=urlsplit(url).netloc)
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+        raise FetchError(f"{url}: {last_error}")
+
+    async def _stream(self, resp, part_path, offset, sha256):
+        """Append the response body to part_path chunk by chunk; returns the file size. fsyncs before returning."""
+        size = offset
+        with open(part_path, "ab" if offset else "wb") as f:
+            while True:
+                reserved = await self.budget.acquire(CHUNK_SIZE)
+                try:
+                    chunk = await resp.content.read(reserved)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                finally:
+                    await self.budget.release(reserved)
+            f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        return size
+
+    def stats(self):
+        return {
+            host: {
+                "requests": l.requests,
+                "retries": l.retries,
+                "throttled": l.throttled,
+                "errors": l.errors,
+                "concurrency": round(l.limit, 1),
+                "latency_ms": round((l.latency or 0) * 1000, 1),
+            }
+            for host, l in self.limiters.items()
+        }
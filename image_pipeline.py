@@ -0,0 +1,217 @@
+"""
+Two-stage image pipeline: downloaders hand raw source files to a bounded queue,
+and a process pool does the PIL decode/resize/encode work off the event loop and the GIL.
+Each source is decoded once and written at the primary size plus any number of
+extra size/format variants.
+"""
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from PIL import Image
+
+import metrics
+
+IMG_MAX_SIZE = (400, 400)  # Mobile-friendly size
+IMG_FORMAT = None  # None keeps the source format; or "JPEG", "PNG", "WEBP"
+IMG_QUALITY = 85
+QUEUE_SIZE = 64  # downloaded sources waiting for a CPU worker
+# Extra variants written next to the primary image: name -> (max edge in px, format, quality)
+VARIANTS = {
+    "thumb": (200, "WEBP", 80),  # web preview
+    "desktop": (1024, "JPEG", 88),  # desktop/tablet decks
+}
+
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+# Modes each output format can store directly; anything else is converted first
+FORMAT_MODES = {"JPEG": ("RGB", "L"), "WEBP": ("RGB", "RGBA"), "PNG": ("RGB", "RGBA", "L", "LA", "P")}
+
+
+def parse_variants(spec):
+    """
+    Parse "name=px:FORMAT[:quality],..." (e.g. "thumb=200:WEBP,desktop=1024:JPEG:88")
+    into a VARIANTS-style dict. An empty spec means no extra variants.
+    """
+    variants = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, settings = item.partition("=")
+        fields = settings.split(":")
+        if not name or len(fields) not in (2, 3) or fields[1].upper() not in FORMAT_EXTENSIONS:
+            raise ValueError(f"bad variant {item!r}; expected name=px:FORMAT[:quality]")
+        variants[name] = (int(fields[0]), fields[1].upper(), int(fields[2]) if len(fields) == 3 else IMG_QUALITY)
+    return variants
+
+
+def variants_spec(variants):
+    """The parse_variants() spelling of a VARIANTS-style dict."""
+    return ",".join(f"{name}={px}:{fmt}:{quality}" for name, (px, fmt, quality) in variants.items())
+
+
+def fit(size, max_size):
+    """Size after img.thumbnail(max_size): scaled down to fit, never up."""
+    scale = min(1.0, max_size[0] / size[0], max_size[1] / size[1])
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def decode_and_resize(source_path, outputs):
+    """
+    Runs in a worker process. outputs is a list of (save_path, max_size, fmt,
+    quality); fmt None keeps the source format. The source is decoded once, at
+    the scale the largest output needs, and each output is resized from the
+    smallest already-resized image that is still big enough. Every output is
+    written to a temp file and renamed into place, so a save_path is never left
+    half-written. Returns ([(bytes_written, width, height)] in output order,
+    decode_s, resize_s, encode_s) measured in CPU time.
+    """
+    t0 = time.process_time()
+    resize_s = encode_s = 0.0
+    results = [None] * len(outputs)
+    with Image.open(source_path) as source:
+        source_format = source.format
+        largest = max((max_size for _, max_size, _, _ in outputs), key=lambda size: size[0] * size[1])
+        if source_format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of the full multi-megapixel image
+            source.draft(source.mode, largest)
+        source.load()
+        decode_s = time.process_time() - t0
+        img = source
+        # Largest first, so each step shrinks an image that is already close in size
+        order = sorted(range(len(outputs)), key=lambda i: -fit(source.size, outputs[i][1])[0])
+        for i in order:
+            save_path, max_size, fmt, quality = outputs[i]
+            t1 = time.process_time()
+            target = fit(img.size, max_size)
+            if target != img.size:
+                img = img.resize(target, Image.Resampling.BICUBIC, reducing_gap=2.0)
+            out_format = fmt or source_format or "JPEG"
+            out = img
+            if out.mode not in FORMAT_MODES.get(out_format, (out.mode,)):
+                out = out.convert("RGBA" if "A" in out.mode and "RGBA" in FORMAT_MODES[out_format] else "RGB")
+            t2 = time.process_time()
+            tmp_path = save_path + ".tmp"
+            out.save(tmp_path, format=out_format, quality=quality)
+            os.replace(tmp_path, save_path)
+            t3 = time.process_time()
+            resize_s += t2 - t1
+            encode_s += t3 - t2
+            results[i] = (os.path.getsize(save_path), out.size[0], out.size[1])
+    return results, decode_s, resize_s, encode_s
+
+
+class ImagePipeline:
+    """
+    Async context manager around the CPU stage:
+
+        async with ImagePipeline() as pipeline:
+            variants = await pipeline.resize(source_path, save_path)
+
+    resize() writes the primary image to save_path and returns the extra
+    variants as {name: (path, width, height)}. It waits for a free queue slot first, so fast downloaders are held back
+    instead of piling up sources that still need resizing.
+    """
+
+    def __init__(self, workers=None, max_size=IMG_MAX_SIZE, fmt=IMG_FORMAT, quality=IMG_QUALITY, queue_size=QUEUE_SIZE,
+                 variants=VARIANTS):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_size = max_size
+        self.fmt = fmt
+        self.quality = quality
+        self.variants = variants
+        self.queue = asyncio.Queue(queue_size)
+        self.pool = None
+        self.consumers = []
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.resized = 0
+        self.variants_written = 0
+        self.failed = 0
+        self.written_bytes = 0
+        self.decode_time = 0.0
+        self.resize_time = 0.0
+        self.encode_time = 0.0
+        self.started_at = None
+        self.elapsed = None
+
+    async def __aenter__(self):
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        self.consumers = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        self.started_at = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.queue.join()
+        for task in self.consumers:
+            task.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.pool.shutdown()
+        self.elapsed = time.perf_counter() - self.started_at
+
+    def output_path(self, path):
+        """Swap the extension of path for the configured output format, if any."""
+        if not self.fmt:
+            return path
+        return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[self.fmt]
+
+    def variant_path(self, save_path, name):
+        """Working path of a variant, next to the primary output."""
+        return f"{os.path.splitext(save_path)[0]}.{name}{FORMAT_EXTENSIONS[self.variants[name][1]]}"
+
+    async def resize(self, source_path, save_path):
+        """Queue a downloaded source image for the CPU stage and wait until save_path and the variants are written."""
+        self.downloaded += 1
+        self.downloaded_bytes += os.path.getsize(source_path)
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((source_path, save_path, done))
+        return await done
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            source_path, save_path, done = await self.queue.get()
+            names = list(self.variants)
+            outputs = [(save_path, self.max_size, self.fmt, self.quality)] + [
+                (self.variant_path(save_path, name), (self.variants[name][0],) * 2, *self.variants[name][1:]) for name in names]
+            try:
+                results, decode_s, resize_s, encode_s = await loop.run_in_executor(self.pool, decode_and_resize, source_path, outputs)
+                written = sum(size for size, _, _ in results)
+                self.resized += 1
+                self.variants_written += len(names)
+                self.written_bytes += written
+                self.decode_time += decode_s
+                self.resize_time += resize_s
+                self.encode_time += encode_s
+                metrics.observe("image_decode_seconds", decode_s)
+                metrics.observe("image_resize_seconds", resize_s)
+                metrics.observe("image_encode_seconds", encode_s)
+                metrics.inc("image_output_bytes_total", written)
+                done.set_result({name: (outputs[i][0], *results[i][1:]) for i, name in enumerate(names, start=1)})
+            except Exception as e:
+                self.failed += 1
+                metrics.inc("image_failures_total")
+                done.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def report(self):
+        elapsed = self.elapsed or time.perf_counter() - self.started_at
+        cpu = self.decode_time + self.resize_time + self.encode_time
+        return {
+            "workers": self.workers,
+            "download": {
+                "images": self.downloaded,
+                "mb": round(self.downloaded_bytes / 1e6, 1),
+                "mb_per_sec": round(self.downloaded_bytes / 1e6 / elapsed, 2) if elapsed else 0.0,
+            },
+            "resize": {
+                "images": self.resized,
+                "variants": self.variants_written,
+                "failed": self.failed,
+                "images_per_sec": round(self.resized / elapsed, 1) if elapsed else 0.0,
+                "decode_cpu_s": round(self.decode_time, 2),
+                "resize_cpu_s": round(self.resize_time, 2),
+                "encode_cpu_s": round(self.encode_time, 2),
+                "cpu_utilisation": round(cpu / (elapsed * self.workers), 2) if elapsed else 0.0,
+                "output_mb": round(self.written_bytes / 1e6, 1),
+            },
+        }
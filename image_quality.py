@@ -0,0 +1,119 @@
+"""
+Photo quality scores, so decks can keep only the best few photos per species.
+
+Each stored image gets a sharpness (variance of the Laplacian), an exposure score
+(how far mean brightness sits from mid-grey and how much of the frame is clipped),
+a contrast (luma standard deviation) and its resolution. They combine into one
+quality score between 0 and 1. PIL only decodes each file and shrinks it to a
+small grayscale square. The filters and statistics run on a whole batch at once
+in NumPy.
+"""
+import argparse
+
+import numpy as np
+from PIL import Image
+
+import db
+import metrics
+
+ANALYSIS_SIZE = 256  # photos are compared at this size, so scores don't depend on the stored size
+SCORE_BATCH = 256
+CLIP_LOW, CLIP_HIGH = 5, 250  # luma at or beyond these counts as crushed/blown out
+SHARPNESS_REF = 1000.0  # Laplacian variance of a crisp photo
+CONTRAST_REF = 60.0  # luma standard deviation of a well-contrasted photo
+RESOLUTION_REF = 400 * 300  # pixels of a full-size phone image
+# Weights of sharpness, exposure, contrast and resolution in the quality score
+WEIGHTS = np.array([0.4, 0.2, 0.2, 0.2], dtype=np.float32)
+
+
+def load_batch(paths, size=ANALYSIS_SIZE):
+    """
+    (pixels, resolution, readable): grayscale size x size float32 arrays, pixel
+    counts and a mask of the files that could be decoded.
+    """
+    pixels = np.zeros((len(paths), size, size), dtype=np.float32)
+    resolution = np.zeros(len(paths), dtype=np.int64)
+    readable = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            with Image.open(path) as img:
+                resolution[i] = img.width * img.height
+                # JPEG can decode straight at a reduced scale
+                img.draft("L", (size, size))
+                pixels[i] = np.asarray(img.convert("L").resize((size, size), Image.Resampling.BILINEAR))
+                readable[i] = True
+        except OSError:
+            continue
+    return pixels, resolution, readable
+
+
+def measure(pixels):
+    """(sharpness, exposure, contrast) for a batch of grayscale frames, shape (n, h, w)."""
+    center = pixels[:, 1:-1, 1:-1]
+    laplacian = 4 * center - pixels[:, :-2, 1:-1] - pixels[:, 2:, 1:-1] - pixels[:, 1:-1, :-2] - pixels[:, 1:-1, 2:]
+    sharpness = laplacian.var(axis=(1, 2))
+    brightness = pixels.mean(axis=(1, 2))
+    clipped = ((pixels <= CLIP_LOW) | (pixels >= CLIP_HIGH)).mean(axis=(1, 2))
+    exposure = (1 - np.abs(brightness - 128) / 128) * (1 - clipped)
+    contrast = pixels.std(axis=(1, 2))
+    return sharpness, exposure, contrast
+
+
+def quality(sharpness, exposure, contrast, resolution):
+    """Weighted 0..1 quality score from the raw measurements."""
+    parts = np.stack([
+        np.clip(np.log1p(sharpness) / np.log1p(SHARPNESS_REF), 0, 1),
+        np.clip(exposure, 0, 1),
+        np.clip(contrast / CONTRAST_REF, 0, 1),
+        np.clip(resolution / RESOLUTION_REF, 0, 1),
+    ], axis=1)
+    return parts @ WEIGHTS
+
+
+def score_batch(paths):
+    """Rows of (sharpness, exposure, contrast, resolution, quality); unreadable files score 0."""
+    pixels, resolution, readable = load_batch(paths)
+    sharpness, exposure, contrast = measure(pixels)
+    scores = np.where(readable, quality(sharpness, exposure, contrast, resolution), 0.0)
+    return [(float(s), float(e), float(c), int(r), float(q)) if ok else (0.0, 0.0, 0.0, 0, 0.0)
+            for s, e, c, r, q, ok in zip(sharpness, exposure, contrast, resolution, scores, readable)]
+
+
+def score_images(conn, batch_size=SCORE_BATCH, species_ids=None, rescore=False):
+    """
+    Score images that have a file but no score yet (all of them with rescore).
+    species_ids limits the work to those species. Runs on the writer connection.
+    Returns the number of images scored.
+    """
+    clauses = ["file_path IS NOT NULL", "file_path != ''"]
+    params = ()
+    if not rescore:
+        clauses.append("quality IS NULL")
+    if species_ids is not None:
+        species_ids = list(species_ids)
+        clauses.append(f"species_id IN ({','.join('?' * len(species_ids))})")
+        params = tuple(species_ids)
+    rows = conn.execute(f"SELECT id, file_path FROM images WHERE {' AND '.join(clauses)}", params).fetchall()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        with metrics.timer("image_score_batch_seconds"):
+            scores = score_batch([path for _, path in batch])
+        conn.executemany("UPDATE images SET sharpness = ?, exposure = ?, contrast = ?, resolution = ?, quality = ? WHERE id = ?",
+                         [(*score, image_id) for score, (image_id, _) in zip(scores, batch)])
+        metrics.inc("images_scored_total", len(batch))
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score stored photos for sharpness, exposure, contrast and resolution")
+    parser.add_argument("--rescore", action="store_true", help="Score every image again, not only new ones")
+    parser.add_argument("--batch-size", type=int, default=SCORE_BATCH, help="Images decoded and scored together")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "score"), db.DBWriter() as writer:
+        scored = writer.submit(lambda conn: score_images(conn, args.batch_size, rescore=args.rescore)).result()
+    print(f"Scored {scored} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,7 @@
 """
-Main entry point for birding project: runs all steps in order
+Main entry point for birding project: runs all steps in one process (see pipeline.py)
 """
-import subprocess
-import sys
+from pipeline import main
 
-import os
-
-
-# List of scripts to run in order (excluding discover_species_ids.py, which is conditional)
-SCRIPTS = [
-    "fetch_and_store_species.py",
-    "download_and_resize_media.py",
-    "generate_anki_deck.py"
-]
-
-
-if not os.path.exists("valid_species_ids.txt"):
-    print("\n=== Running discover_species_ids.py ===")
-    result = subprocess.run([sys.executable, "discover_species_ids.py"])
-    if result.returncode != 0:
-        print(f"Error running discover_species_ids.py. Stopping.")
-        sys.exit(result.returncode)
-else:
-    print("valid_species_ids.txt already exists. Skipping discover_species_ids.py.")
-
-# Run the rest of the scripts in order
-for script in SCRIPTS:
-    print(f"\n=== Running {script} ===")
-    result = subprocess.run([sys.executable, script])
-    if result.returncode != 0:
-        print(f"Error running {script}. Stopping.")
-        sys.exit(result.returncode)
-print("\nAll steps completed successfully.")
+if __name__ == "__main__":
+    main()
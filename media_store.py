@@ -0,0 +1,197 @@
+"""
+Content-addressed media store and perceptual-hash duplicate index.
+
+Files live at media/store/<first two hex chars>/<sha256><ext>, so identical
+images or sounds are stored (and packaged) once no matter how many rows point
+at them. The basename doubles as a unique Anki media filename.
+"""
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+import db
+from http_engine import hash_file
+
+STORE_ROOT = os.path.join("media", "store")
+TMP_ROOT = os.path.join(STORE_ROOT, "tmp")  # in-progress downloads; same filesystem so renames are atomic
+DHASH_SIZE = 8  # 8x8 = 64-bit hash
+DUPLICATE_DISTANCE = 6  # max differing bits for two photos to count as near-duplicates
+HASH_BATCH = 256
+
+
+def store_path(sha256, ext):
+    return os.path.join(STORE_ROOT, sha256[:2], sha256 + ext)
+
+
+def in_store(path):
+    return os.path.commonpath([os.path.abspath(path), os.path.abspath(STORE_ROOT)]) == os.path.abspath(STORE_ROOT)
+
+
+def add(path, ext=None, sha256=None):
+    """
+    Move a finished file into the store and return its store path. If identical
+    content is already stored, the new copy is discarded.
+    """
+    ext = ext if ext is not None else os.path.splitext(path)[1]
+    sha256 = sha256 or hash_file(path).hexdigest()
+    dest = store_path(sha256, ext)
+    if os.path.exists(dest):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+    return dest
+
+
+def release(conn, path):
+    """
+    Delete a stored file once no image, image variant, image encoding, sound or
+    audio clip row references it any more.
+    """
+    if not path or not os.path.exists(path):
+        return
+    referenced = conn.execute(
+        "SELECT 1 FROM images WHERE file_path = ? UNION ALL SELECT 1 FROM sounds WHERE file_path = ?"
+        " UNION ALL SELECT 1 FROM audio_clips WHERE clip_path = ? UNION ALL SELECT 1 FROM image_variants WHERE file_path = ?"
+        " UNION ALL SELECT 1 FROM image_encodings WHERE file_path = ? LIMIT 1",
+        (path, path, path, path, path)).fetchone()
+    if not referenced:
+        os.remove(path)
+
+
+def set_variants(conn, image_id, variants):
+    """
+    Replace an image's variant rows with variants ({name: (path, width, height,
+    bytes)}) and release files no longer used. Runs on the writer connection;
+    set_variants(conn, image_id, {}) drops them all.
+    """
+    old_paths = [row[0] for row in conn.execute("SELECT file_path FROM image_variants WHERE image_id = ?", (image_id,))]
+    conn.execute("DELETE FROM image_variants WHERE image_id = ?", (image_id,))
+    conn.executemany("INSERT INTO image_variants (image_id, variant, file_path, width, height, bytes) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(image_id, name, *variant) for name, variant in variants.items()])
+    for path in old_paths:
+        release(conn, path)
+
+
+def set_variant(conn, image_id, name, variant):
+    """
+    Set (or with variant=None, drop) one variant row of an image, leaving its
+    other variants alone, and release the file it replaces. Runs on the writer connection.
+    """
+    old = conn.execute("SELECT file_path FROM image_variants WHERE image_id = ? AND variant = ?", (image_id, name)).fetchone()
+    conn.execute("DELETE FROM image_variants WHERE image_id = ? AND variant = ?", (image_id, name))
+    if variant is not None:
+        conn.execute("INSERT INTO image_variants (image_id, variant, file_path, width, height, bytes) VALUES (?, ?, ?, ?, ?, ?)",
+                     (image_id, name, *variant))
+    if old and (variant is None or old[0] != variant[0]):
+        release(conn, old[0])
+
+
+def adopt_existing(conn):
+    """
+    Move media downloaded before the store existed into it and repoint
+    images/sounds/media_tasks. Runs on the writer connection. Returns the number of files adopted.
+    """
+    adopted = 0
+    for table, kind in (("images", "image"), ("sounds", "sound")):
+        rows = conn.execute(f"SELECT id, file_path FROM {table} WHERE file_path IS NOT NULL").fetchall()
+        for media_id, path in rows:
+            if in_store(path) or not os.path.exists(path):
+                continue
+            new_path = add(path)
+            adopted += 1
+            sha256 = os.path.splitext(os.path.basename(new_path))[0]
+            conn.execute(f"UPDATE {table} SET file_path = ?, content_hash = ? WHERE id = ?", (new_path, sha256, media_id))
+            conn.execute("UPDATE media_tasks SET file_path = ? WHERE kind = ? AND media_id = ?", (new_path, kind, media_id))
+    return adopted
+
+
+def dhash_batch(paths, size=DHASH_SIZE):
+    """
+    64-bit difference hashes for a batch of images. PIL only shrinks each image
+    to 9x8 grayscale; the gradient comparison and bit packing run on the whole
+    batch at once in NumPy. Unreadable files get hash 0.
+    """
+    pixels = np.zeros((len(paths), size, size + 1), dtype=np.int16)
+    for i, path in enumerate(paths):
+        try:
+            with Image.open(path) as img:
+                pixels[i] = np.asarray(img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR))
+        except OSError:
+            continue
+    bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(paths), -1), axis=1)
+    return packed.view(">u8").ravel().astype(np.uint64)
+
+
+def hamming_matrix(hashes):
+    """Pairwise Hamming distances between 64-bit hashes (uint64 array)."""
+    xor = np.bitwise_xor.outer(hashes, hashes)
+    return np.unpackbits(xor.view(np.uint8).reshape(len(hashes), len(hashes), 8), axis=2).sum(axis=2)
+
+
+def index_duplicates(conn, threshold=DUPLICATE_DISTANCE, batch_size=HASH_BATCH, species_ids=None):
+    """
+    Hash new thumbnails and flag near-duplicate photos within each species:
+    images.duplicate_of points at the lowest-id photo each duplicate resembles.
+    species_ids limits the work to those species. Runs on the writer connection.
+    Returns (hashed, duplicates).
+    """
+    if species_ids is None:
+        species_filter, params = "", ()
+    else:
+        species_ids = list(species_ids)
+        species_filter, params = f"AND species_id IN ({','.join('?' * len(species_ids))})", tuple(species_ids)
+    missing = conn.execute(f"SELECT id, file_path FROM images WHERE file_path IS NOT NULL AND dhash IS NULL {species_filter}",
+                           params).fetchall()
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        hashes = dhash_batch([path for _, path in batch])
+        # SQLite integers are signed 64-bit
+        conn.executemany("UPDATE images SET dhash = ? WHERE id = ?",
+                         [(int(h.astype(np.int64)), image_id) for h, (image_id, _) in zip(hashes, batch)])
+
+    conn.execute(f"UPDATE images SET duplicate_of = NULL WHERE 1 {species_filter}", params)
+    rows = conn.execute(f"SELECT species_id, id, dhash, content_hash FROM images WHERE dhash IS NOT NULL {species_filter}"
+                        " ORDER BY species_id, id", params).fetchall()
+    duplicates = []
+    start = 0
+    while start < len(rows):
+        end = start
+        while end < len(rows) and rows[end][0] == rows[start][0]:
+            end += 1
+        group = rows[start:end]
+        start = end
+        if len(group) < 2:
+            continue
+        ids = [image_id for _, image_id, _, _ in group]
+        hashes = np.array([dhash for _, _, dhash, _ in group], dtype=np.int64).view(np.uint64)
+        distances = hamming_matrix(hashes)
+        kept = []
+        for i in range(len(group)):
+            content_hash = group[i][3]
+            match = next((k for k in kept if distances[i, k] <= threshold
+                          or (content_hash is not None and content_hash == group[k][3])), None)
+            if match is None:
+                kept.append(i)
+            else:
+                duplicates.append((ids[match], ids[i]))
+    conn.executemany("UPDATE images SET duplicate_of = ? WHERE id = ?", duplicates)
+    return len(missing), len(duplicates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed media store")
+    parser.add_argument("--threshold", type=int, default=DUPLICATE_DISTANCE,
+                        help="Max dHash bit distance for two photos of a species to count as duplicates")
+    args = parser.parse_args()
+    with db.DBWriter() as writer:
+        adopted = writer.submit(adopt_existing).result()
+        hashed, duplicates = writer.submit(lambda conn: index_duplicates(conn, args.threshold)).result()
+    print(f"Adopted {adopted} files into {STORE_ROOT}; hashed {hashed} images; {duplicates} near-duplicate photos flagged")
+
+
+if __name__ == "__main__":
+    main()
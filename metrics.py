@@ -0,0 +1,333 @@
+"""
+Process-wide counters and latency histograms, run reports, profiling and a progress bar.
+
+    metrics.inc("http_requests_total", host=host, status=200)
+    metrics.observe("http_request_seconds", elapsed, host=host)
+
+Every script takes the same reporting options (see add_arguments) and wraps its
+work in `with metrics.instrumented(args, "fetch"):`, which starts the optional
+profiler and writes the JSON report (and Prometheus textfile) on the way out.
+"""
+import bisect
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+REPORT_DIR = "reports"
+# Upper bounds in seconds; covers sub-millisecond DB batches up to slow downloads
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+PROGRESS_INTERVAL = 0.1  # seconds between progress bar redraws
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(float)  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> Histogram
+_progress = None  # the progress bar currently on screen, if any
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the largest value seen for the overflow bucket)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return round(min(bound, self.max), 6)
+        return round(self.max, 6)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.add(value)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _label_str(labels):
+    return ",".join(f"{k}={v}" for k, v in labels)
+
+
+def snapshot():
+    """Counters and histogram summaries as plain dicts, grouped by metric name."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (h.count, h.sum, h.max, h.quantile(0.5), h.quantile(0.95), list(h.counts))
+                      for key, h in _histograms.items()}
+    report = {"counters": {}, "histograms": {}}
+    for (name, labels), value in sorted(counters.items()):
+        report["counters"].setdefault(name, {})[_label_str(labels) or "total"] = round(value, 6)
+    for (name, labels), (count, total, peak, p50, p95, _) in sorted(histograms.items()):
+        report["histograms"].setdefault(name, {})[_label_str(labels) or "total"] = {
+            "count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else None,
+            "p50": p50, "p95": p95, "max": round(peak, 6)}
+    return report
+
+
+def write_json(path, stage, elapsed, extra=None):
+    report = {"stage": stage, "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "wall_s": round(elapsed, 3)}
+    report.update(snapshot())
+    if extra:
+        report.update(extra)
+    _atomic_write(path, json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def prometheus_text(stage):
+    """Metrics in the Prometheus text exposition format, for node_exporter's textfile collector."""
+    def fmt(labels):
+        labels = (("stage", stage),) + labels
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (h.count, h.sum, list(h.counts))) for key, h in _histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        metric = f"birds_{name}"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{fmt(labels)} {value}")
+    for (name, labels), (count, total, counts) in histograms:
+        metric = f"birds_{name}"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        cumulative = 0
+        for bound, bucket_count in zip(list(BUCKETS) + ["+Inf"], counts):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{metric}_sum{fmt(labels)} {total}")
+        lines.append(f"{metric}_count{fmt(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _atomic_write(path, text):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# --- profiling ---
+
+class StackSampler(threading.Thread):
+    """
+    Samples every thread's Python stack at a fixed interval and writes them in
+    collapsed-stack format ("a;b;c count" per line), ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, path, interval=SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._done.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        _atomic_write(self.path, "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+
+
+@contextlib.contextmanager
+def profiled(kind, path):
+    """Run the body under cProfile (stats to path, top functions printed) or the stack sampler (collapsed stacks to path)."""
+    if kind == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            profiler.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+            print(out.getvalue())
+            print(f"cProfile stats written to {path}")
+    elif kind == "sample":
+        sampler = StackSampler(path)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            print(f"{sum(sampler.stacks.values())} stack samples written to {path}")
+    else:
+        yield
+
+
+# --- command-line integration ---
+
+def add_arguments(parser):
+    group = parser.add_argument_group("metrics and profiling")
+    group.add_argument("--report", help=f"JSON run report path (default: {REPORT_DIR}/<stage>.json)")
+    group.add_argument("--prometheus", help="Also write metrics in Prometheus textfile format to this path")
+    group.add_argument("--profile", choices=("cprofile", "sample"), help="Profile the run with cProfile or a stack sampler")
+    group.add_argument("--profile-out", help=f"Profile output path (default: {REPORT_DIR}/<stage>.prof or .folded)")
+    group.add_argument("--no-progress", action="store_true", help="Don't draw progress bars")
+
+
+@contextlib.contextmanager
+def instrumented(args, stage):
+    """Profile the body if asked, then write the run report (and Prometheus textfile)."""
+    global _progress_enabled
+    _progress_enabled = not getattr(args, "no_progress", False)
+    profile = getattr(args, "profile", None)
+    profile_out = getattr(args, "profile_out", None) or os.path.join(
+        REPORT_DIR, f"{stage}.{'prof' if profile == 'cprofile' else 'folded'}")
+    start = time.perf_counter()
+    try:
+        with profiled(profile, profile_out):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("stage_seconds", elapsed, stage=stage)
+        report_path = getattr(args, "report", None) or os.path.join(REPORT_DIR, f"{stage}.json")
+        write_json(report_path, stage, elapsed)
+        print(f"Run report written to {report_path}")
+        if getattr(args, "prometheus", None):
+            _atomic_write(args.prometheus, prometheus_text(stage))
+
+
+# --- progress ---
+
+_progress_enabled = True
+
+
+class Progress:
+    """
+    A single-line progress bar on stderr (only when it is a terminal); with
+    total=None it shows a running count instead of a bar:
+
+        progress = Progress(len(ids), "fetch")
+        progress.advance(failed=1)
+        progress.close()
+
+    Keyword counts passed to advance() are shown after the bar. Use echo() for
+    messages so they don't tear the bar.
+    """
+
+    def __init__(self, total, label):
+        global _progress
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.counts = collections.Counter()
+        self.start = time.perf_counter()
+        self._last_draw = 0.0
+        self.enabled = _progress_enabled and sys.stderr.isatty()
+        _progress = self
+
+    def advance(self, n=1, **counts):
+        self.done += n
+        self.counts.update(counts)
+        now = time.perf_counter()
+        if self.enabled and (now - self._last_draw >= PROGRESS_INTERVAL or self.done == self.total):
+            self._last_draw = now
+            self.draw()
+
+    def line(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        extra = "".join(f" {key}={value}" for key, value in sorted(self.counts.items()))
+        if self.total is None:
+            return f"{self.label} {self.done} {rate:.1f}/s{extra}"
+        width = 30
+        filled = min(width, int(width * self.done / self.total)) if self.total else width
+        eta = max(0, self.total - self.done) / rate if rate and self.total else 0.0
+        return (f"{self.label} [{'#' * filled}{'.' * (width - filled)}] {self.done}/{self.total} "
+                f"{rate:.1f}/s eta {eta:.0f}s{extra}")
+
+    def draw(self):
+        sys.stderr.write("\r\033[K" + self.line())
+        sys.stderr.flush()
+
+    def clear(self):
+        if self.enabled:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+
+    def close(self):
+        global _progress
+        if self.enabled:
+            self.clear()
+        if _progress is self:
+            _progress = None
+        print(self.line())
+
+
+def echo(message):
+    """print() that keeps any progress bar intact."""
+    progress = _progress
+    if progress is not None and progress.enabled:
+        progress.clear()
+        print(message, flush=True)
+        progress.draw()
+    else:
+        print(message)
@@ -0,0 +1,327 @@
+"""
+Re-encode deck photos to fit a byte budget per image, or a target deck size.
+
+For every photo the search tries JPEG (progressive, optimized Huffman tables)
+and WebP, and PNG only when the image really uses transparency. It binary-searches
+the highest quality that fits the budget. A candidate only counts if its SSIM
+against the current file stays above a floor. If nothing fits without breaking the
+floor, the smallest encoding that keeps the floor wins. No encoding keeps EXIF or
+ICC metadata. Results are stored by source content hash and settings, so each
+photo is only searched once per setting.
+
+The chosen files are recorded as the "<profile>-optimized" image variant, which
+generate_anki_deck prefers over the plain images.
+"""
+import argparse
+import concurrent.futures
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+import db
+import generate_anki_deck as deck
+import media_store
+import metrics
+from db import DBWriter
+
+MIN_SSIM = 0.93  # perceptual floor; below this an encoding is visibly worse than the source
+MIN_QUALITY = 20
+MAX_QUALITY = 95
+SSIM_BLOCK = 8
+FORMATS = ("JPEG", "WEBP")
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+
+def luma(img):
+    return np.asarray(img.convert("L"), dtype=np.float32)
+
+
+def ssim(a, b, block=SSIM_BLOCK):
+    """Mean SSIM of two equally sized luma arrays over non-overlapping block x block windows."""
+    h, w = a.shape[0] // block * block, a.shape[1] // block * block
+    if not h or not w:
+        return float(np.array_equal(a, b))
+
+    def windows(x):
+        return x[:h, :w].reshape(h // block, block, w // block, block).swapaxes(1, 2).reshape(-1, block * block)
+
+    x, y = windows(a), windows(b)
+    mx, my = x.mean(axis=1), y.mean(axis=1)
+    vx, vy = x.var(axis=1), y.var(axis=1)
+    cov = ((x - mx[:, None]) * (y - my[:, None])).mean(axis=1)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    scores = (2 * mx * my + c1) * (2 * cov + c2) / ((mx ** 2 + my ** 2 + c1) * (vx + vy + c2))
+    return float(scores.mean())
+
+
+def uses_alpha(img):
+    return "A" in img.getbands() and img.getchannel("A").getextrema()[0] < 255
+
+
+def encode(img, fmt, quality):
+    """Encoded bytes; nothing but pixels is written (no EXIF, ICC profile or comments)."""
+    out = io.BytesIO()
+    if fmt == "JPEG":
+        img.convert("RGB" if img.mode != "L" else "L").save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "WEBP":
+        img.save(out, "WEBP", quality=quality, method=6)
+    else:
+        img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def score(data, reference):
+    with Image.open(io.BytesIO(data)) as img:
+        return ssim(luma(img), reference)
+
+
+def search(img, fmt, budget, reference, min_ssim):
+    """
+    Best encoding in one format: (data, quality, ssim, fits), or None if even
+    MAX_QUALITY stays under the SSIM floor.
+    """
+    if fmt == "PNG":
+        data = encode(img, fmt, None)
+        return data, None, 1.0, len(data) <= budget
+    # Highest quality that fits the budget
+    lo, hi, fitting = MIN_QUALITY, MAX_QUALITY, None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = encode(img, fmt, quality)
+        if len(data) <= budget:
+            fitting, lo = (data, quality), quality + 1
+        else:
+            hi = quality - 1
+    if fitting is not None:
+        similarity = score(fitting[0], reference)
+        if similarity >= min_ssim:
+            return fitting[0], fitting[1], similarity, True
+    # Nothing fits above the floor: the lowest quality that still keeps it
+    lo, hi, best = (fitting[1] + 1 if fitting else MIN_QUALITY), MAX_QUALITY, None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = encode(img, fmt, quality)
+        similarity = score(data, reference)
+        if similarity >= min_ssim:
+            best, hi = (data, quality, similarity, False), quality - 1
+        else:
+            lo = quality + 1
+    return best
+
+
+def optimize(source_path, dest_base, budget, min_ssim=MIN_SSIM, formats=FORMATS):
+    """
+    Runs in a worker process. Writes the chosen encoding to dest_base + its
+    extension, unless the source itself is the best choice. Returns
+    (dest_path or None, format, quality, bytes, ssim, fits_budget, seconds).
+    """
+    start = time.process_time()
+    source_bytes = os.path.getsize(source_path)
+    with Image.open(source_path) as img:
+        img.load()
+        source_format = img.format
+        if source_bytes <= budget:
+            return None, source_format, None, source_bytes, 1.0, True, time.process_time() - start
+        reference = luma(img)
+        alpha = uses_alpha(img)
+        if not alpha and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        candidates = []
+        for fmt in ("PNG", "WEBP") if alpha else formats:
+            result = search(img, fmt, budget, reference, min_ssim)
+            if result is not None:
+                candidates.append((fmt, *result))
+    fitting = [c for c in candidates if c[4]]
+    if fitting:
+        # Within budget: the most faithful, then the smallest
+        fmt, data, quality, similarity, fits = max(fitting, key=lambda c: (c[3], -len(c[1])))
+    elif candidates:
+        fmt, data, quality, similarity, fits = min(candidates, key=lambda c: len(c[1]))
+    else:
+        fmt = None
+    if fmt is None or len(data) >= source_bytes:
+        return None, source_format, None, source_bytes, 1.0, False, time.process_time() - start
+    dest_path = dest_base + EXTENSIONS[fmt]
+    with open(dest_path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(dest_path + ".tmp", dest_path)
+    return dest_path, fmt, quality, len(data), similarity, fits, time.process_time() - start
+
+
+def settings_key(budget, min_ssim, formats):
+    return f"{budget}B/ssim{min_ssim}/{'+'.join(formats)}"
+
+
+def deck_budget(catalog, deck_bytes):
+    """Per-image budget that makes the master deck fit deck_bytes next to its sounds."""
+    sounds = {path for species in catalog.species.values() for path in species.sound_paths}
+    images = {image.file_path for image in catalog.images()}
+    if not images:
+        return None
+    room = deck_bytes - sum(os.path.getsize(path) for path in sounds)
+    if room <= 0:
+        raise SystemExit(f"The deck's sounds alone take {(deck_bytes - room) / 1e6:.1f} MB")
+    return room // len(images)
+
+
+def source_images(conn, profile):
+    """{source file: [image ids]} for the photos a profile's decks use (before optimization)."""
+    variant = deck.DECK_PROFILES[profile][0]
+    rows = conn.execute("""
+        SELECT i.id, COALESCE(v.file_path, i.file_path) FROM images i
+        LEFT JOIN image_variants v ON v.image_id = i.id AND v.variant = ?
+        WHERE i.file_path IS NOT NULL AND i.file_path != '' AND i.duplicate_of IS NULL
+    """, (variant,)).fetchall()
+    sources = {}
+    for image_id, path in rows:
+        sources.setdefault(path, []).append(image_id)
+    return sources
+
+
+def source_hash(path):
+    # Store files are named by their content hash
+    if media_store.in_store(path):
+        return os.path.splitext(os.path.basename(path))[0]
+    return media_store.hash_file(path).hexdigest()
+
+
+class ImageOptimizer:
+    """
+    Searches encodings for every photo of a deck profile and points the
+    profile's optimized variant at the results:
+
+        optimizer = ImageOptimizer(budget=40_000)
+        with DBWriter() as writer, ProcessPoolExecutor() as pool:
+            optimizer.run(writer, pool)
+    """
+
+    def __init__(self, budget, min_ssim=MIN_SSIM, formats=FORMATS, profile=deck.DEFAULT_PROFILE):
+        self.budget = budget
+        self.min_ssim = min_ssim
+        self.formats = formats
+        self.profile = profile
+        self.variant = deck.optimized_variant(profile)
+        self.settings = settings_key(budget, min_ssim, formats)
+        self.report = {"images": 0, "cached": 0, "searched": 0, "kept": 0, "over_budget": 0,
+                       "source_bytes": 0, "output_bytes": 0}
+
+    def run(self, writer, pool):
+        conn = db.connect()
+        try:
+            sources = {path: ids for path, ids in source_images(conn, self.profile).items() if os.path.exists(path)}
+            hashes = {path: source_hash(path) for path in sources}
+            cached = {row[0]: row[1:] for row in conn.execute(
+                "SELECT source_hash, file_path, bytes FROM image_encodings WHERE settings = ?", (self.settings,))
+                if os.path.exists(row[1])}
+        finally:
+            conn.close()
+        os.makedirs(media_store.TMP_ROOT, exist_ok=True)
+        progress = metrics.Progress(len(sources), "optimize")
+
+        def record(path, chosen, size):
+            variant = (chosen, *image_size(chosen), size)
+            for image_id in sources[path]:
+                writer.submit(lambda c, image_id=image_id: media_store.set_variant(c, image_id, self.variant, variant))
+            self.report["images"] += 1
+            self.report["source_bytes"] += os.path.getsize(path)
+            self.report["output_bytes"] += size
+
+        futures = {}
+        for path in sources:
+            content_hash = hashes[path]
+            if content_hash in cached:
+                chosen, size = cached[content_hash]
+                record(path, chosen, size)
+                self.report["cached"] += 1
+                metrics.inc("optimize_images_total", result="cached")
+                progress.advance(cached=1)
+                continue
+            dest_base = os.path.join(media_store.TMP_ROOT, f"opt_{content_hash}")
+            futures[pool.submit(optimize, path, dest_base, self.budget, self.min_ssim, self.formats)] = path
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                dest, fmt, quality, size, similarity, fits, seconds = future.result()
+            except (OSError, ValueError) as e:
+                metrics.echo(f"Could not optimize {path}: {e}")
+                progress.advance(failed=1)
+                continue
+            chosen = media_store.add(dest) if dest else path
+            writer.execute("INSERT OR REPLACE INTO image_encodings (source_hash, settings, file_path, format, quality, bytes, ssim)"
+                           " VALUES (?, ?, ?, ?, ?, ?, ?)", (hashes[path], self.settings, chosen, fmt, quality, size, similarity))
+            record(path, chosen, size)
+            result = "kept" if dest is None else "searched"
+            self.report[result] += 1
+            self.report["over_budget"] += not fits
+            metrics.inc("optimize_images_total", result=result if fits else "over_budget")
+            metrics.observe("optimize_search_seconds", seconds)
+            progress.advance(**{result: 1})
+        progress.close()
+
+    def summary(self):
+        r = self.report
+        return (f"Image optimizer ({self.settings}): {r['images']} photos, {r['searched']} re-encoded, {r['kept']} kept as is, "
+                f"{r['cached']} from cache, {r['over_budget']} over budget to keep SSIM >= {self.min_ssim}; "
+                f"{r['source_bytes'] / 1e6:.1f} MB -> {r['output_bytes'] / 1e6:.1f} MB")
+
+
+def image_size(path):
+    with Image.open(path) as img:
+        return img.size
+
+
+def clear(writer, variant):
+    """Drop a profile's optimized variant rows so decks go back to the plain images."""
+    def drop(conn):
+        for (image_id,) in conn.execute("SELECT image_id FROM image_variants WHERE variant = ?", (variant,)).fetchall():
+            media_store.set_variant(conn, image_id, variant, None)
+    writer.submit(drop).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encode deck photos to fit a size budget")
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--image-kb", type=float, help="Byte budget per photo")
+    budget.add_argument("--deck-mb", type=float, help="Target size of the master deck; sounds are counted first")
+    budget.add_argument("--clear", action="store_true", help="Forget the optimized encodings of this profile")
+    parser.add_argument("--min-ssim", type=float, default=MIN_SSIM, help="Perceptual floor an encoding must keep")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Lossy formats to try (JPEG, WEBP)")
+    parser.add_argument("--deck-profile", choices=sorted(deck.DECK_PROFILES), default=deck.DEFAULT_PROFILE,
+                        help="Which deck profile's photos to optimize")
+    parser.add_argument("--workers", type=int, help="Encoder processes (default: CPU count)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "optimize"):
+        run(args)
+
+
+def run(args):
+    if args.clear:
+        with DBWriter() as writer:
+            clear(writer, deck.optimized_variant(args.deck_profile))
+        print(f"Cleared the {deck.optimized_variant(args.deck_profile)} variant")
+        return
+    formats = tuple(fmt.strip().upper() for fmt in args.formats.split(",") if fmt.strip())
+    if not formats or set(formats) - set(FORMATS):
+        raise SystemExit(f"--formats must be a subset of {', '.join(FORMATS)}")
+    if args.image_kb:
+        budget = int(args.image_kb * 1000)
+    else:
+        budget = deck_budget(deck.load_catalog(args.deck_profile, optimized=False), int(args.deck_mb * 1e6))
+        if budget is None:
+            print("No photos to optimize.")
+            return
+        print(f"Deck target {args.deck_mb} MB -> {budget / 1000:.1f} kB per photo")
+
+    optimizer = ImageOptimizer(budget, args.min_ssim, formats, args.deck_profile)
+    with DBWriter() as writer, concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        optimizer.run(writer, pool)
+    print(optimizer.summary())
+    print(f"DB writer: {writer.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+In-process pipeline: discover -> fetch -> media -> audio -> deck.
+
+All stages run in one process and one event loop, linked by bounded queues of
+(species_id, changed) items. A species moves on to media download as soon as
+its JSON is stored. A family deck is packaged as soon as every species in it
+is ready. Stages skip species whose inputs didn't change: the media ledger
+only holds unfinished downloads, the audio budget reruns only for new
+sounds, and deck fingerprints skip unchanged packages.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import sys
+import time
+
+import db
+import download_and_resize_media as media
+import fetch_and_store_species as fetch
+import generate_anki_deck as deck
+import image_quality
+import media_store
+import metrics
+import process_audio
+from catalog import UNKNOWN_FAMILY
+from db import DBWriter
+from discover_species_ids import VALID_IDS_FILE, SpeciesDiscovery, write_valid_ids
+from http_engine import API_HEADERS, FetchEngine
+from image_pipeline import ImagePipeline
+from response_cache import ResponseCache
+
+STAGES = ("discover", "fetch", "media", "audio", "deck")
+QUEUE_SIZE = 64  # species waiting between two stages
+# Concurrent species per stage; "images" is the resize process pool, "audio"/"deck" size their process pools.
+# Discovery chooses its own probes; the HTTP engine's per-host limit bounds its concurrency.
+WORKERS = {"fetch": 32, "media": 16, "images": None, "audio": 2, "deck": 2}
+DONE = None  # end-of-stream marker
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.changed = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def line(self, origin):
+        if self.started is None:
+            return f"  {self.name:<8} no items"
+        return (f"  {self.name:<8} {self.items:>5} items, {self.changed:>5} changed, busy {self.busy:7.2f}s, "
+                f"active {self.started - origin:6.2f}s -> {self.finished - origin:6.2f}s")
+
+
+async def run_stage(stats, handler, inbox, outbox, workers, progress):
+    """
+    Feed items from inbox through handler with `workers` concurrent consumers;
+    results go to outbox. Items that leave the pipeline here (dropped, or this
+    is the last stage) advance the progress bar.
+    """
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is DONE:
+                # Leave the marker for sibling workers
+                await inbox.put(DONE)
+                return
+            start = time.perf_counter()
+            if stats.started is None:
+                stats.started = start
+            result = await handler(item)
+            elapsed = time.perf_counter() - start
+            stats.busy += elapsed
+            stats.items += 1
+            metrics.observe("stage_item_seconds", elapsed, stage=stats.name)
+            progress.advance(int(result is None or outbox is None), **{stats.name: 1})
+            if result is not None:
+                stats.changed += result[1]
+                if outbox is not None:
+                    await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    stats.finished = time.perf_counter()
+    if outbox is not None:
+        await outbox.put(DONE)
+
+
+async def feed(items, outbox):
+    for item in items:
+        await outbox.put(item)
+    await outbox.put(DONE)
+
+
+def select_stages(only=None, start=None):
+    if only:
+        names = [name.strip() for name in only.split(",")]
+        unknown = set(names) - set(STAGES)
+        if unknown:
+            raise SystemExit(f"Unknown stage(s): {', '.join(sorted(unknown))}. Stages: {', '.join(STAGES)}")
+        return [stage for stage in STAGES if stage in names]
+    if start:
+        return list(STAGES[STAGES.index(start):])
+    # Like the old main.py: discovery only runs until the ID list exists
+    return [stage for stage in STAGES if stage != "discover" or not os.path.exists(VALID_IDS_FILE)]
+
+
+def species_families():
+    """family -> set of species ids, as currently stored."""
+    conn = db.connect()
+    families = {}
+    for species_id, family in conn.execute("SELECT id, family FROM species"):
+        families.setdefault(family or UNKNOWN_FAMILY, set()).add(species_id)
+    conn.close()
+    return families
+
+
+class Pipeline:
+    def __init__(self, stages, writer, cache, workers=WORKERS, incremental=False, force=False, deck_profile=deck.DEFAULT_PROFILE,
+                 max_images_per_species=None):
+        self.stages = stages
+        self.writer = writer
+        self.cache = cache
+        self.workers = workers
+        self.incremental = incremental
+        self.force = force
+        self.deck_profile = deck_profile
+        self.max_images_per_species = max_images_per_species
+        self.stats = {stage: StageStats(stage) for stage in stages}
+        self.valid_ids = []
+        self.discovery = None
+        self.fetched_ids = set()
+        self.stored_ids = fetch.stored_species_ids()
+        self.fetch_report = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0, "failed": 0, "media_added": 0, "media_removed": 0}
+        # Set once no stage can add species any more, so family membership is final
+        self.species_known = None
+        self.api_engine = FetchEngine(headers=API_HEADERS, timeout=fetch.REQUEST_TIMEOUT)
+        self.media_engine = FetchEngine(timeout=media.REQUEST_TIMEOUT)
+        self.images = ImagePipeline(workers=workers["images"])
+        self.downloader = None
+        self.budget = process_audio.AudioBudget(encoder=process_audio.find_encoder())
+        self.unbudgeted = set()
+        self.deck_built = []
+        self.deck_reused = []
+        self.audio_pool = None
+        self.deck_pool = None
+        self.origin = None
+        self.progress = None
+
+    # --- stage handlers: (species_id, changed) -> (species_id, changed) or None to drop ---
+
+    async def fetch(self, item):
+        species_id, _ = item
+        self.fetched_ids.add(species_id)
+        if self.incremental:
+            changed = await fetch.refresh_one(self.api_engine, species_id, self.cache, self.writer, self.stored_ids, self.fetch_report)
+        else:
+            changed = await fetch.fetch_and_store_one(self.api_engine, species_id, self.writer, self.stored_ids, self.cache)
+        return species_id, changed
+
+    async def media(self, item):
+        species_id, changed = item
+        states = media.task_states(self.incremental)
+
+        def species_tasks(conn):
+            media.sync_ledger(conn, species_id=species_id)
+            return media.ledger_tasks(conn, states, species_id)
+
+        tasks = await asyncio.wrap_future(self.writer.submit(species_tasks))
+        outcomes = await asyncio.gather(*(self.downloader.process_task(task) for task in tasks))
+        await asyncio.wrap_future(self.writer.submit(lambda conn: media_store.index_duplicates(conn, species_ids=[species_id])))
+        await asyncio.wrap_future(self.writer.submit(lambda conn: image_quality.score_images(conn, species_ids=[species_id])))
+        return species_id, changed or "saved" in outcomes
+
+    async def audio(self, item):
+        species_id, changed = item
+        if changed or self.force or species_id in self.unbudgeted:
+            # The budget reads through its own connection; make this species' sounds visible first
+            await asyncio.to_thread(self.writer.flush)
+            await asyncio.to_thread(self.budget.run, self.writer, self.audio_pool, [species_id])
+        return item
+
+    async def discover(self, outbox):
+        """Discover stage: passes each valid ID on as soon as discovery finds it."""
+        stats = self.stats["discover"]
+        stats.started = time.perf_counter()
+
+        async def on_valid(species_id):
+            stats.items += 1
+            stats.changed += 1
+            self.progress.advance(int(outbox is None), discover=1)
+            if outbox is not None:
+                await outbox.put((species_id, True))
+
+        self.discovery = SpeciesDiscovery(self.api_engine, self.cache, on_valid=on_valid, show_progress=False)
+        self.valid_ids = await self.discovery.run()
+        stats.finished = time.perf_counter()
+        stats.busy = stats.finished - stats.started
+        if outbox is not None:
+            await outbox.put(DONE)
+
+    async def package(self, inbox):
+        """Deck stage: package each family once all its species are ready, then the master deck."""
+        stats = self.stats["deck"]
+        ready, packaged, futures = set(), set(), []
+        families = None
+
+        async def submit(family_names):
+            start = time.perf_counter()
+            await asyncio.to_thread(self.writer.flush)
+            catalog = await asyncio.to_thread(deck.load_catalog, self.deck_profile, True, self.max_images_per_species)
+            if family_names is not None:
+                jobs = deck.family_jobs(catalog, family_names, self.deck_profile)
+            else:
+                jobs = [deck.master_job(catalog, self.deck_profile)]
+            for job in jobs:
+                future = deck.submit_package(self.deck_pool, job, self.force)
+                if future is None:
+                    self.deck_reused.append(job[4])
+                else:
+                    futures.append(asyncio.wrap_future(future))
+            stats.busy += time.perf_counter() - start
+
+        finished = False
+        while not finished:
+            batch = [await inbox.get()]
+            # Take whatever else is already waiting so one catalog load covers several species
+            while not inbox.empty():
+                batch.append(inbox.get_nowait())
+            finished = DONE in batch
+            for item in batch:
+                if item is not DONE:
+                    stats.started = stats.started or time.perf_counter()
+                    stats.items += 1
+                    stats.changed += item[1]
+                    ready.add(item[0])
+                    self.progress.advance(deck=1)
+            if families is None and (self.species_known.is_set() or finished):
+                families = await asyncio.to_thread(species_families)
+            if families is None:
+                continue
+            complete = [family for family, ids in families.items()
+                        if family not in packaged and (ids <= ready or finished)]
+            if complete:
+                packaged.update(complete)
+                await submit(complete)
+        await submit(None)
+        self.deck_built = await asyncio.gather(*futures)
+        stats.started = stats.started or time.perf_counter()
+        stats.finished = time.perf_counter()
+
+    # --- wiring ---
+
+    def source_items(self):
+        first = self.stages[0]
+        if first == "fetch":
+            with open(VALID_IDS_FILE, encoding="utf-8") as f:
+                return [(int(line.strip()), False) for line in f if line.strip().isdigit()]
+        return [(species_id, False) for species_id in sorted(self.stored_ids)]
+
+    async def run(self):
+        self.species_known = asyncio.Event()
+        if not {"discover", "fetch"} & set(self.stages):
+            self.species_known.set()
+        queues = [asyncio.Queue(QUEUE_SIZE) for _ in self.stages]
+        tasks = []
+        if self.stages[0] == "discover":
+            # Discovery finds its own IDs, so the number of species isn't known up front
+            self.progress = metrics.Progress(None, "species")
+        else:
+            items = self.source_items()
+            self.progress = metrics.Progress(len(items), "species")
+            tasks.append(asyncio.ensure_future(feed(items, queues[0])))
+        for i, stage in enumerate(self.stages):
+            inbox = queues[i]
+            outbox = queues[i + 1] if i + 1 < len(self.stages) else None
+            if stage == "discover":
+                tasks.append(asyncio.ensure_future(self.after_stage(stage, self.discover(outbox))))
+            elif stage == "deck":
+                tasks.append(asyncio.ensure_future(self.package(inbox)))
+            else:
+                tasks.append(asyncio.ensure_future(self.after_stage(
+                    stage, run_stage(self.stats[stage], getattr(self, stage), inbox, outbox, self.workers[stage], self.progress))))
+        async with self.api_engine, self.media_engine, self.images:
+            await asyncio.gather(*tasks)
+        self.progress.close()
+
+    async def after_stage(self, stage, coro):
+        await coro
+        if stage == "discover":
+            write_valid_ids(self.valid_ids)
+            metrics.echo(f"{len(self.valid_ids)} valid species IDs saved to {VALID_IDS_FILE}")
+        if stage == "fetch" and self.incremental:
+            gone = self.stored_ids - self.fetched_ids
+            self.writer.submit(lambda conn: fetch.delete_species(conn, gone))
+            self.fetch_report["removed"] += len(gone)
+        if stage == "fetch" or (stage == "discover" and "fetch" not in self.stages):
+            self.species_known.set()
+
+    def start(self):
+        """Run the selected stages; returns the wall time in seconds."""
+        if "media" in self.stages:
+            os.makedirs(media_store.TMP_ROOT, exist_ok=True)
+            added, removed = self.writer.submit(lambda conn: media.sync_ledger(conn, force=self.force)).result()
+            print(f"Media ledger: {added} new items, {removed} removed")
+            adopted = self.writer.submit(media_store.adopt_existing).result()
+            if adopted:
+                print(f"Moved {adopted} previously downloaded files into {media_store.STORE_ROOT}")
+            conn = db.connect()
+            self.downloader = media.MediaDownloader(self.media_engine, self.images, self.writer, conn)
+            conn.close()
+        if "audio" in self.stages:
+            conn = db.connect()
+            self.unbudgeted = {row[0] for row in conn.execute(
+                "SELECT DISTINCT species_id FROM sounds WHERE file_path IS NOT NULL AND selected IS NULL")}
+            conn.close()
+        self.origin = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers["audio"]) as self.audio_pool, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=self.workers["deck"]) as self.deck_pool:
+            asyncio.run(self.run())
+        if self.downloader is not None:
+            self.downloader.save_validators()
+        return time.perf_counter() - self.origin
+
+    def print_report(self, elapsed):
+        print("\nStage report:")
+        for stage in self.stages:
+            print(self.stats[stage].line(self.origin))
+        if self.discovery is not None:
+            print(self.discovery.summary())
+        if "fetch" in self.stages and self.incremental:
+            print("Fetch report: " + ", ".join(f"{key}={value}" for key, value in self.fetch_report.items()))
+        if self.downloader is not None:
+            report = self.downloader.report
+            print("Media report: " + ", ".join(f"{key}={report[key]}" for key in ("added", "changed", "unchanged", "failed")))
+            print(f"Image pipeline: {self.images.report()}")
+        if "audio" in self.stages:
+            print(self.budget.summary())
+        if "deck" in self.stages:
+            stats = self.stats["deck"]
+            deck.print_report(self.deck_built, self.deck_reused, stats.finished - stats.started)
+        spans = sum(s.finished - s.started for s in self.stats.values() if s.started is not None)
+        print(f"Pipeline wall time {elapsed:.2f}s (sum of stage spans {spans:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the whole birds-of-Israel pipeline in one process")
+    parser.add_argument("--only", help=f"Comma-separated stages to run ({', '.join(STAGES)})")
+    parser.add_argument("--from", dest="start", choices=STAGES, help="Run this stage and everything after it")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Revalidate stored species and finished media with conditional requests")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-download all media, re-apply the audio budget and rebuild every deck")
+    parser.add_argument("--deck-profile", choices=sorted(deck.DECK_PROFILES), default=deck.DEFAULT_PROFILE,
+                        help="Device profile the decks are built for (image variant and file names)")
+    parser.add_argument("--max-images-per-species", type=int, metavar="N",
+                        help="Decks keep only the N best-scoring photos of each species")
+    for stage, default in WORKERS.items():
+        parser.add_argument(f"--{stage}-workers", type=int, default=default,
+                            help=f"Concurrency of the {stage} stage (default: {default or 'CPU count'})")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.only and args.start:
+        parser.error("--only and --from are mutually exclusive")
+
+    stages = select_stages(args.only, args.start)
+    if stages and stages[0] == "fetch" and not os.path.exists(VALID_IDS_FILE):
+        print(f"Missing {VALID_IDS_FILE}. Run with --from discover first.")
+        sys.exit(1)
+    workers = {stage: getattr(args, f"{stage}_workers") for stage in WORKERS}
+    print(f"Running stages: {' -> '.join(stages)}")
+
+    with metrics.instrumented(args, "pipeline"), ResponseCache() as cache, DBWriter() as writer:
+        pipeline = Pipeline(stages, writer, cache, workers, args.incremental, args.force, args.deck_profile,
+                            args.max_images_per_species)
+        elapsed = pipeline.start()
+    pipeline.print_report(elapsed)
+    print(f"DB writer: {writer.stats()}")
+    print("\nAll steps completed successfully.")
+
+
+if __name__ == "__main__":
+    main()
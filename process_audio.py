@@ -0,0 +1,332 @@
+"""
+Keep the APKG small enough to sync: pick the best few recordings per species
+within a seconds/bytes budget and cut each to a short clip.
+
+Duration and bitrate come from walking the MP3 frame headers, so nothing is
+decoded. Clips are cut at frame boundaries, and re-encoded to a lower bitrate
+when ffmpeg or lame is installed. Probe results and clips are recorded in the
+DB by source content hash, so each file is only processed once per setting.
+"""
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import threading
+
+import db
+import media_store
+import metrics
+from db import DBWriter
+
+MAX_SOUNDS = 3  # recordings kept per species
+CLIP_SECONDS = 20  # each kept recording is cut to at most this long
+MAX_SPECIES_SECONDS = 45  # total clip time per species
+MAX_SPECIES_BYTES = 1_000_000  # total clip size per species
+MIN_SECONDS = 3  # shorter recordings are only used if nothing better exists
+TARGET_BITRATE = 64  # kbps for re-encoded clips; 0 keeps the source bitrate
+
+# (version, layer) -> bitrates in kbps by header index; version 1 is MPEG-1, 2 is MPEG-2 and 2.5
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def parse_frame_header(data, offset):
+    """Return (frame_length, seconds) for a valid MPEG audio frame header at offset, else None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2 = data[offset + 1], data[offset + 2]
+    version_bits = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    version = 1 if version_bits == 3 else 2
+    bitrate = BITRATES[(version, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][rate_index]
+    samples = 384 if layer == 1 else 576 if layer == 3 and version == 2 else 1152
+    padding = (b2 >> 1) & 1
+    length = samples // 8 * bitrate // sample_rate + padding * (4 if layer == 1 else 1)
+    return length, samples / sample_rate
+
+
+def id3_size(data):
+    """Bytes taken by a leading ID3v2 tag (0 if there is none)."""
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+def mp3_frames(data):
+    """
+    (offset, length, seconds) for every audio frame. Garbage between frames is
+    skipped by resyncing, and a first frame only counts if another one follows
+    it, so stray 0xFF bytes in leftover tags aren't mistaken for audio. A
+    Xing/Info header frame is dropped: it describes the whole file, not a clip.
+    """
+    frames = []
+    offset = id3_size(data)
+    while offset < len(data) - 4:
+        header = parse_frame_header(data, offset)
+        if header is None or (not frames and offset + header[0] < len(data)
+                              and parse_frame_header(data, offset + header[0]) is None):
+            offset += 1
+            continue
+        length, seconds = header
+        if offset + length > len(data):
+            break
+        if frames or not (b"Xing" in data[offset:offset + 64] or b"Info" in data[offset:offset + 64]):
+            frames.append((offset, length, seconds))
+        offset += length
+    return frames
+
+
+def probe(path):
+    """Runs in a worker process. Returns (duration_s, average_kbps); raises ValueError if path has no MP3 frames."""
+    with open(path, "rb") as f:
+        data = f.read()
+    frames = mp3_frames(data)
+    duration = sum(seconds for _, _, seconds in frames)
+    if not duration:
+        raise ValueError("no MPEG audio frames")
+    return duration, round(sum(length for _, length, _ in frames) * 8 / duration / 1000)
+
+
+def find_encoder():
+    """Name of an installed MP3 encoder we know how to drive, or None."""
+    for name in ("ffmpeg", "lame"):
+        if shutil.which(name):
+            return name
+    return None
+
+
+def encode(encoder, source_path, dest_path, bitrate):
+    if encoder == "ffmpeg":
+        cmd = ["ffmpeg", "-v", "error", "-y", "-i", source_path, "-map_metadata", "-1",
+               "-codec:a", "libmp3lame", "-b:a", f"{bitrate}k", "-f", "mp3", dest_path]
+    else:
+        cmd = ["lame", "--silent", "--mp3input", "-b", str(bitrate), source_path, dest_path]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+
+def make_clip(source_path, dest_path, seconds=CLIP_SECONDS, bitrate=TARGET_BITRATE, encoder=None):
+    """
+    Runs in a worker process. Copy whole frames from the start of source_path
+    until the clip is `seconds` long, then re-encode to `bitrate` kbps if an
+    encoder is given and it would shrink the file. Returns (clip_seconds, bytes).
+    """
+    with open(source_path, "rb") as f:
+        data = f.read()
+    frames = mp3_frames(data)
+    kept, total = [], 0.0
+    for offset, length, frame_seconds in frames:
+        if total >= seconds:
+            break
+        kept.append(data[offset:offset + length])
+        total += frame_seconds
+    if not kept:
+        raise ValueError("no MPEG audio frames")
+    tmp_path = dest_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(kept))
+    source_kbps = sum(map(len, kept)) * 8 / total / 1000
+    if encoder and bitrate and source_kbps > bitrate * 1.1:
+        encoded_path = dest_path + ".enc"
+        try:
+            encode(encoder, tmp_path, encoded_path, bitrate)
+            os.replace(encoded_path, tmp_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Keep the frame-trimmed clip rather than failing the sound
+            print(f"Re-encode failed for {source_path}: {e}")
+    os.replace(tmp_path, dest_path)
+    return total, os.path.getsize(dest_path)
+
+
+def settings_key(seconds, bitrate, encoder):
+    return f"{seconds}s/" + (f"{bitrate}k" if encoder and bitrate else "source")
+
+
+def select_sounds(sounds, max_sounds=MAX_SOUNDS, clip_seconds=CLIP_SECONDS, max_seconds=MAX_SPECIES_SECONDS,
+                  max_bytes=MAX_SPECIES_BYTES, bitrate=None):
+    """
+    Choose which of one species' sounds to keep. sounds is a list of
+    (sound_id, duration, source_kbps) in the order birds.org.il lists them;
+    recordings of at least MIN_SECONDS come first, then higher source
+    bitrate, then listing order. bitrate is the clip bitrate if re-encoding.
+    Returns the kept sound ids.
+    """
+    ranked = sorted(enumerate(sounds), key=lambda item: (item[1][1] < min(MIN_SECONDS, clip_seconds), -item[1][2], item[0]))
+    kept, total_seconds, total_bytes = [], 0.0, 0
+    for _, (sound_id, duration, source_kbps) in ranked:
+        if len(kept) >= max_sounds:
+            break
+        seconds = min(duration, clip_seconds)
+        size = seconds * min(source_kbps, bitrate or source_kbps) * 1000 / 8
+        # Always keep one recording per species, even if it alone exceeds the budget
+        if kept and (total_seconds + seconds > max_seconds or total_bytes + size > max_bytes):
+            continue
+        kept.append(sound_id)
+        total_seconds += seconds
+        total_bytes += size
+    return kept
+
+
+class AudioBudget:
+    """
+    Probe, select and clip sounds under one set of budget settings:
+
+        budget = AudioBudget(clip_seconds=20)
+        with DBWriter() as writer, ProcessPoolExecutor() as pool:
+            budget.run(writer, pool)
+
+    run() reads through its own connection, so call writer.flush() first if
+    the sounds it should see were only just queued.
+    """
+
+    def __init__(self, max_sounds=MAX_SOUNDS, clip_seconds=CLIP_SECONDS, max_species_seconds=MAX_SPECIES_SECONDS,
+                 max_species_bytes=MAX_SPECIES_BYTES, bitrate=TARGET_BITRATE, encoder=None):
+        self.max_sounds = max_sounds
+        self.clip_seconds = clip_seconds
+        self.max_species_seconds = max_species_seconds
+        self.max_species_bytes = max_species_bytes
+        self.bitrate = bitrate
+        self.encoder = encoder
+        self.settings = settings_key(clip_seconds, bitrate, encoder)
+        self.report = {"probed": 0, "sounds": 0, "kept": 0, "species": 0, "clipped": 0, "source_bytes": 0, "clip_bytes": 0}
+        self._lock = threading.Lock()  # run() may be called from several threads at once
+
+    def run(self, writer, pool, species_ids=None):
+        """Apply the budget to the given species (default: all)."""
+        conn = db.connect()
+        try:
+            params = () if species_ids is None else tuple(species_ids)
+            species_filter = "" if species_ids is None else f"AND species_id IN ({','.join('?' * len(params))})"
+            sounds = conn.execute(f"""
+                SELECT id, species_id, file_path, content_hash FROM sounds
+                WHERE file_path IS NOT NULL AND content_hash IS NOT NULL {species_filter}
+                ORDER BY species_id, id
+            """, params).fetchall()
+            sounds = [row for row in sounds if os.path.exists(row[2])]
+            paths = {content_hash: path for _, _, path, content_hash in sounds}
+            hashes = tuple(paths)
+            placeholders = ",".join("?" * len(hashes))
+            sources = {row[0]: row[1:] for row in conn.execute(
+                f"SELECT content_hash, duration, bitrate, error FROM audio_sources WHERE content_hash IN ({placeholders})", hashes)}
+            clips = {row[0]: row[1] for row in conn.execute(
+                f"SELECT source_hash, clip_path FROM audio_clips WHERE settings = ? AND source_hash IN ({placeholders})",
+                (self.settings, *hashes)) if os.path.exists(row[1])}
+        finally:
+            conn.close()
+        os.makedirs(media_store.TMP_ROOT, exist_ok=True)
+
+        # 1. Probe each new source file's frame headers
+        to_probe = [h for h in paths if h not in sources]
+        futures = {pool.submit(probe, paths[h]): h for h in to_probe}
+        for future in concurrent.futures.as_completed(futures):
+            content_hash = futures[future]
+            try:
+                duration, kbps = future.result()
+                sources[content_hash] = (duration, kbps, None)
+            except (OSError, ValueError) as e:
+                metrics.echo(f"Could not read {paths[content_hash]}: {e}")
+                sources[content_hash] = (None, None, str(e))
+            writer.execute("INSERT OR REPLACE INTO audio_sources (content_hash, duration, bitrate, error) VALUES (?, ?, ?, ?)",
+                           (content_hash, *sources[content_hash]))
+
+        # 2. Pick the recordings each species keeps
+        by_species = {}
+        for sound_id, species_id, _, content_hash in sounds:
+            duration, kbps, error = sources[content_hash]
+            if error is None:
+                by_species.setdefault(species_id, []).append((sound_id, duration, kbps))
+        selected = set()
+        for species_sounds in by_species.values():
+            selected.update(select_sounds(species_sounds, self.max_sounds, self.clip_seconds, self.max_species_seconds,
+                                          self.max_species_bytes, self.bitrate if self.encoder else None))
+        hash_of = {sound_id: content_hash for sound_id, _, _, content_hash in sounds}
+
+        # 3. Cut clips that don't exist for these settings yet
+        needed = {hash_of[sound_id] for sound_id in selected} - set(clips)
+        futures = {}
+        for content_hash in needed:
+            dest = os.path.join(media_store.TMP_ROOT, f"clip_{content_hash}.mp3")
+            futures[pool.submit(make_clip, paths[content_hash], dest, self.clip_seconds, self.bitrate, self.encoder)] = (content_hash, dest)
+        for future in concurrent.futures.as_completed(futures):
+            content_hash, dest = futures[future]
+            try:
+                clip_seconds, clip_bytes = future.result()
+            except (OSError, ValueError) as e:
+                metrics.echo(f"Could not clip {paths[content_hash]}: {e}")
+                continue
+            clips[content_hash] = media_store.add(dest)
+            writer.execute("INSERT OR REPLACE INTO audio_clips (source_hash, settings, clip_path, clip_bytes, clip_seconds)"
+                           " VALUES (?, ?, ?, ?, ?)", (content_hash, self.settings, clips[content_hash], clip_bytes, clip_seconds))
+
+        # 4. Point the deck at the kept clips; files we can't parse are passed through untouched
+        for sound_id, _, _, content_hash in sounds:
+            keep = sound_id in selected and content_hash in clips
+            selected_flag = None if sources[content_hash][2] is not None else int(keep)
+            writer.execute("UPDATE sounds SET selected = ?, clip_path = ? WHERE id = ?",
+                           (selected_flag, clips[content_hash] if keep else None, sound_id))
+
+        kept_hashes = {hash_of[sound_id] for sound_id in selected}
+        counts = {
+            "probed": len(to_probe),
+            "sounds": len(sounds),
+            "kept": len(selected),
+            "species": len(by_species),
+            "clipped": len(needed),
+            "source_bytes": sum(os.path.getsize(paths[h]) for h in kept_hashes),
+            "clip_bytes": sum(os.path.getsize(clips[h]) for h in kept_hashes if h in clips),
+        }
+        with self._lock:
+            for key, value in counts.items():
+                self.report[key] += value
+        for key, value in counts.items():
+            metrics.inc(f"audio_{key}_total", value)
+        return counts
+
+    def summary(self):
+        r = self.report
+        return (f"Audio budget: kept {r['kept']} of {r['sounds']} recordings for {r['species']} species; probed {r['probed']}, "
+                f"cut {r['clipped']} new clips; {r['source_bytes'] / 1e6:.1f} MB of source audio -> {r['clip_bytes'] / 1e6:.1f} MB of clips")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Select and trim bird sounds to an audio budget")
+    parser.add_argument("--max-sounds", type=int, default=MAX_SOUNDS, help="Recordings kept per species")
+    parser.add_argument("--clip-seconds", type=int, default=CLIP_SECONDS, help="Length each kept recording is cut to")
+    parser.add_argument("--max-species-seconds", type=int, default=MAX_SPECIES_SECONDS, help="Total clip time per species")
+    parser.add_argument("--max-species-kb", type=int, default=MAX_SPECIES_BYTES // 1000, help="Total clip size per species")
+    parser.add_argument("--bitrate", type=int, default=TARGET_BITRATE,
+                        help="Re-encode clips to this many kbps when ffmpeg or lame is installed (0 disables)")
+    parser.add_argument("--workers", type=int, help="Audio processes (default: CPU count)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.instrumented(args, "audio"):
+        run(args)
+
+
+def run(args):
+    encoder = find_encoder() if args.bitrate else None
+    budget = AudioBudget(args.max_sounds, args.clip_seconds, args.max_species_seconds, args.max_species_kb * 1000,
+                         args.bitrate, encoder)
+    print(f"Audio settings {budget.settings} (encoder: {encoder or 'none, trimming only'})")
+
+    with DBWriter() as writer, concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        budget.run(writer, pool)
+    print(budget.summary())
+    print(f"DB writer: {writer.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Release manifests and delta packages.
+
+Each release records what its master deck contained in releases/<name>.json:
+a digest of every note's fields, keyed by the note's stable GUID, and a
+fingerprint of every media file. A later build can then package only the notes
+that are new or changed since a release, plus the media files those notes use
+that the release didn't already ship. Anki matches notes by GUID, so importing
+that delta on top of the release's deck updates the changed notes and adds the
+new ones, which gives the same notes as importing the full build. Anki imports
+never delete notes, so notes removed since the release are only listed in the
+report.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+
+RELEASES_DIR = "releases"
+RELEASE_NAME = re.compile(r"^[\w.-]+$")
+# Media a note's fields refer to: <img src="..."> and [sound:...]
+MEDIA_REFERENCE = re.compile(r'src="([^"]+)"|\[sound:([^\]]+)\]')
+
+
+def check_name(name):
+    """Raise ValueError unless name is usable as a release name (letters, digits, '.', '-', '_')."""
+    if not RELEASE_NAME.match(name):
+        raise ValueError(f"Invalid release name '{name}': use letters, digits, '.', '-' and '_'")
+    return name
+
+
+def manifest_path(name, suffix=""):
+    """Path of a release manifest; suffix separates deck profiles (see generate_anki_deck.DECK_PROFILES)."""
+    return os.path.join(RELEASES_DIR, f"{check_name(name)}{suffix}.json")
+
+
+def note_digest(fields):
+    return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+
+def referenced_media(fields):
+    return {image or sound for field in fields for image, sound in MEDIA_REFERENCE.findall(field)}
+
+
+def build_manifest(name, deck_id, deck_name, notes, media_files, media_fingerprint):
+    return {
+        "release": name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "deck_id": deck_id,
+        "deck_name": deck_name,
+        "notes": {guid: note_digest(fields) for guid, fields in notes},
+        "media": {os.path.basename(path): media_fingerprint(path) for path in media_files},
+    }
+
+
+def write_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(path):
+    """A release manifest; raises ValueError if it doesn't exist or can't be read."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(f"No release manifest at {path}") from None
+    except ValueError as e:
+        raise ValueError(f"Unreadable release manifest {path}: {e}") from None
+
+
+def delta(manifest, notes, media_files, media_fingerprint):
+    """
+    (notes, media_files, report) holding only what changed since manifest:
+    new or edited notes, and the media they reference that the release didn't
+    ship (or shipped with different content).
+    """
+    old_notes, old_media = manifest["notes"], manifest["media"]
+    changed = [(guid, fields) for guid, fields in notes if old_notes.get(guid) != note_digest(fields)]
+    wanted = set()
+    for _, fields in changed:
+        wanted |= referenced_media(fields)
+    changed_media = [path for path in media_files if os.path.basename(path) in wanted
+                     and old_media.get(os.path.basename(path)) != media_fingerprint(path)]
+    current = {guid for guid, _ in notes}
+    report = {
+        "added": sum(1 for guid, _ in changed if guid not in old_notes),
+        "changed": sum(1 for guid, _ in changed if guid in old_notes),
+        "removed": sum(1 for guid in old_notes if guid not in current),
+        "media": len(changed_media),
+    }
+    return changed, changed_media, report
@@ -0,0 +1,111 @@
+"""
+Persistent, compressed store of raw birds.org.il API responses.
+
+Discovery and fetch share it, so every species ID costs one request, and the
+species/images/sounds tables can be rebuilt from it without touching the network.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+CACHE_FILE = "api_cache.sqlite3"
+API_LANG = "he"
+COMPRESSION_LEVEL = 6
+
+CREATE_RESPONSES_TABLE = """
+CREATE TABLE IF NOT EXISTS api_responses (
+    species_id INTEGER,
+    lang TEXT,
+    status INTEGER,
+    body BLOB,
+    fetched_at REAL,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    PRIMARY KEY(species_id, lang)
+);
+"""
+
+# Columns added after the table was first shipped: (name, type)
+ADDED_COLUMNS = [("etag", "TEXT"), ("last_modified", "TEXT"), ("content_hash", "TEXT")]
+
+class ResponseCache:
+    def __init__(self, path=CACHE_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute(CREATE_RESPONSES_TABLE)
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(api_responses)")}
+        for name, col_type in ADDED_COLUMNS:
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE api_responses ADD COLUMN {name} {col_type}")
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def put(self, species_id, status, body, headers=None, lang=API_LANG):
+        """
+        Store a raw response body (bytes) with its HTTP validators. Non-200
+        responses are kept without a body. Returns True if the content differs
+        from what was stored before.
+        """
+        ok = status == 200 and body
+        blob = zlib.compress(body, COMPRESSION_LEVEL) if ok else None
+        content_hash = hashlib.sha256(body).hexdigest() if ok else None
+        headers = headers or {}
+        previous = self.conn.execute(
+            "SELECT content_hash FROM api_responses WHERE species_id=? AND lang=?", (species_id, lang)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO api_responses (species_id, lang, status, body, fetched_at, etag, last_modified, content_hash)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (species_id, lang, status, blob, time.time(),
+             headers.get("ETag") if ok else None, headers.get("Last-Modified") if ok else None, content_hash))
+        self.conn.commit()
+        return previous is None or previous[0] != content_hash
+
+    def validator(self, species_id, lang=API_LANG):
+        """(etag, last_modified, content_hash) of a cached 200 response, or None."""
+        row = self.conn.execute(
+            "SELECT etag, last_modified, content_hash FROM api_responses WHERE species_id=? AND lang=? AND status=200",
+            (species_id, lang)).fetchone()
+        return tuple(row) if row else None
+
+    def touch(self, species_id, lang=API_LANG):
+        """Mark a cached response as revalidated (the server answered 304)."""
+        self.conn.execute("UPDATE api_responses SET fetched_at=? WHERE species_id=? AND lang=?",
+                          (time.time(), species_id, lang))
+        self.conn.commit()
+
+    def checked(self, lang=API_LANG):
+        """{species_id: (status, fetched_at)} for every stored response, valid or not."""
+        return {row[0]: (row[1], row[2]) for row in self.conn.execute(
+            "SELECT species_id, status, fetched_at FROM api_responses WHERE lang=?", (lang,))}
+
+    def get(self, species_id, lang=API_LANG):
+        """Return the parsed JSON of a cached 200 response, or None."""
+        row = self.conn.execute(
+            "SELECT body FROM api_responses WHERE species_id=? AND lang=? AND status=200 AND body IS NOT NULL",
+            (species_id, lang)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def iter_species(self, lang=API_LANG):
+        """Yield the parsed JSON of every cached 200 response, in ID order."""
+        rows = self.conn.execute(
+            "SELECT body FROM api_responses WHERE lang=? AND status=200 AND body IS NOT NULL ORDER BY species_id",
+            (lang,)).fetchall()
+        for (blob,) in rows:
+            try:
+                yield json.loads(zlib.decompress(blob))
+            except ValueError:
+                continue
@@ -0,0 +1,56 @@
+"""DBWriter error handling."""
+import sqlite3
+
+import pytest
+
+import db
+
+
+def species_names(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT hebrew_name FROM species ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def test_failed_statement_rolls_back_its_batch_and_raises_on_flush(tmp_path):
+    path = str(tmp_path / "birds.sqlite3")
+    with db.DBWriter(path, flush_interval=60) as writer:
+        writer.execute("INSERT INTO species (id, hebrew_name) VALUES (?, ?)", (1, "a"))
+        writer.execute("INSERT INTO no_such_table VALUES (?)", (1,))
+        with pytest.raises(sqlite3.OperationalError):
+            writer.flush()
+        # The writer is still running and the next batch commits
+        writer.execute("INSERT INTO species (id, hebrew_name) VALUES (?, ?)", (2, "b"))
+        writer.flush()
+        assert writer.stats()["errors"] == 1
+    assert species_names(path) == ["b"]
+
+
+def test_failing_call_undoes_only_its_own_writes(tmp_path):
+    path = str(tmp_path / "birds.sqlite3")
+
+    def fails(conn):
+        conn.execute("INSERT INTO species (id, hebrew_name) VALUES (2, 'b')")
+        raise ValueError("boom")
+
+    with db.DBWriter(path, flush_interval=60) as writer:
+        writer.execute("INSERT INTO species (id, hebrew_name) VALUES (?, ?)", (1, "a"))
+        future = writer.submit(fails)
+        writer.flush()
+        with pytest.raises(ValueError):
+            future.result()
+    assert species_names(path) == ["a"]
+
+
+def test_calls_in_a_rolled_back_batch_fail(tmp_path):
+    path = str(tmp_path / "birds.sqlite3")
+    with db.DBWriter(path, flush_interval=60) as writer:
+        future = writer.submit(lambda conn: conn.execute("INSERT INTO species (id, hebrew_name) VALUES (1, 'a')").rowcount)
+        writer.execute("INSERT INTO no_such_table VALUES (?)", (1,))
+        with pytest.raises(sqlite3.OperationalError):
+            writer.flush()
+        with pytest.raises(sqlite3.OperationalError):
+            future.result()
+    assert species_names(path) == []
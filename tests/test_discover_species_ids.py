@@ -0,0 +1,105 @@
+"""SpeciesDiscovery against a fake ID space served by an in-memory engine."""
+import asyncio
+import json
+
+import pytest
+
+from discover_species_ids import SpeciesDiscovery
+from http_engine import FetchError, FetchResult
+from response_cache import ResponseCache
+
+
+class FakeEngine:
+    """Answers species requests from a set of live IDs; each species links to its neighbours."""
+
+    def __init__(self, ids, links=True):
+        self.ids = set(ids)
+        self.links = links
+        self.requests = []
+
+    async def get(self, url, headers=None):
+        species_id = int(url.rsplit("/", 1)[1])
+        self.requests.append(species_id)
+        if species_id not in self.ids:
+            return FetchResult(url, 404, {}, b"", 0.0)
+        related = [{"id": i} for i in (species_id - 1, species_id + 1) if i in self.ids and self.links]
+        body = json.dumps({"id": species_id, "name": f"bird {species_id}", "latinName": "Avis", "relatedSpecies": related})
+        return FetchResult(url, 200, {}, body.encode(), 0.0)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with ResponseCache(str(tmp_path / "cache.sqlite3")) as cache:
+        yield cache
+
+
+def discover(engine, cache, **options):
+    options.setdefault("hint", 50)
+    discovery = SpeciesDiscovery(engine, cache, show_progress=False, **options)
+    return discovery, asyncio.run(discovery.run())
+
+
+LIVE = set(range(1, 40)) - {5, 6, 7, 20} | set(range(44, 61))  # a gap of 4 and one of 3 above the hint
+
+
+def test_cold_cache_finds_every_id_without_more_than_a_linear_scan(cache):
+    engine = FakeEngine(LIVE)
+    discovery, ids = discover(engine, cache, max_gap=8)
+    assert ids == sorted(LIVE)
+    assert discovery.upper == 60
+    # A linear scan up to the top, plus the window that confirms the end
+    assert len(engine.requests) <= 60 + 8
+    assert len(engine.requests) == len(set(engine.requests))
+
+
+def test_rerun_probes_only_the_window_above_the_bound(cache):
+    discover(FakeEngine(LIVE), cache, max_gap=8)
+    engine = FakeEngine(LIVE)
+    _, ids = discover(engine, cache, max_gap=8)
+    assert ids == sorted(LIVE)
+    assert sorted(engine.requests) == list(range(61, 69))
+
+
+def test_rerun_finds_species_added_above_the_bound(cache):
+    discover(FakeEngine(LIVE), cache, max_gap=8)
+    engine = FakeEngine(LIVE | set(range(61, 67)))
+    discovery, ids = discover(engine, cache, max_gap=8)
+    assert ids == sorted(LIVE | set(range(61, 67)))
+    assert discovery.upper == 66
+
+
+def test_gap_wider_than_max_gap_ends_the_range(cache):
+    engine = FakeEngine({1, 2, 3, 30})
+    discovery, ids = discover(engine, cache, hint=3, max_gap=8, scan_gaps=False)
+    assert ids == [1, 2, 3]
+    assert discovery.upper == 3
+
+
+def test_bound_search_from_a_low_hint_gallops(cache):
+    engine = FakeEngine(set(range(1, 201)), links=False)
+    discovery, ids = discover(engine, cache, hint=1, max_gap=4, scan_gaps=False)
+    assert discovery.upper == 200
+    # Doubling steps plus a binary search of the edge, not a walk through all 200
+    assert discovery.requests["bound"] < 25
+    assert set(ids) <= set(range(1, 201)) and 200 in ids
+
+
+def test_removed_species_drop_out_once_their_entry_is_stale(cache):
+    discover(FakeEngine(LIVE), cache, max_gap=8)
+    engine = FakeEngine(LIVE - {10})
+    _, ids = discover(engine, cache, max_gap=8)
+    assert 10 in ids  # cached as valid within the TTL
+    discovery, ids = discover(engine, cache, max_gap=8, valid_ttl=0)
+    assert 10 not in ids
+    assert discovery.report["removed"] == 1
+
+
+def test_stale_species_are_kept_when_the_recheck_fails(cache):
+    discover(FakeEngine(LIVE), cache, max_gap=8)
+
+    class Failing(FakeEngine):
+        async def get(self, url, headers=None):
+            raise FetchError(url)
+
+    _, ids = discover(Failing(LIVE), cache, max_gap=8, valid_ttl=0)
+    assert ids == sorted(LIVE)
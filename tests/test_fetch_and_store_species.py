@@ -0,0 +1,45 @@
+"""Incremental refresh of stored species."""
+import asyncio
+import collections
+import json
+
+import db
+import fetch_and_store_species as fetch
+from http_engine import FetchResult
+from response_cache import ResponseCache
+
+
+class FakeEngine:
+    def __init__(self, responses):
+        self.responses = responses  # species id -> (status, data)
+
+    async def get(self, url, headers=None):
+        status, data = self.responses[int(url.rsplit("/", 1)[1])]
+        return FetchResult(url, status, {}, json.dumps(data).encode() if data else b"", 0.0)
+
+
+def species(species_id, name):
+    return {"id": species_id, "name": name, "latinName": "Avis", "speciesFamilyName": "fam", "images": [], "sounds": []}
+
+
+def test_404_for_a_stored_species_removes_it(tmp_path):
+    path = str(tmp_path / "birds.sqlite3")
+    with ResponseCache(str(tmp_path / "cache.sqlite3")) as cache, db.DBWriter(path) as writer:
+        for species_id in (1, 2):
+            fetch.parse_and_store(species(species_id, f"bird {species_id}"), writer)
+        writer.flush()
+        cache.put(1, 200, json.dumps(species(1, "bird 1")).encode())
+        engine = FakeEngine({1: (200, species(1, "bird 1")), 2: (404, None)})
+        stored_ids, report = {1, 2}, collections.Counter()
+
+        async def refresh():
+            return [await fetch.refresh_one(engine, i, cache, writer, stored_ids, report) for i in (1, 2)]
+
+        assert asyncio.run(refresh()) == [False, True]
+        writer.flush()
+        assert cache.get(2) is None
+    conn = db.connect(path)
+    assert [row[0] for row in conn.execute("SELECT id FROM species")] == [1]
+    conn.close()
+    assert report["removed"] == 1 and report["failed"] == 0
+    assert stored_ids == {1}